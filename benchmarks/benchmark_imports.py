@@ -0,0 +1,167 @@
+"""Checks how long it takes to start up, i.e. to import the tool's modules in a fresh Python process.
+
+Run from the root of the repo:
+    python benchmarks/benchmark_imports.py
+
+Each module is imported in its own process (best of --repeat runs), after the third-party libraries every run needs
+anyway (pandas, numpy, psycopg2, dotenv). Its cumulative import time from python -X importtime, which only counts
+what it imports on top of those, is compared to the budget.
+Fails if a module goes over its budget, or if importing it loads a library that should only be loaded on first use.
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIR)
+
+import json
+import argparse
+import subprocess
+from library.log_config import get_logger
+
+# Initiate logging
+log = get_logger(__name__)
+
+# Seconds each module may take to import, on top of BASE_IMPORTS (its cumulative time from python -X importtime).
+# main takes ~0.05s, so this leaves room for noise and slower machines, but not for another heavy library
+# (libraries that should be lazy are checked separately, see LAZY_MODULES)
+IMPORT_TIME_BUDGET_SECONDS = float(os.environ.get("IMPORT_TIME_BUDGET_SECONDS", 0.1))
+MODULES = [
+    "library.log_config",
+    "library.connection_utils",
+    "library.database_utils",
+    "library.s3_utils",
+    "utils.obfuscation_utils",
+    "main",
+]
+# Imported by every run, so they are imported first, and aren't counted against the budget
+BASE_IMPORTS = ["pandas", "numpy", "psycopg2", "dotenv"]
+# Only needed by some runs, so they must be imported on first use
+LAZY_MODULES = [
+    "boto3",
+    "botocore",
+    "sqlalchemy",
+    "black",
+    "multiprocessing.connection",
+]
+# Written to stderr once the base imports are done, so only the imports that come after it are counted
+BASE_IMPORTS_DONE = "-- base imports done --"
+
+# Run in a fresh process with -X importtime: import the base imports, then the module, and report which lazy
+# modules were loaded
+IMPORT_SCRIPT = """
+import json, sys
+for module in {base_imports!r}:
+    __import__(module)
+print({marker!r}, file=sys.stderr, flush=True)
+__import__({module!r})
+print(json.dumps({{"loaded": [m for m in {lazy_modules!r} if m in sys.modules]}}))
+"""
+
+
+class ImportFailed(Exception):
+    """Importing the modules in a fresh process failed"""
+
+
+def parse_import_times(stderr: str) -> list:
+    """The imports after the base imports, from python -X importtime: (cumulative seconds, name, depth)"""
+    lines = stderr.splitlines()
+    if BASE_IMPORTS_DONE in lines:
+        lines = lines[lines.index(BASE_IMPORTS_DONE) + 1 :]
+
+    imports = []
+    for line in lines:
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                # Each level of nesting indents the name by two more spaces
+                depth = (len(name) - len(name.lstrip()) - 1) // 2
+                imports.append((int(cumulative) / 1e6, name.strip(), depth))
+
+    return imports
+
+
+def time_import(module: str, repeat: int) -> dict:
+    """Best time to import the module (and everything it imports, apart from the base imports) in a fresh process,
+    the lazy modules it loaded, and the import times of that run"""
+    script = IMPORT_SCRIPT.format(
+        base_imports=BASE_IMPORTS,
+        marker=BASE_IMPORTS_DONE,
+        module=module,
+        lazy_modules=LAZY_MODULES,
+    )
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", script],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            # The end of the traceback says what went wrong
+            error = "\n".join(result.stderr.strip().splitlines()[-5:])
+            raise ImportFailed(f"Importing {module} failed:\n{error}")
+
+        imports = parse_import_times(result.stderr)
+        runs.append(
+            {
+                # The top level imports (e.g. `library` and `library.s3_utils`) include everything under them
+                "seconds": sum(seconds for seconds, _, depth in imports if depth == 0),
+                "loaded": json.loads(result.stdout.strip().splitlines()[-1])["loaded"],
+                "imports": imports,
+            }
+        )
+
+    return min(runs, key=lambda run: run["seconds"])
+
+
+def slowest_imports(imports: list, num_imports: int = 10) -> list:
+    """The imports that took the longest (cumulative)"""
+    return sorted(((seconds, name) for seconds, name, _ in imports), reverse=True)[
+        :num_imports
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the import time of the tool's modules against a budget"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=IMPORT_TIME_BUDGET_SECONDS,
+        help="Seconds each module may take to import, on top of pandas, numpy, psycopg2 and dotenv",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per module (the best is kept)"
+    )
+    args = parser.parse_args()
+
+    failures = []
+    for module in MODULES:
+        try:
+            result = time_import(module, args.repeat)
+        except ImportFailed as e:
+            failures.append(str(e))
+            continue
+        log.info(f"`{module}`: {result['seconds']:.3f}s on top of the base imports")
+
+        if result["seconds"] > args.budget:
+            slowest = "\n".join(
+                f"  {seconds:.3f}s {name}"
+                for seconds, name in slowest_imports(result["imports"])
+            )
+            failures.append(
+                f"`{module}` takes {result['seconds']:.3f}s to import (budget {args.budget:.3f}s). "
+                f"Slowest imports:\n{slowest}"
+            )
+        if result["loaded"]:
+            failures.append(
+                f"`{module}` loads {', '.join(result['loaded'])} on import, they should be imported on first use"
+            )
+
+    if failures:
+        log.error("Startup check failed:\n" + "\n".join(failures))
+        sys.exit(1)
+    log.info(f"Every module imports within {args.budget:.3f}s")
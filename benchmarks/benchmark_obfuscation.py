@@ -0,0 +1,410 @@
+"""Benchmarks the obfuscation kernels and obfuscate_dataframe on synthetic data shaped like the beneficiaries table.
+
+Run from the root of the repo:
+    python benchmarks/benchmark_obfuscation.py                   # compare against the saved baseline
+    python benchmarks/benchmark_obfuscation.py --save-baseline   # save the results as the new baseline
+
+If there is no baseline yet, the results are saved as the baseline. Timings depend on the machine, so the baseline
+records the machine it was measured on, and a baseline from a different machine is replaced instead of compared.
+
+Exits with a non-zero status if any benchmark's rows/sec dropped, or its peak memory grew,
+by more than the regression threshold compared to the baseline.
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIR)
+
+import gc
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import datetime as dt
+import numpy as np
+import pandas as pd
+from typing import Callable
+from library.log_config import get_logger
+from utils.obfuscation_utils import (
+    COLUMN_KERNELS,
+    ObfuscationPlan,
+    obfuscate_dataframe,
+    obfuscate_varchar,
+    obfuscate_int,
+    obfuscate_date,
+    obfuscate_super,
+)
+
+from pandas import DataFrame as DF
+
+# Initiate logging
+log = get_logger(__name__)
+
+DEFAULT_PROFILE = os.path.join(
+    ROOT_DIR, "table_obfuscation_profiles", "basetables.beneficiaries.csv"
+)
+DEFAULT_BASELINE = os.path.join(ROOT_DIR, "benchmarks", "baselines", "obfuscation.json")
+DEFAULT_ROW_COUNTS = [10_000, 100_000, 1_000_000]
+# Fractional drop in rows/sec (or growth in peak memory) that counts as a regression
+REGRESSION_THRESHOLD = float(os.environ.get("BENCHMARK_REGRESSION_THRESHOLD", 0.2))
+# What identifies the machine a baseline was measured on
+MACHINE_KEYS = ["node", "machine", "processor", "cpus"]
+# The row-by-row kernels are slow, so they are only timed on up to this many rows
+SCALAR_KERNEL_MAX_ROWS = 100_000
+
+NAMES = ["MARY", "JOHN", "PATRICIA", "ROBERT", "LINDA", "JAMES", "BARBARA", "O'NEIL"]
+CITIES = ["BALTIMORE", "SPRINGFIELD", "COLUMBUS", "SAN JOSÉ", "PORTLAND", "AUSTIN"]
+STATES = ["MD", "IL", "OH", "CA", "OR", "TX", "PR"]
+# Characters allowed at each position of an MBI (e.g. 1EG4TE5MK73)
+MBI_POSITIONS = ["123456789", "ACDEFGHJKMNPQRTUVWXY", "ACDEFGHJKMNPQRTUVWXY0123456789"]
+MBI_FORMAT = [0, 1, 2, 0, 1, 2, 0, 1, 1, 0, 0]
+# Share of NULLs in the columns that are often empty (the rest get DEFAULT_NULL_RATE)
+NULL_RATES = {
+    "death_date": 0.9,
+    "railroad_retirement_board_number": 0.98,
+    "middle_name": 0.4,
+    "part_a_stop_date": 0.8,
+    "part_b_stop_date": 0.8,
+    "hicn_history": 0.5,
+    "mbi_history": 0.3,
+    "ma_enrollment_effective_date": 0.6,
+    "pdp_enrollment_effective_date": 0.6,
+}
+DEFAULT_NULL_RATE = 0.05
+
+
+def synthetic_dtype(column_name: str) -> str:
+    """Data type of a beneficiaries column, going by its name"""
+    if column_name in ("beneficiary_key", "coverage_bk", "beneficiary_partition"):
+        return "int"
+    if column_name.endswith("_date_time"):
+        return "timestamp"
+    if column_name.endswith(("_date", "_lst_updt")):
+        return "date"
+    if column_name.endswith(("_history", "_json", "_information", "_ssa")):
+        return "super"
+    return "varchar"
+
+
+def random_strings(
+    rng: np.random.Generator, num_rows: int, alphabets: list
+) -> np.ndarray:
+    """Strings with a character from alphabets[i] at position i"""
+    chars = np.stack(
+        [rng.choice(list(alphabet), size=num_rows) for alphabet in alphabets], axis=1
+    )
+    return chars.astype("<U1").view(f"<U{len(alphabets)}").ravel().astype(object)
+
+
+def random_dates(rng: np.random.Generator, num_rows: int) -> np.ndarray:
+    days = rng.integers(-30_000, 3_000, size=num_rows)
+    return np.datetime64(dt.date.today()) + days.astype("timedelta64[D]")
+
+
+def synthetic_column(rng: np.random.Generator, column_name: str, num_rows: int):
+    """Values for a column, in the shape they come back from the database"""
+    dtype = synthetic_dtype(column_name)
+    if column_name == "beneficiary_key":
+        return rng.permutation(num_rows) + 1_000_000
+    if dtype == "int":
+        return rng.integers(0, 10**9, size=num_rows)
+    if dtype == "timestamp":
+        return random_dates(rng, num_rows) + rng.integers(
+            0, 86_400, size=num_rows
+        ).astype("timedelta64[s]")
+    if dtype == "date":
+        # psycopg2 returns dates as datetime.date objects
+        return random_dates(rng, num_rows).astype(object)
+    if dtype == "super":
+        mbis = random_strings(rng, num_rows, [MBI_POSITIONS[i] for i in MBI_FORMAT])
+        dates = np.datetime_as_string(random_dates(rng, num_rows))
+        if column_name.endswith("_history"):
+            return [
+                f'[{{"id": "{mbi}", "effective_date": "{date}", "end_date": null}}]'
+                for mbi, date in zip(mbis, dates)
+            ]
+        cities = rng.choice(CITIES, size=num_rows)
+        return [
+            f'{{"line_1": "{number} MAIN ST", "city": "{city}", "zip_code": "{number:05d}", '
+            f'"valid_from": "{date}", "is_verified": true}}'
+            for number, city, date in zip(
+                rng.integers(1, 99_999, size=num_rows), cities, dates
+            )
+        ]
+    if "mbi" in column_name or column_name == "beneficiary_identification_code":
+        return random_strings(rng, num_rows, [MBI_POSITIONS[i] for i in MBI_FORMAT])
+    if column_name.endswith("name"):
+        return rng.choice(NAMES, size=num_rows).astype(object)
+    if column_name.endswith("city"):
+        return rng.choice(CITIES, size=num_rows).astype(object)
+    if column_name.endswith("state"):
+        return rng.choice(STATES, size=num_rows).astype(object)
+    if "zip" in column_name or "code" in column_name or "ssn" in column_name:
+        return random_strings(rng, num_rows, ["0123456789"] * 9)
+    return random_strings(rng, num_rows, ["ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"] * 10)
+
+
+def make_synthetic_frame(profile: DF, num_rows: int, seed: int = 0) -> DF:
+    """Synthetic results with the columns of an obfuscation profile, and NULLs at roughly realistic rates"""
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for column_name in profile["column_name"]:
+        values = pd.Series(synthetic_column(rng, column_name, num_rows))
+        null_rate = (
+            0
+            if column_name == "beneficiary_key"
+            else NULL_RATES.get(column_name, DEFAULT_NULL_RATE)
+        )
+        is_null = rng.random(num_rows) < null_rate
+        if pd.api.types.is_integer_dtype(values):
+            values = values.astype("Int64")
+        values[is_null] = None
+        columns[column_name] = values
+
+    return pd.DataFrame(columns)
+
+
+def fields_to_obfuscate(profile: DF) -> DF:
+    """The fields to obfuscate and their data types, as find_fields_to_obfuscate returns them"""
+    obfuscated = profile[profile["obfuscate"].str.lower() != "no"]
+    return pd.DataFrame(
+        {"dtype": [synthetic_dtype(column) for column in obfuscated["column_name"]]},
+        index=pd.Index(obfuscated["column_name"], name="column_name"),
+    ).sort_index()
+
+
+def measure(func: Callable, num_rows: int, repeat: int) -> dict:
+    """Best time of `repeat` runs, and the peak memory allocated by a separate (traced) run"""
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start_time)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    best_seconds = min(seconds)
+    return {
+        "rows": num_rows,
+        "seconds": round(best_seconds, 4),
+        "rows_per_sec": round(num_rows / best_seconds, 1),
+        "peak_memory_mb": round(peak_memory / 1024**2, 2),
+    }
+
+
+def scalar_benchmarks(df: DF, fields: DF, rand_ints, rand_days) -> dict:
+    """The row-by-row kernels, on the first column of each data type"""
+    scalar_kernels = {
+        "int": lambda value, ri, rd, column: obfuscate_int(value, ri, rd),
+        "date": lambda value, ri, rd, column: obfuscate_date(value, rd),
+        "timestamp": lambda value, ri, rd, column: obfuscate_date(value, rd),
+        "varchar": obfuscate_varchar,
+        "super": lambda value, ri, rd, column: obfuscate_super(value, ri, rd),
+    }
+
+    benchmarks = {}
+    for dtype, kernel in scalar_kernels.items():
+        columns = fields.index[fields["dtype"] == dtype]
+        if columns.empty:
+            continue
+        column = columns[0]
+        values = df[column].head(SCALAR_KERNEL_MAX_ROWS).tolist()
+        if dtype == "timestamp":
+            # obfuscate_date compares against datetime.now(), so it is given datetimes
+            values = [
+                None if pd.isna(value) else value.to_pydatetime() for value in values
+            ]
+        values = [None if value is pd.NA else value for value in values]
+
+        benchmarks[f"scalar.{dtype}.{column}"] = (
+            lambda kernel=kernel, values=values, column=column: [
+                kernel(value, int(ri), int(rd), column)
+                for value, ri, rd in zip(values, rand_ints, rand_days)
+            ],
+            len(values),
+        )
+
+    return benchmarks
+
+
+def column_benchmarks(df: DF, fields: DF, rand_ints, rand_days) -> dict:
+    """The column kernels, on every column that is obfuscated (grouped by data type)"""
+    benchmarks = {}
+    for dtype, kernel in COLUMN_KERNELS.items():
+        columns = list(fields.index[fields["dtype"] == dtype])
+        if not columns:
+            continue
+
+        def run_kernel(kernel=kernel, columns=columns, dtype=dtype):
+            for column in columns:
+                options = {"field_name": column} if dtype == "varchar" else {}
+                kernel(df[column], rand_ints, rand_days, **options)
+
+        benchmarks[f"column.{dtype}"] = (run_kernel, len(df.index) * len(columns))
+
+    return benchmarks
+
+
+def run_benchmarks(profile: DF, row_counts: list, repeat: int) -> dict:
+    """Benchmarks every kernel and obfuscate_dataframe at each number of rows"""
+    fields = fields_to_obfuscate(profile)
+    results = {}
+    for num_rows in row_counts:
+        log.info(f"Generating {num_rows} synthetic rows")
+        df = make_synthetic_frame(profile, num_rows)
+        plan = ObfuscationPlan.compile(fields, df.columns)
+        rng = np.random.default_rng(1)
+        rand_ints = rng.integers(1, 10, size=num_rows)
+        rand_days = rng.integers(1, 1001, size=num_rows)
+
+        benchmarks = {
+            **scalar_benchmarks(df, fields, rand_ints, rand_days),
+            **column_benchmarks(df, fields, rand_ints, rand_days),
+            "obfuscate_dataframe": (
+                lambda: obfuscate_dataframe(df, plan, show_comparison=False),
+                num_rows,
+            ),
+        }
+
+        # The biggest frames are only run once, they take long enough to time reliably
+        runs = 1 if num_rows >= 1_000_000 else repeat
+        results[str(num_rows)] = {}
+        for name, (func, rows) in benchmarks.items():
+            log.info(f"Benchmarking `{name}` on {rows} rows")
+            results[str(num_rows)][name] = measure(func, rows, runs)
+
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> list:
+    """Benchmarks whose rows/sec dropped, or peak memory grew, by more than the threshold"""
+    regressions = []
+    for num_rows, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            previous = baseline.get(num_rows, {}).get(name)
+            if previous is None:
+                continue
+
+            if result["rows_per_sec"] < previous["rows_per_sec"] * (1 - threshold):
+                regressions.append(
+                    f"{name} ({num_rows} rows): {result['rows_per_sec']:.0f} rows/sec, "
+                    f"baseline {previous['rows_per_sec']:.0f}"
+                )
+            if result["peak_memory_mb"] > previous["peak_memory_mb"] * (1 + threshold):
+                regressions.append(
+                    f"{name} ({num_rows} rows): {result['peak_memory_mb']:.1f} MB peak memory, "
+                    f"baseline {previous['peak_memory_mb']:.1f}"
+                )
+
+    return regressions
+
+
+def machine_differences(report: dict, baseline: dict) -> list:
+    """How the machine the baseline was measured on differs from this one (timings from different machines can't be
+    compared)"""
+    return [
+        f"{key}: {baseline.get(key)} (baseline), {report[key]} (this run)"
+        for key in MACHINE_KEYS
+        if baseline.get(key) != report[key]
+    ]
+
+
+def results_table(results: dict) -> DF:
+    return pd.DataFrame(
+        [
+            {"benchmark": name, **result}
+            for benchmarks in results.values()
+            for name, result in benchmarks.items()
+        ]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the obfuscation kernels on synthetic beneficiaries data"
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=DEFAULT_ROW_COUNTS,
+        help="Number of rows to benchmark with",
+    )
+    parser.add_argument(
+        "--profile", default=DEFAULT_PROFILE, help="Obfuscation profile to mimic"
+    )
+    parser.add_argument(
+        "--baseline", default=DEFAULT_BASELINE, help="JSON baseline to compare with"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the new baseline instead of comparing them",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="Fractional slowdown (or memory growth) that fails the benchmark",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per benchmark (the best is kept)"
+    )
+    parser.add_argument("--output", help="Also save the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(pd.read_csv(args.profile), args.rows, args.repeat)
+    log.info(f"Benchmark results:\n{results_table(results).to_string(index=False)}")
+
+    report = {
+        "created": dt.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "node": platform.node(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        differences = machine_differences(report, baseline)
+        if differences:
+            log.warning(
+                f"The baseline in `{args.baseline}` was measured on a different machine, so it is replaced "
+                "with this run instead of being compared:\n" + "\n".join(differences)
+            )
+            baseline = None
+
+    if baseline is None:
+        # The first run on a machine (or with a new --baseline path) becomes the baseline
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        log.info(f"Baseline saved to `{args.baseline}`")
+    else:
+        regressions = find_regressions(results, baseline["results"], args.threshold)
+        if regressions:
+            log.error(
+                f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}:\n"
+                + "\n".join(regressions)
+            )
+            sys.exit(1)
+        log.info(f"No regressions compared to `{args.baseline}`")
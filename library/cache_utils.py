@@ -0,0 +1,81 @@
+import os
+import sys
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(dir_path)
+
+import time
+import pickle
+import hashlib
+from dataclasses import dataclass
+from file_utils import make_dir_if_not_exists
+
+# Initiate logging
+try:
+    # Imported through the package everywhere, so logging is only configured by one copy of log_config
+    from library.log_config import get_logger
+except ImportError:
+    # (unless this folder isn't the `library` package, e.g. when it's used under another name)
+    from log_config import get_logger
+
+log = get_logger(__name__)
+
+
+@dataclass
+class MetadataCache:
+    """On-disk cache for metadata that rarely changes (e.g. table lists, column types, obfuscation profiles).
+
+    Every entry is stored as a pickle file in `cache_folder` (use one folder per database).
+    Entries expire after `ttl_seconds`, and can be tied to a fingerprint (e.g. the hash of the file they were
+    built from) so they are ignored as soon as that changes. If `refresh` is True, nothing is read from the cache,
+    but new entries are still saved.
+    """
+
+    cache_folder: str
+    ttl_seconds: float = 24 * 60 * 60
+    refresh: bool = False
+
+    def get(self, key: str, fingerprint: str = None):
+        """Returns the cached value, or None if it is missing, expired, or its fingerprint doesn't match"""
+        path = self._path(key)
+        if self.refresh or not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            log.warning(f"Could not read the cached `{key}`, ignoring it")
+            return None
+
+        if time.time() - entry["created"] > self.ttl_seconds:
+            log.info(f"Cached `{key}` has expired")
+            return None
+        if entry["fingerprint"] != fingerprint:
+            log.info(f"Cached `{key}` is out of date")
+            return None
+
+        log.info(f"Using cached `{key}`")
+        return entry["value"]
+
+    def set(self, key: str, value, fingerprint: str = None) -> None:
+        """Saves a value to the cache"""
+        make_dir_if_not_exists(self.cache_folder)
+        path = self._path(key)
+        entry = {"created": time.time(), "fingerprint": fingerprint, "value": value}
+
+        # Write to a temp file and rename it, so a partially written entry is never read
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(temp_path, path)
+
+    def _path(self, key: str) -> str:
+        safe_key = "".join(c if c.isalnum() or c in "._-" else "_" for c in key)
+        return os.path.join(self.cache_folder, safe_key + ".pkl")
+
+
+def file_fingerprint(path: str) -> str:
+    """Hash of a file's contents, used to tell when a cached entry built from the file is out of date"""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
@@ -1,3 +1,4 @@
+from __future__ import annotations
 import os
 import sys
 
@@ -7,49 +8,79 @@ sys.path.append(dir_path)
 """Utilities for common database access tasks.
 """
 import subprocess
+import json
+import time
 import psycopg2
-import sqlalchemy
+import psycopg2.pool
 import os
-import boto3
+import threading
 from dotenv import load_dotenv
 from dataclasses import dataclass
-from sqlalchemy.engine import Connection
+from typing import TYPE_CHECKING
 from command_line_utils import bash_cmd
 
+if TYPE_CHECKING:
+    # Only used for type hints (SQLAlchemy takes a while to import, and is only needed for SQLAlchemy connections)
+    from sqlalchemy.engine import Connection
+
 # Initiate logging
-from log_config import get_logger
+try:
+    # Imported through the package everywhere, so logging is only configured by one copy of log_config
+    from library.log_config import get_logger
+except ImportError:
+    # (unless this folder isn't the `library` package, e.g. when it's used under another name)
+    from log_config import get_logger
 
 log = get_logger(__name__)
 
 # Load environmental file
 load_dotenv()
 LASTPASS_USERNAME = os.environ.get("LASTPASS_USERNAME")
+# How long credentials fetched from LastPass are reused in this process (0 = always fetch them)
+LASTPASS_CACHE_SECONDS = float(os.environ.get("LASTPASS_CACHE_SECONDS", 15 * 60))
+
+# Credentials fetched from LastPass, by entry: (time fetched, fields). Only ever kept in memory.
+_lpass_cache = {}
+_lpass_cache_lock = threading.Lock()
 
 
 @dataclass
 class LastpassManager:
-    """Class for creating a database engine with Lastpass."""
+    """Class for creating a database engine with Lastpass.
+
+    All of the entry's credentials are fetched with a single `lpass show --json` call. They are kept in memory for
+    `cache_seconds` (0 = don't cache), so other managers for the same entry don't have to call lpass again.
+    """
 
     lpass_entry: str
     driver: str = "psycopg2"
     dialect: str = "postgresql"
+    cache_seconds: float = LASTPASS_CACHE_SECONDS
 
     def __post_init__(self) -> None:
-        self._authenticate()
+        fields = self._cached_fields()
+        if fields is None:
+            self._authenticate()
 
         try:
-            self.db_type = self._lpass_cred("--field Type")
-            self.database = self._lpass_cred("--field Database")
-            self.user = self._lpass_cred("--username")
-            self.password = self._lpass_cred("--password")
-            self.host = self._lpass_cred("--field Hostname")
-            self.port = self._lpass_cred("--field Port")
+            if fields is None:
+                fields = self._lpass_fields()
+                self._cache_fields(fields)
+
+            self.db_type = fields["Type"]
+            self.database = fields["Database"]
+            self.user = fields["Username"]
+            self.password = fields["Password"]
+            self.host = fields["Hostname"]
+            self.port = fields["Port"]
 
             if self.driver is not None:
                 self.engine_str = f"{self.dialect}+{self.driver}://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
             else:
                 self.engine_str = f"{self.dialect}://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
-        except:
+        except (subprocess.CalledProcessError, IndexError, KeyError):
+            # `lpass show` fails for an unknown entry, and an entry without the database fields isn't usable either.
+            # Anything else (e.g. lpass output that isn't JSON) is a real error, and is raised as is.
             log.warning(f"'{self.lpass_entry}' Last Pass entry does not exist.")
             raise AssertionError
 
@@ -60,18 +91,45 @@ class LastpassManager:
             lpass_login = LASTPASS_USERNAME
             bash_cmd(f"lpass login {lpass_login}")
 
-    def _lpass_cred(self, args: str) -> str:
-        """Fetch a single credential from the lastpass CLI.
-
-        Args:
-            entry (str): Lastpass entry to request.
-            args (str): Flags to pass to the CLI.
+    def _lpass_fields(self) -> dict:
+        """Fetch all of the entry's credentials from the lastpass CLI in one call.
 
         Returns:
-            str: Requested Lastpass credential.
+            dict: Field name -> value (including "Username" and "Password").
         """
-        result = bash_cmd(f"lpass show '{self.lpass_entry}' {args}")
-        return result
+        entries = json.loads(bash_cmd(f"lpass show --json '{self.lpass_entry}'"))
+        entry = entries[0]
+
+        # Depending on the lpass version, custom fields are either listed in "fields" or only kept in the note
+        # (as "Name:value" lines, e.g. "Hostname:...")
+        fields = {}
+        for line in (entry.get("note") or "").splitlines():
+            name, separator, value = line.partition(":")
+            if separator:
+                fields[name] = value
+        for field in entry.get("fields", []):
+            fields[field["name"]] = field["value"]
+        if entry.get("username"):
+            fields["Username"] = entry["username"]
+        if entry.get("password"):
+            fields["Password"] = entry["password"]
+
+        return fields
+
+    def _cached_fields(self) -> dict:
+        """Returns the entry's credentials if they were fetched less than `cache_seconds` ago"""
+        with _lpass_cache_lock:
+            cached = _lpass_cache.get(self.lpass_entry)
+        if cached is None or time.monotonic() - cached[0] > self.cache_seconds:
+            return None
+
+        log.info(f"Using the cached credentials for '{self.lpass_entry}'")
+        return cached[1]
+
+    def _cache_fields(self, fields: dict) -> None:
+        if self.cache_seconds > 0:
+            with _lpass_cache_lock:
+                _lpass_cache[self.lpass_entry] = (time.monotonic(), fields)
 
     def create_psycopg2_connection(
         self,
@@ -95,6 +153,29 @@ class LastpassManager:
             password=self.password,
         )
 
+    def create_psycopg2_connection_pool(
+        self, max_connections: int
+    ) -> psycopg2.pool.ThreadedConnectionPool:
+        """Build a thread-safe pool of database connections with credentials from Lastpass.
+
+        Args:
+            max_connections (int): Maximum number of connections the pool will open.
+
+        Returns:
+            Database connection pool.
+
+        """
+
+        return psycopg2.pool.ThreadedConnectionPool(
+            1,
+            max_connections,
+            host=self.host,
+            database=self.database,
+            port=int(self.port),
+            user=self.user.lower(),
+            password=self.password,
+        )
+
     def create_sqlalchemy_connection(
         self,
     ) -> Connection:
@@ -108,29 +189,105 @@ class LastpassManager:
             Database connection.
 
         """
+        # SQLAlchemy is only needed if a SQLAlchemy connection is requested
+        import sqlalchemy
 
         return sqlalchemy.create_engine(self.engine_str).connect()
 
 
-def connect_to_aws_service(aws_account_id: str, aws_role_name: str, service="s3"):
-    log.info(f"Fetching boto3 client...")
+@dataclass
+class AwsSessionManager:
+    """Class for reusing the temporary credentials of an assumed AWS role.
 
-    role = f"arn:aws:iam::{aws_account_id}:role/{aws_role_name}"
+    The role is only assumed once, and botocore refreshes the credentials on its own when they get close to expiring
+    (with its default refresh windows), so sessions (and the clients/resources made from them) can be kept around.
+    """
 
-    sts = boto3.client(service_name="sts")
+    aws_account_id: str
+    aws_role_name: str
+    role_session_name: str = "AssumeRoleSession1"
+
+    def __post_init__(self) -> None:
+        # boto3 is only needed once a role is assumed
+        import boto3
+        from botocore.session import get_session as get_botocore_session
+
+        self.role = f"arn:aws:iam::{self.aws_account_id}:role/{self.aws_role_name}"
+        self._sts = boto3.client(service_name="sts")
+
+        # The assumed role's credentials come before every other source of credentials (e.g. environment variables)
+        botocore_session = get_botocore_session()
+        botocore_session.get_component("credential_provider").insert_before(
+            "env", _assumed_role_credential_provider(self._assume_role)
+        )
+        self.session = boto3.Session(botocore_session=botocore_session)
+
+        # Assume the role now, so a role that can't be assumed fails here rather than on first use
+        self.session.get_credentials()
+
+    def _assume_role(self) -> dict:
+        """Assume the role, and return its credentials in the format botocore expects"""
+        log.info(f"Assuming AWS Role: {self.role}")
+        assumed_role = self._sts.assume_role(
+            RoleArn=self.role, RoleSessionName=self.role_session_name
+        )
+        log.info(f"Role assumption complete...")
+
+        credentials = assumed_role["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    def resource(self, service: str = "s3"):
+        return self.session.resource(service)
+
+    def client(self, service: str = "s3"):
+        return self.session.client(service)
 
-    log.info(f"Assuming AWS Role: {role}")
-    assumed_role = sts.assume_role(RoleArn=role, RoleSessionName="AssumeRoleSession1")
-    log.info(f"Role assumption complete...")
 
-    credentials = assumed_role["Credentials"]
+def _assumed_role_credential_provider(assume_role):
+    """Returns a botocore credential provider whose credentials come from `assume_role`, and are refreshed with it"""
+    from botocore.credentials import CredentialProvider, RefreshableCredentials
+
+    class AssumedRoleCredentialProvider(CredentialProvider):
+        METHOD = "sts-assume-role"
+
+        def load(self) -> RefreshableCredentials:
+            return RefreshableCredentials.create_from_metadata(
+                metadata=assume_role(),
+                refresh_using=assume_role,
+                method=self.METHOD,
+            )
+
+    return AssumedRoleCredentialProvider()
+
+
+# One session manager per role, shared by every call to connect_to_aws_service
+_aws_session_managers = {}
+_aws_session_managers_lock = threading.Lock()
+
+
+def get_aws_session_manager(
+    aws_account_id: str, aws_role_name: str
+) -> AwsSessionManager:
+    """Returns the session manager for a role, creating it (and assuming the role) the first time"""
+    with _aws_session_managers_lock:
+        key = (aws_account_id, aws_role_name)
+        if key not in _aws_session_managers:
+            _aws_session_managers[key] = AwsSessionManager(
+                aws_account_id, aws_role_name
+            )
+        return _aws_session_managers[key]
+
+
+def connect_to_aws_service(aws_account_id: str, aws_role_name: str, service="s3"):
+    log.info(f"Fetching boto3 client...")
 
-    # Use the temporary credentials that AssumeRole returns to make a connection to Amazon S3
-    s3_resource = boto3.resource(
-        service,
-        aws_access_key_id=credentials["AccessKeyId"],
-        aws_secret_access_key=credentials["SecretAccessKey"],
-        aws_session_token=credentials["SessionToken"],
-    )
+    # The role is only assumed the first time, after that its cached (and auto-refreshed) credentials are reused
+    session_manager = get_aws_session_manager(aws_account_id, aws_role_name)
+    s3_resource = session_manager.resource(service)
     log.info("Connected to s3...")
     return s3_resource
@@ -1,27 +1,75 @@
 from __future__ import annotations
 import os
 import sys
+import io
+import re
+import json
+import time
+import uuid
+import tempfile
+from contextlib import contextmanager
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(dir_path)
 
+import numpy as np
 import pandas as pd
 from pandas import DataFrame as DF
-from multiprocessing.connection import Connection
+from typing import Iterable, Iterator
 from psycopg2.sql import SQL
+from psycopg2.extensions import connection as Connection, encodings
+from psycopg2.pool import ThreadedConnectionPool
 from connection_utils import LastpassManager
+from cache_utils import MetadataCache
+
+try:
+    # Imported through the package everywhere, so there is only ever one RUN_METRICS collecting a run's timings
+    from library.metrics_utils import timer, count
+except ImportError:
+    # (unless this folder isn't the `library` package, e.g. when it's used under another name)
+    from metrics_utils import timer, count
 from queries_as_functions import (
     row_count_query,
     tables_in_schema_query,
     columns_dtypes_of_table_query,
     generic_sql_query,
+    copy_to_stdout_query,
+    result_columns_query,
+    create_table_query,
+    drop_table_query,
+    copy_from_stdin_query,
+    DEFAULT_SAMPLE_PERCENTAGE,
+    COPY_NULL_MARKER,
+    COPY_TEXT_PREFIX,
 )
 
 # Initiate logging
-from log_config import get_logger
+try:
+    # Imported through the package everywhere, so logging is only configured by one copy of log_config
+    from library.log_config import get_logger
+except ImportError:
+    # (unless this folder isn't the `library` package, e.g. when it's used under another name)
+    from log_config import get_logger
 
 log = get_logger(__name__)
 
+# When sampling for a limited number of rows, sample this many times the limit (the sample size varies, and LIMIT caps it)
+SAMPLE_OVERSAMPLING = 2
+# Number of rows pulled from a server-side cursor at a time when streaming results
+DEFAULT_ITERSIZE = 10000
+# Size of a COPY stream kept in memory before it spills to a temporary file
+COPY_BUFFER_MAX_MEMORY = 64 * 1024 * 1024
+# COPY sends every value as text. Columns of these types (by type OID) are converted back, the rest are kept as text.
+INT_TYPE_CODES = {20, 21, 23, 26}
+FLOAT_TYPE_CODES = {700, 701}
+BOOL_TYPE_CODES = {16}
+JSON_TYPE_CODES = {114, 3802}
+# text, varchar, bpchar and name
+TEXT_TYPE_CODES = {25, 1043, 1042, 19}
+# Data types (as returned by columns_dtypes_of_table_query) that need their values converted before a COPY load
+INT_DTYPES = {"int2", "int4", "int8"}
+JSON_DTYPES = {"json", "jsonb"}
+
 
 def results_to_df(conn: Connection, query_func: SQL) -> DF:
     """Returns a dataframe from SQL query results"""
@@ -46,6 +94,29 @@ def connect_to_db_with_psycopg2(lpass_manager: LastpassManager) -> Connection:
     return conn
 
 
+def connect_to_db_with_psycopg2_pool(
+    lpass_manager: LastpassManager, max_connections: int
+) -> ThreadedConnectionPool:
+    connection_pool = lpass_manager.create_psycopg2_connection_pool(max_connections)
+
+    log.info(
+        f"Created a pool of up to {max_connections} connections to {lpass_manager.database}"
+    )
+
+    return connection_pool
+
+
+@contextmanager
+def pooled_connection(connection_pool: ThreadedConnectionPool) -> Iterator[Connection]:
+    """Borrow a connection from the pool (with autocommit on), and return it to the pool when done"""
+    conn = connection_pool.getconn()
+    try:
+        conn.autocommit = True
+        yield conn
+    finally:
+        connection_pool.putconn(conn)
+
+
 def connect_to_db_with_sqlalchemy(lpass_manager: LastpassManager) -> Connection:
     conn = lpass_manager.create_sqlalchemy_connection()
     conn.autocommit = True
@@ -53,15 +124,43 @@ def connect_to_db_with_sqlalchemy(lpass_manager: LastpassManager) -> Connection:
     return conn
 
 
-def columns_from_table(schema: str, table: str, conn: Connection):
-    """Return the column names from a table"""
-    df_columns_dtypes = results_to_df(
-        conn, columns_dtypes_of_table_query(schema, table)
-    )
+def columns_from_table(
+    schema: str, table: str, conn: Connection, cache: MetadataCache = None
+):
+    """Return the column names from a table (from the metadata cache, if one is passed in and it's fresh)"""
+    cache_key = f"columns.{schema}.{table}"
+    if cache is not None:
+        df_columns_dtypes = cache.get(cache_key)
+        if df_columns_dtypes is not None:
+            return df_columns_dtypes
 
+    with timer("catalog_lookup"):
+        df_columns_dtypes = results_to_df(
+            conn, columns_dtypes_of_table_query(schema, table)
+        )
+
+    if cache is not None:
+        cache.set(cache_key, df_columns_dtypes)
     return df_columns_dtypes
 
 
+def tables_in_schema(schema: str, conn: Connection, cache: MetadataCache = None) -> DF:
+    """Return the tables and views in a schema (from the metadata cache, if one is passed in and it's fresh)"""
+    cache_key = f"tables.{schema}"
+    if cache is not None:
+        df_tables_in_schema = cache.get(cache_key)
+        if df_tables_in_schema is not None:
+            return df_tables_in_schema
+
+    with timer("catalog_lookup"):
+        df_tables_in_schema = results_to_df(conn, tables_in_schema_query(schema))
+
+    # Don't cache a missing schema, in case it gets created
+    if cache is not None and not df_tables_in_schema.empty:
+        cache.set(cache_key, df_tables_in_schema)
+    return df_tables_in_schema
+
+
 def prettify_query(ugly_query: str) -> str:
     """Format a query so it can be printed to the console"""
     query_as_list = ugly_query.split("\n")
@@ -79,13 +178,175 @@ def query_table(conn: Connection, query_func: SQL):
         query_string = prettify_query(query_func.as_string(conn))
         log.info(f"Running Query:\n\n{query_string}\n")
 
-        cur.execute(query_func)
+        with timer("query_execute"):
+            cur.execute(query_func)
         query_string = prettify_query(cur.query.decode())
-        data = cur.fetchall()
+        with timer("fetch"):
+            data = cur.fetchall()
+        count("rows", len(data), stage="fetch")
 
     return data, cur
 
 
+def query_table_in_chunks(
+    conn: Connection, query_func: SQL, itersize: int = DEFAULT_ITERSIZE
+) -> Iterator[DF]:
+    """Queries a table with a named (server-side) cursor and yields the results as dataframes of up to `itersize` rows.
+    Only one chunk is held in memory at a time. If there are no results, a single empty dataframe is yielded.
+    """
+    # Named cursors only live inside a transaction, so autocommit is turned off while streaming
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+            cur.itersize = itersize
+            query_string = prettify_query(query_func.as_string(conn))
+            log.info(f"Streaming Query:\n\n{query_string}\n")
+
+            with timer("query_execute"):
+                cur.execute(query_func)
+            first_chunk = True
+            while True:
+                with timer("fetch"):
+                    data = cur.fetchmany(itersize)
+                count("rows", len(data), stage="fetch")
+                if not data and not first_chunk:
+                    break
+
+                # Identify column names for dataframe
+                cols = [col[0] for col in cur.description]
+                yield pd.DataFrame(data=data, columns=cols)
+
+                first_chunk = False
+                if len(data) < itersize:
+                    break
+        conn.commit()
+    finally:
+        conn.rollback()
+        conn.autocommit = autocommit
+
+
+def supports_copy_query(conn: Connection) -> bool:
+    """COPY (query) TO STDOUT WITH (...) needs Postgres 9.0+ (Redshift can only UNLOAD to S3)"""
+    return conn.server_version >= 90000
+
+
+def copy_is_supported(conn: Connection) -> bool:
+    """Checks COPY can be used to pull results, and warns if it has to fall back to a regular query"""
+    if supports_copy_query(conn):
+        return True
+
+    log.warning(
+        "This database doesn't support COPY (...) TO STDOUT, falling back to a regular query"
+    )
+    return False
+
+
+def copy_query_to_buffer(conn: Connection, query_func: SQL):
+    """Runs a query as COPY (...) TO STDOUT and writes the CSV stream to a buffer (in memory, spilling to a
+    temporary file once it gets big). Returns the buffer, rewound, and the (name, type code) of each column."""
+    with conn.cursor() as cur:
+        cur.execute(result_columns_query(query_func))
+        columns = [(col[0], col[1]) for col in cur.description]
+
+        query_string = prettify_query(query_func.as_string(conn))
+        log.info(f"Copying Query:\n\n{query_string}\n")
+
+        # Text values are sent with a prefix, so they can't be mistaken for the NULL marker (see COPY_TEXT_PREFIX)
+        text_columns = [
+            name for name, type_code in columns if type_code in TEXT_TYPE_CODES
+        ]
+        copy_query = copy_to_stdout_query(
+            query_func, [name for name, _ in columns], text_columns
+        )
+
+        buffer = tempfile.SpooledTemporaryFile(max_size=COPY_BUFFER_MAX_MEMORY)
+        with timer("query_execute", method="copy"):
+            cur.copy_expert(copy_query, buffer)
+
+    count("bytes", buffer.tell(), stage="fetch")
+    buffer.seek(0)
+    return buffer, columns
+
+
+def convert_copy_types(df: DF, columns: list) -> DF:
+    """Convert the text COPY sent back to numbers, booleans and JSON, like psycopg2 does when fetching, and take the
+    prefix off text values (see copy_to_stdout_query).
+    Integer columns with NULLs become nullable integers (fetching would turn them into floats)."""
+    for name, type_code in columns:
+        if type_code in INT_TYPE_CODES:
+            has_nulls = df[name].isna().any()
+            df[name] = df[name].astype("Int64" if has_nulls else "int64")
+        elif type_code in FLOAT_TYPE_CODES:
+            df[name] = df[name].astype("float64")
+        elif type_code in BOOL_TYPE_CODES:
+            df[name] = df[name].map({"t": True, "f": False})
+        elif type_code in JSON_TYPE_CODES:
+            df[name] = df[name].map(json.loads, na_action="ignore")
+        elif type_code in TEXT_TYPE_CODES:
+            # Take off the prefix COPY sent the text with
+            df[name] = df[name].str[len(COPY_TEXT_PREFIX) :]
+
+    return df
+
+
+def read_copy_buffer(buffer, columns: list, encoding: str, chunksize: int = None):
+    """Parse a COPY CSV stream with pandas' C reader (in chunks of `chunksize` rows, if given)"""
+    return pd.read_csv(
+        buffer,
+        header=None,
+        names=[name for name, _ in columns],
+        # Keep the text as is (e.g. leading zeros), and only treat the NULL marker as missing
+        dtype=str,
+        keep_default_na=False,
+        na_values=[COPY_NULL_MARKER],
+        encoding=encoding,
+        chunksize=chunksize,
+    )
+
+
+def results_to_df_with_copy(conn: Connection, query_func: SQL) -> DF:
+    """Bulk version of results_to_df. The results are pulled with COPY (...) TO STDOUT and parsed by pandas'
+    C CSV reader, instead of being built up from Python tuples."""
+    buffer, columns = copy_query_to_buffer(conn, query_func)
+    with buffer, timer("fetch", method="copy"):
+        df = convert_copy_types(
+            read_copy_buffer(buffer, columns, encodings[conn.encoding]), columns
+        )
+    count("rows", len(df.index), stage="fetch")
+
+    return df
+
+
+def query_table_with_copy(
+    conn: Connection, query_func: SQL, itersize: int = DEFAULT_ITERSIZE
+) -> Iterator[DF]:
+    """Bulk version of query_table_in_chunks (see results_to_df_with_copy), parsed `itersize` rows at a time.
+    If there are no results, a single empty dataframe is yielded."""
+    buffer, columns = copy_query_to_buffer(conn, query_func)
+    with buffer:
+        reader = read_copy_buffer(
+            buffer, columns, encodings[conn.encoding], chunksize=itersize
+        )
+        first_chunk = True
+        while True:
+            with timer("fetch", method="copy"):
+                df_chunk = next(reader, None)
+                if df_chunk is not None:
+                    df_chunk = convert_copy_types(
+                        df_chunk.reset_index(drop=True), columns
+                    )
+            if df_chunk is None:
+                break
+
+            count("rows", len(df_chunk.index), stage="fetch")
+            yield df_chunk
+            first_chunk = False
+
+        if first_chunk:
+            yield pd.DataFrame(columns=[name for name, _ in columns])
+
+
 def check_if_schema_exists(schema, conn: Connection) -> DF:
     # Get list of tables in schema
     df_tables_in_schema = results_to_df(conn, tables_in_schema_query(schema))
@@ -102,6 +363,32 @@ def get_table_row_count(schema: str, table_name: str, conn: Connection) -> int:
     return df_count.iloc[0, 0]
 
 
+def estimate_row_count(conn: Connection, query_func: SQL) -> int:
+    """Returns the query planner's estimate of how many rows a query will return, without running it
+    (or None if the plan can't be read)"""
+    with conn.cursor() as cur:
+        cur.execute(SQL("EXPLAIN {query}").format(query=query_func))
+        query_plan = cur.fetchall()
+
+    match = re.search(r"rows=(\d+)", query_plan[0][0]) if query_plan else None
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def sample_percentage_for_limit(limit: int, row_count: int) -> float:
+    """Percentage of a table to sample in order to (most likely) get `limit` rows out of `row_count`"""
+    if not limit or not row_count:
+        return DEFAULT_SAMPLE_PERCENTAGE
+
+    return min(100, 100 * limit * SAMPLE_OVERSAMPLING / row_count)
+
+
+def supports_tablesample(conn: Connection) -> bool:
+    """TABLESAMPLE was added in Postgres 9.5 (Redshift reports itself as 8.0)"""
+    return conn.server_version >= 90500
+
+
 def check_if_table_exists(schema: str, table_name: str, df_tables_in_schema: DF) -> str:
     """Returns a table name to query based on the inputs.
     If the base name exists as a table, it will return that."""
@@ -119,21 +406,113 @@ def check_if_table_exists(schema: str, table_name: str, df_tables_in_schema: DF)
         return False
 
 
-def insert_df_to_db(df: DF, conn: Connection, table: str, if_exists: str = "fail"):
-    log.info(f"Load to '{table}' starting...")
-    result = df.to_sql(table, conn, if_exists=if_exists, index=False)
-    log.info(f"Load to '{table}' COMPLETE!!!")
-    return result
+def prepare_df_for_copy(df: DF, dtypes: dict) -> DF:
+    """Get a dataframe's values ready to be written as CSV rows for COPY ... FROM STDIN"""
+    df = df.copy()
+    for column, dtype in dtypes.items():
+        if column not in df.columns:
+            continue
+
+        # Integer columns with NULLs are fetched as floats, and "1.0" isn't a valid integer
+        if dtype in INT_DTYPES and pd.api.types.is_float_dtype(df[column]):
+            df[column] = df[column].astype("Int64")
+        # psycopg2 fetches JSON as dicts and lists, which have to be written back as JSON (not Python reprs)
+        elif dtype in JSON_DTYPES:
+            df[column] = df[column].map(
+                lambda value: value if isinstance(value, str) else json.dumps(value),
+                na_action="ignore",
+            )
+
+    return df
+
 
+def insert_df_to_db(
+    df: DF | Iterable[DF],
+    conn: Connection,
+    table: str,
+    if_exists: str = "fail",
+    schema: str = "public",
+    df_columns_dtypes: DF = None,
+) -> int:
+    """Bulk loads a dataframe (or an iterable of dataframe chunks) into schema.table with COPY ... FROM STDIN.
+    Everything happens in a single transaction, so a failed load leaves the database as it was.
+    if_exists can be "fail", "replace" (drop and recreate the table) or "append".
+    New tables are created with the columns and data types in df_columns_dtypes (i.e. columns_from_table of the
+    source table), with integers widened to int8 (see create_table_query). Returns the number of rows loaded."""
+    assert if_exists in (
+        "fail",
+        "replace",
+        "append",
+    ), f"Unexpected value for if_exists: {if_exists}"
+    if not supports_copy_query(conn):
+        raise ValueError("This database doesn't support COPY ... FROM STDIN")
+
+    table_exists = (tables_in_schema(schema, conn)["table_name"] == table).any()
+    if table_exists and if_exists == "fail":
+        raise ValueError(f"'{table}' already exists in the '{schema}' schema")
+
+    create_table = not table_exists or if_exists == "replace"
+    if create_table and df_columns_dtypes is None:
+        raise ValueError(f"The column data types are needed to create '{table}'")
+
+    dtypes = {}
+    if df_columns_dtypes is not None:
+        dtypes = dict(zip(df_columns_dtypes["column_name"], df_columns_dtypes["dtype"]))
+    df_chunks = [df] if isinstance(df, DF) else df
+
+    log.info(f"Load to '{schema}.{table}' starting...")
+    start_time = time.perf_counter()
+    num_rows = 0
+
+    # The whole load is one transaction, so autocommit is turned off until it's done
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            if table_exists and if_exists == "replace":
+                cur.execute(drop_table_query(schema, table))
+            if create_table:
+                cur.execute(create_table_query(schema, table, df_columns_dtypes))
+
+            for df_chunk in df_chunks:
+                if df_chunk.empty:
+                    continue
+
+                buffer = io.StringIO()
+                prepare_df_for_copy(df_chunk, dtypes).to_csv(
+                    buffer, header=False, index=False, na_rep=COPY_NULL_MARKER
+                )
+                buffer.seek(0)
+                cur.copy_expert(
+                    copy_from_stdin_query(schema, table, list(df_chunk.columns)),
+                    buffer,
+                )
 
-def find_table_to_query(schema, base_table_name: str, conn: Connection) -> str:
+                num_rows += len(df_chunk.index)
+                log.info(f"Loaded {num_rows} rows so far")
+        conn.commit()
+    finally:
+        conn.rollback()
+        conn.autocommit = autocommit
+
+    elapsed = time.perf_counter() - start_time
+    log.info(
+        f"Load to '{schema}.{table}' COMPLETE!!! {num_rows} rows in {elapsed:.1f}s "
+        f"({num_rows / max(elapsed, 1e-9):,.0f} rows/sec)"
+    )
+    return num_rows
+
+
+def find_table_to_query(
+    schema, base_table_name: str, conn: Connection, cache: MetadataCache = None
+) -> str:
     """Returns a table name to query based on the inputs.
     If the base name exists as a table, it will return that.
     If there are multiple, dated tables with the base name,
     it will return the most recent table created"""
 
     # Get list of tables in schema
-    df_tables_in_schema = results_to_df(conn, tables_in_schema_query(schema))
+    df_tables_in_schema = tables_in_schema(schema, conn, cache)
 
     if df_tables_in_schema.empty:
         raise ValueError(f"Could not find the schema '{schema}'")
@@ -176,18 +555,33 @@ def query_into_df(
     clause: str = None,
     limit: int = False,
     random: bool = False,
+    sampling: str = "random",
+    sample_percentage: float = DEFAULT_SAMPLE_PERCENTAGE,
+    sample_key: str = None,
+    use_copy: bool = False,
 ) -> DF:
     """
     Basic function to query BEDAP and return all columns.
-    You can specify a LIMIT and if you want pseudo-random results.
+    You can specify a LIMIT and if you want pseudo-random results (and how to sample them, see generic_sql_query).
     You only enter the schema and basename of the table (e.g. "beneficiaries" for "beneficiaries_YYYYMMDD")
     and it will query the most up-to-date table.
+    If use_copy is True, the results are pulled in bulk with COPY (where the database supports it).
     """
+    use_copy = use_copy and copy_is_supported(conn)
 
     # Query table and return df
-    df_query_results = results_to_df(
+    df_query_results = (results_to_df_with_copy if use_copy else results_to_df)(
         conn,
-        generic_sql_query(schema, table, clause, limit=limit, random=random),
+        generic_sql_query(
+            schema,
+            table,
+            clause,
+            limit=limit,
+            random=random,
+            sampling=sampling,
+            sample_percentage=sample_percentage,
+            sample_key=sample_key,
+        ),
     )
 
     num_results = len(df_query_results.index)
@@ -201,4 +595,137 @@ def query_into_df(
         else:
             log.info(f"Results:\n{df_query_results}")
 
+    if random and sampling != "random" and limit and num_results < limit:
+        log.warning(
+            f"The {sampling} sample returned fewer rows than the limit ({num_results} < {limit}). "
+            "Try the `random` sampling strategy if you need the full limit."
+        )
+
     return df_query_results
+
+
+def query_into_df_chunks(
+    schema: str,
+    table: str,
+    conn: Connection,
+    clause: str = None,
+    limit: int = False,
+    random: bool = False,
+    sampling: str = "random",
+    sample_percentage: float = DEFAULT_SAMPLE_PERCENTAGE,
+    sample_key: str = None,
+    itersize: int = DEFAULT_ITERSIZE,
+    use_copy: bool = False,
+) -> Iterator[DF]:
+    """
+    Streaming version of query_into_df.
+    Yields the results in dataframes of up to `itersize` rows, so large (or unlimited) queries don't have to fit in memory.
+    """
+    use_copy = use_copy and copy_is_supported(conn)
+
+    num_results = 0
+    for df_chunk in (query_table_with_copy if use_copy else query_table_in_chunks)(
+        conn,
+        generic_sql_query(
+            schema,
+            table,
+            clause,
+            limit=limit,
+            random=random,
+            sampling=sampling,
+            sample_percentage=sample_percentage,
+            sample_key=sample_key,
+        ),
+        itersize=itersize,
+    ):
+        if num_results == 0 and not df_chunk.empty:
+            log.info(f"Preview of first 10 rows:\n{df_chunk.head(10)}")
+
+        num_results += len(df_chunk.index)
+        log.info(f"Fetched {len(df_chunk.index)} rows ({num_results} so far)")
+
+        yield df_chunk
+
+    if num_results == 0:
+        log.info("The query did not return any results")
+    else:
+        log.info(f"Query returned {num_results} results")
+
+    if random and sampling != "random" and limit and num_results < limit:
+        log.warning(
+            f"The {sampling} sample returned fewer rows than the limit ({num_results} < {limit}). "
+            "Try the `random` sampling strategy if you need the full limit."
+        )
+
+
+def query_into_df_pages(
+    schema: str,
+    table: str,
+    conn: Connection,
+    keyset_columns: list,
+    clause: str = None,
+    limit: int = False,
+    random: bool = False,
+    sampling: str = "random",
+    sample_percentage: float = DEFAULT_SAMPLE_PERCENTAGE,
+    sample_key: str = None,
+    after_key: list = None,
+    page_size: int = DEFAULT_ITERSIZE,
+    use_copy: bool = False,
+) -> Iterator[tuple[DF, list]]:
+    """
+    Paginated version of query_into_df_chunks, for extractions that can be picked up where they left off.
+    Every page is its own query, ordered by the keyset columns (e.g. the profile's unique fields), that starts after
+    the last key of the previous page (`WHERE key > last_key ORDER BY key LIMIT page_size`). Pass in `after_key` to
+    start after a page that was already read, and `limit` for the rows still to be read.
+    Yields each page with its last key. Rows with a NULL in the keyset columns are never returned.
+    """
+    use_copy = use_copy and copy_is_supported(conn)
+
+    num_results = 0
+    while not limit or num_results < limit:
+        df_page = (results_to_df_with_copy if use_copy else results_to_df)(
+            conn,
+            generic_sql_query(
+                schema,
+                table,
+                clause,
+                limit=min(page_size, limit - num_results) if limit else page_size,
+                random=random,
+                sampling=sampling,
+                sample_percentage=sample_percentage,
+                sample_key=sample_key,
+                keyset_columns=keyset_columns,
+                after_key=after_key,
+            ),
+        )
+        if df_page.empty:
+            break
+
+        # Each column is read on its own, since a whole row would be cast to one dtype (e.g. ints next to a float
+        # column would become floats, and lose precision past 2**53)
+        after_key = [
+            json_safe_key_value(df_page[column].iloc[-1]) for column in keyset_columns
+        ]
+        num_results += len(df_page.index)
+        log.info(f"Fetched {len(df_page.index)} rows ({num_results} so far)")
+
+        yield df_page, after_key
+
+        if len(df_page.index) < page_size:
+            break
+
+    log.info(f"Query returned {num_results} results")
+
+
+def json_safe_key_value(value):
+    """Keeps ints, floats and strings as they are, and turns anything else (dates, decimals, ...) into a string,
+    so it can be saved in a checkpoint file and sent back to the database as a literal"""
+    if value is None or pd.isna(value):
+        # The pages leave out rows with NULL keys, so this would mean the page can't be picked up after
+        raise ValueError("Keyset values can't be NULL")
+    if isinstance(value, (np.bool_, np.integer, np.floating)):
+        value = value.item()
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
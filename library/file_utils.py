@@ -1,7 +1,12 @@
 from __future__ import annotations
 import os
 import sys
+import io
+import ast
+import gzip
+import json
 import pandas as pd
+from dataclasses import dataclass
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(dir_path)
@@ -10,7 +15,19 @@ import os
 from pandas import DataFrame as DF
 
 # Initiate logging
-from log_config import get_logger
+try:
+    # Imported through the package everywhere, so logging is only configured by one copy of log_config
+    from library.log_config import get_logger
+except ImportError:
+    # (unless this folder isn't the `library` package, e.g. when it's used under another name)
+    from log_config import get_logger
+
+try:
+    # Imported through the package everywhere, so there is only ever one RUN_METRICS collecting a run's timings
+    from library.metrics_utils import timer, count
+except ImportError:
+    # (unless this folder isn't the `library` package, e.g. when it's used under another name)
+    from metrics_utils import timer, count
 
 log = get_logger(__name__)
 
@@ -23,6 +40,373 @@ def results_to_csv(df: DF, csv_name: str, results_folder: str = "./results/") ->
     df.to_csv(file, index=False)
 
 
+@dataclass
+class CsvResultsWriter:
+    """Writes results to a csv one dataframe (chunk) at a time.
+
+    The header is only written once, and the rows can be compressed on the fly ("gzip" or "zstd").
+    By default the compression is inferred from the file name (.gz or .zst).
+    Everything is written to a temp file in the results folder, which is synced to disk and renamed
+    to `csv_name` on close(). If the writer is used as a context manager and an error occurs, the temp file is removed.
+    Instead of a local file, the rows can be written to `output_file`, a binary file-like object with an abort() method
+    (e.g. an S3MultipartUpload), which is closed on close() and aborted on errors.
+    """
+
+    csv_name: str
+    results_folder: str = "./results/"
+    compression: str = "infer"
+    output_file: object = None
+
+    def __post_init__(self) -> None:
+        if self.compression == "infer":
+            self.compression = compression_from_file_name(self.csv_name)
+
+        self.rows_written = 0
+        self._header_written = False
+
+        if self.output_file is None:
+            self.results_folder = ensure_file_slash(self.results_folder)
+            make_dir_if_not_exists(self.results_folder)
+            self.file_path = self.results_folder + self.csv_name
+            self.temp_file_path = self.results_folder + "." + self.csv_name + ".tmp"
+            self._raw_file = open(self.temp_file_path, "wb")
+        else:
+            self.file_path = self.output_file.name
+            self._raw_file = self.output_file
+
+        if self.compression is None:
+            stream = self._raw_file
+        elif self.compression == "gzip":
+            stream = gzip.GzipFile(fileobj=self._raw_file, mode="wb")
+        elif self.compression == "zstd":
+            # zstandard is only needed if zstd compression is requested
+            import zstandard
+
+            stream = zstandard.ZstdCompressor().stream_writer(
+                self._raw_file, closefd=False
+            )
+        else:
+            self._discard_raw_file()
+            raise ValueError(f"Unexpected compression: {self.compression}")
+
+        self._text_file = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+
+    def write(self, df: DF) -> None:
+        """Append a dataframe to the csv (the header is written with the first dataframe)"""
+        with timer("write", format="csv"):
+            df.to_csv(self._text_file, index=False, header=not self._header_written)
+        self._header_written = True
+        self.rows_written += len(df.index)
+        count("rows", len(df.index), stage="write")
+
+    def close(self) -> None:
+        """Finish writing, sync the file to disk, and move it to its final name"""
+        self._text_file.flush()
+        stream = self._text_file.detach()
+        if stream is not self._raw_file:
+            # Closing the compressor writes its trailer, but leaves the file itself open
+            stream.close()
+        count("bytes", self._raw_file.tell(), stage="write")
+
+        if self.output_file is None:
+            self._raw_file.flush()
+            os.fsync(self._raw_file.fileno())
+            self._raw_file.close()
+            os.replace(self.temp_file_path, self.file_path)
+        else:
+            self._raw_file.close()
+        log.info(f"{self.rows_written} rows saved to `{self.file_path}`")
+
+    def abort(self) -> None:
+        """Stop writing and remove the temp file (or abort the output file)"""
+        if self.output_file is not None:
+            # Abort first, so closing the text file can't complete the output
+            self.output_file.abort()
+        try:
+            self._text_file.close()
+        except (OSError, ValueError):
+            # Anything still buffered can't be written to an aborted output
+            pass
+        self._discard_raw_file()
+
+    def _discard_raw_file(self) -> None:
+        if self.output_file is not None:
+            self.output_file.abort()
+            return
+
+        self._raw_file.close()
+        if os.path.exists(self.temp_file_path):
+            os.remove(self.temp_file_path)
+
+    def __enter__(self) -> CsvResultsWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Parquet types for the data types returned by columns_dtypes_of_table_query (anything else is stored as a string).
+# Every integer is stored as int64, since obfuscating it can push it out of its source type's range
+# (e.g. the int2 12345 can become 67890)
+PARQUET_TYPE_NAMES = {
+    "int2": "int64",
+    "int4": "int64",
+    "int8": "int64",
+    "float4": "float32",
+    "float8": "float64",
+    "bool": "bool_",
+    "date": "date32",
+}
+PARQUET_COMPRESSIONS = ("snappy", "zstd", "gzip", "none")
+
+
+@dataclass
+class ParquetResultsWriter:
+    """Writes results to a parquet file, each dataframe (chunk) as its own row group.
+
+    If `df_columns_dtypes` (the source table's columns_dtypes_of_table_query results) is passed in, every column keeps
+    its native type (integers, dates, timestamps...), no matter how it was fetched or obfuscated. Otherwise the types
+    are inferred from the first chunk. SUPER columns are stored as strings, or as structs / lists if `super_as` is
+    "struct" (when their values can't all be decoded to one struct / list type, they stay strings).
+    Like CsvResultsWriter, everything is written to a temp file that is synced and renamed to `parquet_name` on close(),
+    unless an `output_file` (e.g. an S3MultipartUpload) is passed in.
+    """
+
+    parquet_name: str
+    results_folder: str = "./results/"
+    compression: str = "snappy"
+    df_columns_dtypes: DF = None
+    super_as: str = "string"
+    output_file: object = None
+
+    def __post_init__(self) -> None:
+        # pyarrow is only needed if parquet files are written
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._pq = pq
+
+        if self.compression not in PARQUET_COMPRESSIONS:
+            raise ValueError(f"Unexpected compression: {self.compression}")
+        if self.super_as not in ("string", "struct"):
+            raise ValueError(f"Unexpected way to store super columns: {self.super_as}")
+
+        if self.output_file is None:
+            self.results_folder = ensure_file_slash(self.results_folder)
+            make_dir_if_not_exists(self.results_folder)
+            self.file_path = self.results_folder + self.parquet_name
+            self.temp_file_path = self.results_folder + "." + self.parquet_name + ".tmp"
+            self._sink = self.temp_file_path
+        else:
+            self.file_path = self.output_file.name
+            self._sink = self.output_file
+        self.rows_written = 0
+        self._writer = None
+        self._empty_df = None
+
+        self._dtypes = {}
+        self._types = {}
+        if self.df_columns_dtypes is not None:
+            self._dtypes = dict(
+                zip(
+                    self.df_columns_dtypes["column_name"],
+                    self.df_columns_dtypes["dtype"],
+                )
+            )
+            self._types = {
+                column: self._parquet_type(dtype)
+                for column, dtype in self._dtypes.items()
+            }
+
+    def write(self, df: DF) -> None:
+        """Write a dataframe as a row group (the schema is fixed by the first one)"""
+        if df.empty:
+            self._empty_df = df
+            return
+
+        with timer("write", format="parquet"):
+            table = self._to_arrow(df)
+            if self._writer is None:
+                self._writer = self._pq.ParquetWriter(
+                    self._sink, table.schema, compression=self.compression
+                )
+                # Later chunks are cast to the types of the first one
+                self._types = dict(zip(table.schema.names, table.schema.types))
+
+            self._writer.write_table(table, row_group_size=len(df.index))
+        self.rows_written += len(df.index)
+        count("rows", len(df.index), stage="write")
+
+    def close(self) -> None:
+        """Finish writing, sync the file to disk, and move it to its final name"""
+        if self._writer is None:
+            # Nothing was written, so save an empty file that still has the columns
+            empty_df = self._empty_df if self._empty_df is not None else DF()
+            self._writer = self._pq.ParquetWriter(
+                self._sink,
+                self._to_arrow(empty_df).schema,
+                compression=self.compression,
+            )
+        self._writer.close()
+
+        if self.output_file is None:
+            count("bytes", os.path.getsize(self.temp_file_path), stage="write")
+            with open(self.temp_file_path, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(self.temp_file_path, self.file_path)
+        else:
+            count("bytes", self.output_file.tell(), stage="write")
+            self.output_file.close()
+        log.info(f"{self.rows_written} rows saved to `{self.file_path}`")
+
+    def abort(self) -> None:
+        """Stop writing and remove the temp file (or abort the output file)"""
+        if self.output_file is not None:
+            self.output_file.abort()
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except (OSError, ValueError):
+                # The footer can't be written to an aborted output
+                pass
+        if self.output_file is None and os.path.exists(self.temp_file_path):
+            os.remove(self.temp_file_path)
+
+    def __enter__(self) -> ParquetResultsWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _parquet_type(self, dtype: str):
+        pa = self._pa
+        if dtype in PARQUET_TYPE_NAMES:
+            return getattr(pa, PARQUET_TYPE_NAMES[dtype])()
+        elif dtype == "timestamp":
+            return pa.timestamp("us")
+        elif dtype == "timestamptz":
+            return pa.timestamp("us", tz="UTC")
+        elif dtype == "super" and self.super_as == "struct":
+            # The struct / list type is inferred from the first chunk
+            return None
+        else:
+            return pa.string()
+
+    def _to_arrow(self, df: DF):
+        """Convert a dataframe to an arrow table with the column types of the file"""
+        pa = self._pa
+        arrays = []
+        for column in df.columns:
+            values = df[column]
+            dtype = self._dtypes.get(column)
+            parquet_type = self._types.get(column)
+
+            if dtype == "super" and self.super_as == "struct":
+                arrays.append(self._super_to_arrow(column, values, parquet_type))
+            elif parquet_type is None:
+                arrays.append(pa.array(values, from_pandas=True))
+            elif pa.types.is_string(parquet_type):
+                arrays.append(
+                    pa.array(
+                        values.map(self._to_text(dtype), na_action="ignore"),
+                        type=parquet_type,
+                        from_pandas=True,
+                    )
+                )
+            else:
+                arrays.append(pa.array(values, from_pandas=True).cast(parquet_type))
+
+        return pa.Table.from_arrays(arrays, names=[str(c) for c in df.columns])
+
+    def _super_to_arrow(self, column: str, values, parquet_type):
+        """Decode a super column into structs / lists (or keep it as strings if it can't be)"""
+        pa = self._pa
+        if parquet_type is not None and pa.types.is_string(parquet_type):
+            return pa.array(values.map(str, na_action="ignore"), type=parquet_type)
+
+        decoded = [decode_super(value) for value in values]
+        if parquet_type is not None:
+            return pa.array(decoded, type=parquet_type, from_pandas=True)
+
+        try:
+            array = pa.array(decoded, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            array = None
+        if array is None or not (
+            pa.types.is_struct(array.type) or pa.types.is_list(array.type)
+        ):
+            log.warning(
+                f"`{column}` can't be stored as a struct or list, storing it as a string"
+            )
+            return pa.array(values.map(str, na_action="ignore"), type=pa.string())
+
+        return array
+
+    @staticmethod
+    def _to_text(dtype: str):
+        # psycopg2 fetches JSON as dicts and lists, which are stored as JSON text (not Python reprs)
+        if dtype in ("json", "jsonb"):
+            return lambda value: value if isinstance(value, str) else json.dumps(value)
+        return str
+
+
+def decode_super(value):
+    """Decode a super value (JSON, or a Python literal) into dicts and lists"""
+    if not isinstance(value, str):
+        # NaN (i.e. NULL) is the only value that isn't equal to itself
+        return None if value != value else value
+
+    try:
+        return json.loads(value)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def open_results_writer(
+    file_name: str,
+    results_folder: str = "./results/",
+    df_columns_dtypes: DF = None,
+    parquet_compression: str = "snappy",
+    super_as: str = "string",
+    output_file=None,
+):
+    """Returns a ParquetResultsWriter for .parquet files, and a CsvResultsWriter for anything else"""
+    if file_name.endswith(".parquet"):
+        return ParquetResultsWriter(
+            file_name,
+            results_folder=results_folder,
+            compression=parquet_compression,
+            df_columns_dtypes=df_columns_dtypes,
+            super_as=super_as,
+            output_file=output_file,
+        )
+
+    return CsvResultsWriter(
+        file_name, results_folder=results_folder, output_file=output_file
+    )
+
+
+def compression_from_file_name(file_name: str) -> str:
+    """Determine the compression to use from a file's suffix"""
+    if file_name.endswith(".gz"):
+        return "gzip"
+    elif file_name.endswith(".zst"):
+        return "zstd"
+    else:
+        return None
+
+
 def check_if_file_exists(directory, filename):
     """Check if path and file exist"""
     directory = ensure_file_slash(directory)
@@ -35,8 +35,23 @@ LOGGING_CONFIG = {
 }
 
 
-def get_logger(name: str, log_file: str = None) -> logging.Logger:
+# Set once LOGGING_CONFIG has been applied
+_logging_configured = False
+
+
+def configure_logging() -> None:
+    """Applies LOGGING_CONFIG, once per process.
+    (Import this module as `library.log_config`, so there is only one copy of it, and of _logging_configured)"""
+    global _logging_configured
+    if _logging_configured:
+        return
+
     dictConfig(LOGGING_CONFIG)
+    _logging_configured = True
+
+
+def get_logger(name: str, log_file: str = None) -> logging.Logger:
+    configure_logging()
     log = logging.getLogger(name)
 
     return log
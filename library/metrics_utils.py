@@ -0,0 +1,146 @@
+from __future__ import annotations
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+# Note: modules in this folder are imported both as `library.x` and `x`. Import this one as `library.metrics_utils`
+# (falling back to `metrics_utils` if there is no `library` package), so there is only ever one RUN_METRICS
+# collecting the timings of a run.
+
+
+@dataclass
+class RunMetrics:
+    """Timings and counters collected over a run, e.g. how long each stage took and how many rows went through it.
+
+    Timers add up the seconds and number of calls of a stage (like "query_execute" or "obfuscate_column"),
+    and counters add up values (like rows or bytes). Both can have labels (e.g. column="birth_date"), and are safe to
+    update from several threads. Work done in other processes (e.g. obfuscation shards) is not counted.
+    """
+
+    prefix: str = "obfuscation"
+
+    def __post_init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget everything collected so far"""
+        with self._lock:
+            self._timers = {}
+            self._counters = {}
+            self.started = time.time()
+
+    @contextmanager
+    def timer(self, stage: str, **labels) -> Iterator[None]:
+        """Time the code run inside the `with` block as part of a stage"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            key = (stage, tuple(sorted(labels.items())))
+            with self._lock:
+                total_seconds, calls = self._timers.get(key, (0.0, 0))
+                self._timers[key] = (total_seconds + seconds, calls + 1)
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        """Add to a counter (e.g. count("rows", 500, stage="fetch"))"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def report(self) -> dict:
+        """Everything collected so far, as a JSON-friendly dictionary"""
+        with self._lock:
+            timers = sorted(self._timers.items())
+            counters = sorted(self._counters.items())
+
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_seconds": round(time.time() - self.started, 3),
+            "timers": [
+                {
+                    "stage": stage,
+                    **dict(labels),
+                    "seconds": round(seconds, 6),
+                    "calls": calls,
+                }
+                for (stage, labels), (seconds, calls) in timers
+            ],
+            "counters": [
+                {"name": name, **dict(labels), "value": value}
+                for (name, labels), value in counters
+            ],
+        }
+
+    def write_json_report(self, path: str, extra: dict = None) -> None:
+        """Save the report (with anything in `extra`, e.g. the jobs that ran) as JSON"""
+        write_text_atomically(
+            json.dumps({**self.report(), **(extra or {})}, indent=2, default=str),
+            path,
+        )
+
+    def write_prometheus(self, path: str) -> None:
+        """Save the metrics in the Prometheus text format (e.g. for node_exporter's textfile collector)"""
+        with self._lock:
+            timers = sorted(self._timers.items())
+            counters = sorted(self._counters.items())
+
+        lines = [
+            f"# TYPE {self.prefix}_stage_seconds_total counter",
+            *(
+                f"{self.prefix}_stage_seconds_total{prometheus_labels(stage=stage, **dict(labels))} {seconds}"
+                for (stage, labels), (seconds, calls) in timers
+            ),
+            f"# TYPE {self.prefix}_stage_calls_total counter",
+            *(
+                f"{self.prefix}_stage_calls_total{prometheus_labels(stage=stage, **dict(labels))} {calls}"
+                for (stage, labels), (seconds, calls) in timers
+            ),
+        ]
+        for name in sorted({name for (name, labels), value in counters}):
+            lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+            lines.extend(
+                f"{self.prefix}_{name}_total{prometheus_labels(**dict(labels))} {value}"
+                for (counter_name, labels), value in counters
+                if counter_name == name
+            )
+
+        write_text_atomically("\n".join(lines) + "\n", path)
+
+
+def prometheus_labels(**labels) -> str:
+    """Format labels as {name="value",...} (or nothing if there are none)"""
+    if not labels:
+        return ""
+
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    return (
+        "{"
+        + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items())
+        + "}"
+    )
+
+
+def write_text_atomically(text: str, path: str) -> None:
+    """Write to a temp file and rename it, so a partially written file is never read (e.g. by a metrics scraper)"""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+# Metrics of the current run, updated by the query, obfuscation and writing functions
+RUN_METRICS = RunMetrics()
+timer = RUN_METRICS.timer
+count = RUN_METRICS.count
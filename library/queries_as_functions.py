@@ -1,8 +1,29 @@
+import re
 from psycopg2 import sql
 from psycopg2.sql import SQL
 
 # TODO: Implement Query Class!!
 
+# Ways to pull a random sample of a table:
+#   random    - WHERE RANDOM() < rate (works everywhere, but reads every row and evaluates RANDOM() on each of them)
+#   system    - TABLESAMPLE SYSTEM, samples whole pages, so only the sampled pages are read (Postgres only, fastest,
+#               but rows on the same page are sampled together)
+#   bernoulli - TABLESAMPLE BERNOULLI, samples each row on its own (Postgres only). It still reads every page, it only
+#               saves evaluating a condition on each row
+#   key_hash  - WHERE MOD(ABS(key), 10000) < threshold on an integer key, e.g. beneficiary_key. It reads every row too
+#               (an index on the key can't be used for MOD), but always samples the same keys, so runs can be repeated
+SAMPLING_STRATEGIES = ("random", "system", "bernoulli", "key_hash")
+# Percentage of the table sampled when no rate is given (i.e. RANDOM() < 0.1)
+DEFAULT_SAMPLE_PERCENTAGE = 10
+KEY_HASH_BUCKETS = 10000
+# Written in place of NULLs by COPY, so they can be told apart from empty strings
+COPY_NULL_MARKER = "\\N"
+# Put in front of text values sent by COPY TO STDOUT (and taken off once they're read). pandas can't tell a quoted
+# "\N" from an unquoted one, so without it the text "\N" would be read as NULL.
+COPY_TEXT_PREFIX = "_"
+# A profile's clause, e.g. "where birth_date > '2000-01-01'" (the condition is the first group)
+WHERE_CLAUSE_PATTERN = re.compile(r"\s*WHERE\s+(.*\S)\s*$", re.IGNORECASE | re.DOTALL)
+
 
 def tables_in_schema_query(schema: str) -> SQL:
     """Query to identify tables in the schema provided"""
@@ -30,6 +51,7 @@ def columns_dtypes_of_table_query(schema: str, table: str) -> SQL:
         SELECT c.column_name, c.udt_name as dtype
         FROM information_schema.columns c
         WHERE c.table_schema = {schema} AND c.table_name = {table}
+        ORDER BY c.ordinal_position
     """
     params = {
         "schema": sql.Literal(schema),
@@ -60,8 +82,16 @@ def generic_sql_query(
     clause: str = None,
     limit: int = False,
     random: bool = False,
+    sampling: str = "random",
+    sample_percentage: float = DEFAULT_SAMPLE_PERCENTAGE,
+    sample_key: str = None,
+    keyset_columns: list = None,
+    after_key: list = None,
 ) -> SQL:
-    """Generic SELECT query, with optional limit and pseudo-random flag"""
+    """Generic SELECT query, with optional limit and pseudo-random flag.
+    If random is True, `sampling` picks how the sample is taken (see SAMPLING_STRATEGIES).
+    If keyset_columns are given, the results are ordered by them, and only the rows after `after_key` (the values
+    of the keyset columns in the last row of the previous page) are returned (see keyset_condition)."""
     query_template = """
         SELECT *
         FROM {schema}.{table}
@@ -71,13 +101,60 @@ def generic_sql_query(
         "table": sql.Identifier(table),
     }
 
+    sample_condition = None
+    if random:
+        if sampling == "random":
+            sample_condition = "RANDOM() < {sample_rate}"
+            params["sample_rate"] = sql.Literal(sample_percentage / 100)
+        elif sampling in ("system", "bernoulli"):
+            query_template = (
+                query_template.rstrip()
+                + f" TABLESAMPLE {sampling.upper()} ({{sample_percentage}})\n"
+            )
+            params["sample_percentage"] = sql.Literal(sample_percentage)
+        elif sampling == "key_hash":
+            assert sample_key, "A key column is needed for key_hash sampling"
+            # MOD keeps the sign of the key, so ABS keeps negative keys from always being sampled
+            sample_condition = "MOD(ABS({sample_key}), {buckets}) < {threshold}"
+            params["sample_key"] = sql.Identifier(sample_key)
+            params["buckets"] = sql.Literal(KEY_HASH_BUCKETS)
+            params["threshold"] = sql.Literal(
+                max(1, round(KEY_HASH_BUCKETS * sample_percentage / 100))
+            )
+        else:
+            raise AssertionError(f"Unexpected sampling strategy: {sampling}")
+
+    if keyset_columns:
+        # Rows with a NULL key can't be paged through (NULLs don't compare), so they are left out
+        keyset_template = "{keyset_not_null}"
+        params["keyset_not_null"] = SQL(" AND ").join(
+            SQL("{} IS NOT NULL").format(sql.Identifier(column))
+            for column in keyset_columns
+        )
+        if after_key is not None:
+            keyset_template = keyset_template + " AND {keyset_condition}"
+            params["keyset_condition"] = keyset_condition(keyset_columns, after_key)
+        if sample_condition:
+            sample_condition = sample_condition + " AND " + keyset_template
+        else:
+            sample_condition = keyset_template
+        # The profile's clause is wrapped in parentheses, so an OR in it can't leak past the keyset condition
+        if clause:
+            clause = "WHERE (" + where_clause_condition(clause) + ")"
+
     if clause:
         query_template = query_template + "\n" + clause
-        if random:
-            query_template = query_template + " AND RANDOM() < 0.1"
+        if sample_condition:
+            query_template = query_template + " AND " + sample_condition
     else:
-        if random:
-            query_template = query_template + "\nWHERE RANDOM() < 0.1"
+        if sample_condition:
+            query_template = query_template + "\nWHERE " + sample_condition
+
+    if keyset_columns:
+        query_template = query_template + "\nORDER BY {keyset_columns}"
+        params["keyset_columns"] = SQL(", ").join(
+            sql.Identifier(column) for column in keyset_columns
+        )
 
     if limit:
         query_template = query_template + "\nLIMIT {limit}"
@@ -87,6 +164,144 @@ def generic_sql_query(
     return query
 
 
+def where_clause_condition(clause: str) -> str:
+    """The condition of a profile's clause, i.e. everything after its WHERE keyword"""
+    match = WHERE_CLAUSE_PATTERN.match(clause)
+    if match is None:
+        raise AssertionError(f"Expected the clause to start with WHERE: {clause}")
+
+    return match.group(1)
+
+
+def keyset_condition(keyset_columns: list, after_key: list) -> SQL:
+    """Condition for the rows that come after `after_key` when ordered by the keyset columns.
+    (a, b) > (x, y) is written out as a > x OR (a = x AND b > y), since Redshift doesn't compare row values."""
+    conditions = []
+    for i, column in enumerate(keyset_columns):
+        equal_conditions = [
+            SQL("{column} = {value}").format(
+                column=sql.Identifier(previous_column), value=sql.Literal(value)
+            )
+            for previous_column, value in zip(keyset_columns[:i], after_key)
+        ]
+        greater_condition = SQL("{column} > {value}").format(
+            column=sql.Identifier(column), value=sql.Literal(after_key[i])
+        )
+        conditions.append(
+            SQL("({})").format(
+                SQL(" AND ").join(equal_conditions + [greater_condition])
+            )
+        )
+
+    return SQL("({})").format(SQL(" OR ").join(conditions))
+
+
+def copy_to_stdout_query(
+    query: SQL, columns: list = None, text_columns: list = ()
+) -> SQL:
+    """Wraps a SELECT query in COPY ... TO STDOUT, so the results are sent back as one CSV stream.
+    The (non-NULL) values of `text_columns` are sent with COPY_TEXT_PREFIX in front of them, so a text value can't be
+    read back as the NULL marker. `columns` (every column of the results, in order) is needed to select them."""
+    if text_columns:
+        select_list = SQL(", ").join(
+            SQL("{prefix} || {column} AS {column}").format(
+                prefix=sql.Literal(COPY_TEXT_PREFIX), column=sql.Identifier(column)
+            )
+            if column in text_columns
+            else sql.Identifier(column)
+            for column in columns
+        )
+        query = SQL("SELECT {select_list} FROM ({query}) AS results").format(
+            select_list=select_list, query=query
+        )
+
+    query_template = """
+        COPY ({query}) TO STDOUT WITH (FORMAT csv, NULL {null_marker})
+        """
+    params = {"query": query, "null_marker": sql.Literal(COPY_NULL_MARKER)}
+
+    query = params_in_query_template(query_template, params)
+    return query
+
+
+def result_columns_query(query: SQL) -> SQL:
+    """Query that returns no rows, only the column names and types a SELECT query would return"""
+    query_template = """
+        SELECT *
+        FROM ({query}) AS results
+        LIMIT 0
+        """
+    params = {"query": query}
+
+    query = params_in_query_template(query_template, params)
+    return query
+
+
+def create_table_query(schema: str, table: str, df_columns_dtypes) -> SQL:
+    """Query to create a table with the columns and data types returned by columns_dtypes_of_table_query.
+    Integers are widened to int8, since obfuscating them can take them out of their type's range
+    (e.g. the int2 32767 can become 76101)."""
+    column_definitions = []
+    for column_name, dtype in zip(
+        df_columns_dtypes["column_name"], df_columns_dtypes["dtype"]
+    ):
+        assert re.fullmatch(r"_?\w+", dtype), f"Unexpected data type: {dtype}"
+        # Array types are listed with a leading underscore (e.g. _int4 = int4[])
+        if dtype.startswith("_"):
+            dtype = dtype[1:] + "[]"
+        # Redshift's super type doesn't exist in Postgres, so its values are stored as text
+        if dtype == "super":
+            dtype = "text"
+        elif dtype in ("int2", "int4"):
+            dtype = "int8"
+        column_definitions.append(
+            SQL("{column} {dtype}").format(
+                column=sql.Identifier(column_name), dtype=SQL(dtype)
+            )
+        )
+
+    query_template = """
+        CREATE TABLE {schema}.{table} ({column_definitions})
+        """
+    params = {
+        "schema": sql.Identifier(schema),
+        "table": sql.Identifier(table),
+        "column_definitions": SQL(", ").join(column_definitions),
+    }
+
+    query = params_in_query_template(query_template, params)
+    return query
+
+
+def drop_table_query(schema: str, table: str) -> SQL:
+    query_template = """
+        DROP TABLE IF EXISTS {schema}.{table}
+        """
+    params = {
+        "schema": sql.Identifier(schema),
+        "table": sql.Identifier(table),
+    }
+
+    query = params_in_query_template(query_template, params)
+    return query
+
+
+def copy_from_stdin_query(schema: str, table: str, columns: list) -> SQL:
+    """Query to load CSV rows (with COPY_NULL_MARKER for NULLs) into the given columns of a table"""
+    query_template = """
+        COPY {schema}.{table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL {null_marker})
+        """
+    params = {
+        "schema": sql.Identifier(schema),
+        "table": sql.Identifier(table),
+        "columns": SQL(", ").join(sql.Identifier(column) for column in columns),
+        "null_marker": sql.Literal(COPY_NULL_MARKER),
+    }
+
+    query = params_in_query_template(query_template, params)
+    return query
+
+
 def params_in_query_template(query_template: str, params: dict) -> SQL:
     """Insert parameters into query template"""
     return SQL(query_template).format(**params)
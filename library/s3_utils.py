@@ -1,11 +1,15 @@
+from __future__ import annotations
 import os
 import sys
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(dir_path)
 
-from botocore.exceptions import ClientError
-from boto3.resources.factory import ServiceResource
+import json
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import TYPE_CHECKING
 from file_utils import (
     ensure_file_slash,
     filename_is_blank,
@@ -13,66 +17,127 @@ from file_utils import (
     make_dir_if_not_exists,
 )
 
+if TYPE_CHECKING:
+    # Only used for type hints (boto3 takes a while to import, and is only needed once there is an s3_resource)
+    from boto3.resources.factory import ServiceResource
+
 # Initiate logging
-from log_config import get_logger
+try:
+    # Imported through the package everywhere, so logging is only configured by one copy of log_config
+    from library.log_config import get_logger
+except ImportError:
+    # (unless this folder isn't the `library` package, e.g. when it's used under another name)
+    from log_config import get_logger
 
 log = get_logger(__name__)
 
+# S3 parts must be at least 5 MiB (except the last one), and there can be at most 10,000 of them
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+# Seconds to wait before retrying a failed part (doubled after every failed attempt)
+RETRY_BACKOFF_SECONDS = 1
+# Kept in folders synced from S3, with the ETag and size of every object downloaded into them
+SYNC_MANIFEST_NAME = ".s3_sync_manifest.json"
+
+
+# Buckets already known to exist, by S3 client (so by session and endpoint), so head_bucket is only called once
+# per bucket. A bucket found with one session isn't assumed to exist (or be accessible) with another one.
+_existing_buckets = weakref.WeakKeyDictionary()
+
+
+def check_if_bucket_exists(s3_resource: ServiceResource, bucket_name: str) -> bool:
+    """Checks if an S3 bucket exists (only asking S3 the first time it's found with this resource's client)"""
+    # botocore is already loaded by the time there is an s3_resource
+    from botocore.exceptions import ClientError
+
+    existing_buckets = _existing_buckets.setdefault(s3_resource.meta.client, set())
+    if bucket_name in existing_buckets:
+        return True
+
+    try:
+        s3_resource.meta.client.head_bucket(Bucket=bucket_name)
+    except ClientError:
+        log.info(f"S3 Bucket '{bucket_name}' does not exist")
+        return False
+
+    existing_buckets.add(bucket_name)
+    return True
+
 
 def check_if_folder_exists_in_s3_bucket(
     s3_resource: ServiceResource, bucket_name: str, directory: str
 ) -> bool:
     "Checks S3 bucket to determine if a folder exists"
+    from botocore.exceptions import ClientError
 
     directory = ensure_file_slash(directory)
 
+    if not check_if_bucket_exists(s3_resource, bucket_name):
+        return False
+
     try:
-        s3_resource.meta.client.head_bucket(Bucket=bucket_name)
-        try:
-            s3_resource.Object(bucket_name=bucket_name, key=directory).load()
-            log.info(f"'{directory}' exists in S3 Bucket '{bucket_name}'")
-            return True
-        except ClientError as e:
-            log.error(f"Error = {e}")
-            log.info(f"'{directory}' does not exist in S3 Bucket '{bucket_name}'")
-            return False
-    except ClientError:
-        log.info(f"S3 Bucket '{bucket_name}' does not exist")
+        s3_resource.Object(bucket_name=bucket_name, key=directory).load()
+        log.info(f"'{directory}' exists in S3 Bucket '{bucket_name}'")
+        return True
+    except ClientError as e:
+        log.error(f"Error = {e}")
+        log.info(f"'{directory}' does not exist in S3 Bucket '{bucket_name}'")
         return False
 
 
 def check_if_file_exists_in_s3(
     s3_resource: ServiceResource, bucket_name: str, filename: str, path: str = None
 ) -> bool:
-
+    """Checks if a file exists in an S3 bucket (in the `path` folder, if given)"""
     if filename_is_blank(filename):
         return False
 
-    if path is None:
-        try:
-            s3_resource.meta.client.head_bucket(Bucket=bucket_name)
-            try:
-                s3_resource.Object(bucket_name=bucket_name, key=filename).load()
-                log.info(f"'{filename}' exists in S3 Bucket '{bucket_name}'")
-                return True
-            except ClientError:
-                log.info(f"'{filename}' does not exist in S3 Bucket '{bucket_name}'")
-                return False
-        except ClientError:
-            log.info(f"S3 Bucket '{bucket_name}' does not exist")
-            return False
-
+    key = filename if path is None else ensure_file_slash(path) + filename
+    exists = check_if_files_exist_in_s3(s3_resource, bucket_name, [key])[key]
+    if exists:
+        log.info(f"'{key}' exists in S3 Bucket '{bucket_name}'")
     else:
-        try:
-            check_if_folder_exists_in_s3_bucket(s3_resource, bucket_name, path)
-            path = ensure_file_slash(path)
-            file_path = path + filename
-            s3_resource.Object(bucket_name=bucket_name, key=file_path).load()
-            log.info(f"'{filename}' exists in directory '{path}'")
-            return True
-        except ClientError:
-            log.info(f"'{filename}' does not exist in directory '{path}'")
-            return False
+        log.info(f"'{key}' does not exist in S3 Bucket '{bucket_name}'")
+    return exists
+
+
+def check_if_files_exist_in_s3(
+    s3_resource: ServiceResource, bucket_name: str, keys: list[str]
+) -> dict[str, bool]:
+    """Checks which of many keys exist in a bucket.
+    Instead of a HEAD request per key, each prefix (folder) is listed once with a paginated list_objects_v2
+    (a prefix with a single key only lists the objects starting with that key).
+    Returns a dictionary of key -> exists (all False if the bucket doesn't exist or can't be listed)."""
+    from botocore.exceptions import ClientError
+
+    keys_by_prefix = {}
+    for key in keys:
+        prefix = key.rpartition("/")[0]
+        keys_by_prefix.setdefault(ensure_file_slash(prefix), set()).add(key)
+
+    found = set()
+    paginator = s3_resource.meta.client.get_paginator("list_objects_v2")
+    try:
+        for prefix, prefix_keys in keys_by_prefix.items():
+            if len(prefix_keys) == 1:
+                # No need to list the whole folder for one key
+                prefix = next(iter(prefix_keys))
+            # The delimiter stops the listing from going into sub-folders
+            for page in paginator.paginate(
+                Bucket=bucket_name, Prefix=prefix, Delimiter="/"
+            ):
+                for s3_object in page.get("Contents", []):
+                    if s3_object["Key"] in prefix_keys:
+                        found.add(s3_object["Key"])
+    except ClientError as e:
+        log.info(f"Could not list S3 Bucket '{bucket_name}': {e}")
+        return {key: False for key in keys}
+
+    log.info(
+        f"{len(found)} of {len(set(keys))} files exist in S3 Bucket '{bucket_name}'"
+    )
+    return {key: key in found for key in keys}
 
 
 def move_local_file_to_s3(
@@ -125,7 +190,7 @@ def pull_file_from_s3(
         else:
             s3_filepath = s3_filename
 
-        if check_if_file_exists_in_s3(s3_resource, bucket, s3_filename, s3_path):
+        if check_if_files_exist_in_s3(s3_resource, bucket, [s3_filepath])[s3_filepath]:
             if not local_filename:
                 local_filename = s3_filename
 
@@ -143,3 +208,251 @@ def pull_file_from_s3(
     except Exception as e:
         print(f"{type(e)}: {e}")
         return False
+
+
+def split_s3_uri(s3_uri: str) -> tuple[str, str]:
+    """Split s3://bucket/path/to/key into the bucket and the key"""
+    assert s3_uri.startswith("s3://"), f"Not an S3 URI: {s3_uri}"
+    bucket, _, key = s3_uri[len("s3://") :].partition("/")
+    return bucket, key
+
+
+class S3MultipartUpload:
+    """Binary file-like object that uploads everything written to it to `key` in `bucket`, without a local copy.
+
+    Writes are buffered into parts of `part_size` bytes, which are uploaded by up to `max_concurrency` threads
+    (so at most that many parts are held in memory). A part that fails is retried up to `max_retries` times.
+    Nothing is visible in S3 until close() completes the multipart upload; abort() cancels it instead.
+    If less than one part is written in total, it is uploaded with a single put_object on close().
+    """
+
+    def __init__(
+        self,
+        s3_resource: ServiceResource,
+        bucket: str,
+        key: str,
+        part_size: int = DEFAULT_PART_SIZE,
+        max_concurrency: int = 4,
+        max_retries: int = 3,
+    ) -> None:
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"S3 parts must be at least {MIN_PART_SIZE} bytes")
+
+        self.bucket = bucket
+        self.key = key
+        self.name = f"s3://{bucket}/{key}"
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.closed = False
+
+        self._client = s3_resource.meta.client
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._executor = None
+        self._part_futures = []
+
+    def writable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return False
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._submit_part(part)
+
+        return len(data)
+
+    def close(self) -> None:
+        """Upload the last part and complete the upload, which makes the object appear in S3 all at once"""
+        if self.closed:
+            return
+
+        try:
+            if self._upload_id is None:
+                self._client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer)
+                )
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._part_futures]
+                self._client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+                self._executor.shutdown()
+        except Exception:
+            self.abort()
+            raise
+
+        self.closed = True
+        self._buffer = bytearray()
+        log.info(f"Uploaded {self._position} bytes to `{self.name}`")
+
+    def abort(self) -> None:
+        """Cancel the upload, so nothing is left behind in S3"""
+        if self.closed:
+            return
+
+        self.closed = True
+        self._buffer = bytearray()
+        if self._executor is not None:
+            for future in self._part_futures:
+                future.cancel()
+            self._executor.shutdown()
+        if self._upload_id is not None:
+            self._client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+            log.info(f"Aborted the upload to `{self.name}`")
+
+    def __enter__(self) -> S3MultipartUpload:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _submit_part(self, part: bytes) -> None:
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )
+            self._upload_id = response["UploadId"]
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        part_number = len(self._part_futures) + 1
+        if part_number > MAX_PARTS:
+            raise ValueError(
+                f"`{self.name}` needs more than {MAX_PARTS} parts, use a bigger part size"
+            )
+
+        # Wait for a part to finish before holding another one in memory (and stop early if one failed)
+        pending = [future for future in self._part_futures if not future.done()]
+        while len(pending) >= self.max_concurrency:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pending = [future for future in pending if future not in done]
+        for future in self._part_futures:
+            if future.done():
+                future.result()
+
+        self._part_futures.append(
+            self._executor.submit(self._upload_part, part_number, part)
+        )
+
+    def _upload_part(self, part_number: int, part: bytes) -> dict:
+        from botocore.exceptions import ClientError, BotoCoreError
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._client.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    PartNumber=part_number,
+                    Body=part,
+                )
+                return {"PartNumber": part_number, "ETag": response["ETag"]}
+            except (ClientError, BotoCoreError) as e:
+                if attempt == self.max_retries:
+                    raise
+                log.warning(
+                    f"Part {part_number} of `{self.name}` failed ({e}), retrying..."
+                )
+                time.sleep(RETRY_BACKOFF_SECONDS * 2**attempt)
+
+
+def sync_s3_prefix_to_folder(
+    s3_resource: ServiceResource,
+    bucket: str,
+    prefix: str,
+    local_folder: str,
+    suffix: str = "",
+    max_workers: int = 8,
+) -> dict[str, str]:
+    """Mirrors the objects directly under an S3 prefix (ending in `suffix`) into a local folder.
+
+    A manifest of each object's ETag and size is kept in the folder, and objects that still match it aren't downloaded
+    again, so syncing an up-to-date folder only costs a listing. Everything else is downloaded concurrently
+    (each file is downloaded to a temp file and renamed, so a file is never half written). Files that were synced
+    before but have since been removed from S3 are removed locally. Returns the local file path of every object key.
+    """
+    prefix = ensure_file_slash(prefix)
+    local_folder = ensure_file_slash(local_folder)
+    make_dir_if_not_exists(local_folder)
+
+    manifest_path = local_folder + SYNC_MANIFEST_NAME
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    client = s3_resource.meta.client
+    s3_objects = {}
+    for page in client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, Prefix=prefix, Delimiter="/"
+    ):
+        for s3_object in page.get("Contents", []):
+            if s3_object["Key"].endswith(suffix) and s3_object["Key"] != prefix:
+                s3_objects[s3_object["Key"]] = {
+                    "etag": s3_object["ETag"],
+                    "size": s3_object["Size"],
+                }
+
+    local_paths = {key: local_folder + key[len(prefix) :] for key in s3_objects.keys()}
+    to_download = [
+        key
+        for key, s3_object in s3_objects.items()
+        if manifest.get(key) != s3_object
+        or not os.path.exists(local_paths[key])
+        or os.path.getsize(local_paths[key]) != s3_object["size"]
+    ]
+
+    def download(key: str) -> None:
+        temp_path = local_paths[key] + ".tmp"
+        client.download_file(bucket, key, temp_path)
+        os.replace(temp_path, local_paths[key])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Consume the results so any download error is raised
+        list(executor.map(download, to_download))
+
+    for key in manifest.keys() - s3_objects.keys():
+        removed_path = local_folder + key[len(prefix) :]
+        if os.path.exists(removed_path):
+            os.remove(removed_path)
+
+    temp_manifest_path = manifest_path + ".tmp"
+    with open(temp_manifest_path, "w") as f:
+        json.dump(s3_objects, f, indent=2)
+    os.replace(temp_manifest_path, manifest_path)
+
+    log.info(
+        f"Synced {len(s3_objects)} files from 's3://{bucket}/{prefix}' to '{local_folder}' "
+        f"({len(to_download)} downloaded, {len(s3_objects) - len(to_download)} already up to date)"
+    )
+    return local_paths
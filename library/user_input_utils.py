@@ -1,6 +1,6 @@
 from __future__ import annotations
 import os
-from multiprocessing.connection import Connection
+from psycopg2.extensions import connection as Connection
 from pyclbr import Function
 from pandas import DataFrame as DF
 from .connection_utils import LastpassManager
@@ -68,7 +68,8 @@ def ensure_lastpass_entry_exists(default_entry: str) -> LastpassManager:
             return lpass
         except KeyboardInterrupt:
             break
-        except:
+        except AssertionError:
+            # Only a missing entry is worth asking again for (e.g. a failed `lpass login` is raised)
             pass
 
 
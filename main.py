@@ -1,8 +1,19 @@
 from __future__ import annotations
 from library.database_utils import (
-    connect_to_db_with_psycopg2,
+    connect_to_db_with_psycopg2_pool,
+    pooled_connection,
     find_table_to_query,
-    query_into_df,
+    columns_from_table,
+    query_into_df_chunks,
+    query_into_df_pages,
+    estimate_row_count,
+    sample_percentage_for_limit,
+    supports_tablesample,
+)
+from library.queries_as_functions import (
+    generic_sql_query,
+    SAMPLING_STRATEGIES,
+    DEFAULT_SAMPLE_PERCENTAGE,
 )
 from library.user_input_utils import (
     ensure_lastpass_entry_exists,
@@ -12,14 +23,49 @@ from library.user_input_utils import (
 )
 from utils.obfuscation_utils import (
     find_fields_to_obfuscate,
+    sync_obfuscation_profiles_from_s3,
     obfuscate_dataframe,
+    ObfuscationPlan,
+)
+from utils.uniqueness_utils import UniqueKeyIndex
+from utils.checkpoint_utils import (
+    ClauseCheckpoint,
+    open_checkpoint_folder,
+    remove_checkpoint_folder,
 )
-from library.file_utils import results_to_csv
+from utils.job_utils import (
+    ObfuscationJob,
+    JobResult,
+    JobScheduler,
+    load_jobs,
+    write_summary_report,
+)
+from library.file_utils import open_results_writer, ensure_file_slash
+from library.s3_utils import S3MultipartUpload, split_s3_uri
+from library.connection_utils import connect_to_aws_service, LastpassManager
+from library.cache_utils import MetadataCache
+from library.metrics_utils import RUN_METRICS
 from library.log_config import get_logger
 from dotenv import load_dotenv
-import os
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import connection as Connection
 import pandas as pd
+import argparse
+import copy
+import multiprocessing
+import tempfile
+import os
 import math
+from dataclasses import asdict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Only used for type hints (the process pool is only started if OBFUSCATION_WORKERS > 1)
+    from concurrent.futures import ProcessPoolExecutor
+
+# Initiate logging
+log = get_logger(__name__)
 
 # Load environmental file
 load_dotenv()
@@ -27,6 +73,47 @@ BEDAP_LASTPASS_ENTRY = os.environ.get("BEDAP_LASTPASS_ENTRY")
 DEFAULT_CSV_LOCATION = os.environ.get("DEFAULT_CSV_LOCATION")
 DEFAULT_SCHEMA = os.environ.get("DEFAULT_SCHEMA")
 DEFAULT_TABLE = os.environ.get("DEFAULT_TABLE")
+# Where table lists, column types and obfuscation profiles are cached, and for how long
+METADATA_CACHE_FOLDER = os.environ.get("METADATA_CACHE_FOLDER", "./.metadata_cache/")
+METADATA_CACHE_TTL_HOURS = float(os.environ.get("METADATA_CACHE_TTL_HOURS", 1))
+# Number of rows queried, obfuscated and saved at a time
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", 50000))
+# Pull results in bulk with COPY (...) TO STDOUT instead of a cursor (Postgres only, falls back to a cursor otherwise)
+EXTRACT_WITH_COPY = os.environ.get("EXTRACT_WITH_COPY", "False").lower() == "true"
+# Default output format ("csv" or "parquet"), and how parquet files are compressed ("snappy", "zstd", "gzip" or "none")
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "csv")
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "snappy")
+# How SUPER columns are stored in parquet files ("string" or "struct")
+PARQUET_SUPER_AS = os.environ.get("PARQUET_SUPER_AS", "string")
+# Secret that each row's randomness is derived from (with its unique fields), so re-runs reproduce the same output.
+# If not set, every run draws new random values
+OBFUSCATION_SECRET = os.environ.get("OBFUSCATION_SECRET") or None
+# Extract each profile page by page, ordered by its unique fields, saving a checkpoint after every page, so a job that
+# is stopped halfway resumes where it left off. Checkpoints are kept in CHECKPOINT_FOLDER until the results are saved
+RESUMABLE_EXTRACTION = os.environ.get("RESUMABLE_EXTRACTION", "False").lower() == "true"
+CHECKPOINT_FOLDER = os.environ.get("CHECKPOINT_FOLDER", "./.checkpoints/")
+# Results saved to an s3://bucket/prefix/ location are uploaded in parts of this size, this many at a time
+S3_PART_SIZE_MB = int(os.environ.get("S3_PART_SIZE_MB", 16))
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("S3_UPLOAD_CONCURRENCY", 4))
+# Optional S3 endpoint (e.g. a local moto server for testing)
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+# Optional AWS role to assume for S3 (otherwise the default AWS credentials are used)
+AWS_ACCOUNT_ID = os.environ.get("AWS_ACCOUNT_ID")
+AWS_ROLE_NAME = os.environ.get("AWS_ROLE_NAME")
+# Optional s3://bucket/prefix/ the obfuscation profiles are synced from before they are read
+OBFUSCATION_PROFILE_S3_URI = os.environ.get("OBFUSCATION_PROFILE_S3_URI")
+# Number of unique keys kept in memory before they are spilled to disk
+MAX_UNIQUE_KEYS_IN_MEMORY = int(os.environ.get("MAX_UNIQUE_KEYS_IN_MEMORY", 1000000))
+# Maximum number of profiles (WHERE clauses) queried at the same time, each on its own connection
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 4))
+# Number of processes used to obfuscate the results (1 = obfuscate in the main process)
+OBFUSCATION_WORKERS = int(os.environ.get("OBFUSCATION_WORKERS", 1))
+# Maximum number of jobs run at the same time by --jobs, and against the same database (unless the job file says otherwise)
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 4))
+DEFAULT_JOBS_PER_DATABASE = int(os.environ.get("DEFAULT_JOBS_PER_DATABASE", 1))
+# Where the run report (how long each stage took, rows and bytes) is saved, and optionally Prometheus metrics
+METRICS_REPORT_PATH = os.environ.get("METRICS_REPORT_PATH")
+PROMETHEUS_METRICS_FILE = os.environ.get("PROMETHEUS_METRICS_FILE") or None
 
 
 def define_where_clauses(num_clauses: int) -> list[dict]:
@@ -93,7 +180,48 @@ def determine_query_limit(clause_list: list, limit: int):
     return clause_list
 
 
-def determine_file_name(table: str, random: bool, number_of_clauses: int, limit: int):
+def choose_sampling_strategy(tablesample_supported: bool) -> str:
+    """Ask how the random results should be sampled (TABLESAMPLE is only offered if the database supports it)"""
+    strategies = [
+        strategy
+        for strategy in SAMPLING_STRATEGIES
+        if tablesample_supported or strategy not in ("system", "bernoulli")
+    ]
+    while True:
+        sampling = enter_for_default(
+            f"How would you like the results sampled? ({', '.join(strategies)})",
+            "random",
+        )
+        if sampling in strategies:
+            return sampling
+        print(f"Please enter one of: {', '.join(strategies)}")
+
+
+def determine_sample_percentages(
+    clause_list: list, schema: str, table: str, conn: Connection
+):
+    """Determine the percentage of each profile to sample, from its limit and the estimated number of rows it matches"""
+    for clause_dict in clause_list:
+        row_count = estimate_row_count(
+            conn, generic_sql_query(schema, table, clause_dict["clause"])
+        )
+        clause_dict["sample_percentage"] = sample_percentage_for_limit(
+            clause_dict["limit"], row_count
+        )
+        log.info(
+            f"Sampling {clause_dict['sample_percentage']:.4g}% of ~{row_count} rows for `{clause_dict['clause']}`"
+        )
+
+    return clause_list
+
+
+def default_file_name(
+    table: str,
+    random: bool,
+    number_of_clauses: int,
+    limit: int,
+    output_format: str = "csv",
+) -> str:
     """Function to determine the default file name"""
     if random is True:
         csv_name = table + "_random_"
@@ -105,22 +233,188 @@ def determine_file_name(table: str, random: bool, number_of_clauses: int, limit:
     elif number_of_clauses > 1:
         csv_name = csv_name + str(number_of_clauses) + "clauses_"
 
-    if limit > 0:
-        csv_name = csv_name + str(limit) + "limit_obfuscated.csv"
+    if limit:
+        csv_name = csv_name + str(limit) + "limit_obfuscated." + output_format
     else:
-        csv_name = csv_name + "obfuscated.csv"
+        csv_name = csv_name + "obfuscated." + output_format
+
+    return csv_name
 
-    file_name = enter_for_default(
-        "What would you like the file to be called?", csv_name
-    )
 
-    # If the file name doesn't end in .csv, add it
-    if file_name[-4:] != ".csv":
+def ensure_results_suffix(file_name: str) -> str:
+    # If the file name doesn't end in .csv or .parquet, add it (compressed csv's can end in .csv.gz or .csv.zst)
+    if not file_name.endswith((".csv", ".csv.gz", ".csv.zst", ".parquet")):
         file_name = file_name + ".csv"
 
     return file_name
 
 
+def determine_file_name(
+    table: str,
+    random: bool,
+    number_of_clauses: int,
+    limit: int,
+    output_format: str = "csv",
+):
+    """Ask what the results file should be called"""
+    file_name = enter_for_default(
+        "What would you like the file to be called? (end it in .parquet for a parquet file)",
+        default_file_name(table, random, number_of_clauses, limit, output_format),
+    )
+
+    return ensure_results_suffix(file_name)
+
+
+def s3_resource():
+    """Connect to S3, assuming AWS_ROLE_NAME if it's set"""
+    if AWS_ROLE_NAME:
+        return connect_to_aws_service(AWS_ACCOUNT_ID, AWS_ROLE_NAME)
+
+    # boto3 is only needed if something is read from or saved to S3
+    import boto3
+
+    return boto3.resource("s3", endpoint_url=S3_ENDPOINT_URL)
+
+
+def open_results_output(results_location: str, file_name: str):
+    """Returns an S3 upload to write the results to if the location is an s3:// URI (otherwise they are saved locally)"""
+    if not results_location.startswith("s3://"):
+        return None
+
+    bucket, prefix = split_s3_uri(ensure_file_slash(results_location))
+    return S3MultipartUpload(
+        s3_resource(),
+        bucket,
+        prefix + file_name,
+        part_size=S3_PART_SIZE_MB * 1024 * 1024,
+        max_concurrency=S3_UPLOAD_CONCURRENCY,
+    )
+
+
+def query_and_obfuscate_clause(
+    connection_pool: ThreadedConnectionPool,
+    clause_number: int,
+    clause_dict: dict,
+    schema: str,
+    table: str,
+    random: bool,
+    obfuscation_plan: ObfuscationPlan,
+    show_obfuscation: bool,
+    spill_folder: str,
+    process_pool: ProcessPoolExecutor = None,
+    sampling: str = "random",
+    sample_key: str = None,
+    key_columns: list = None,
+) -> list[str]:
+    """Query a single profile (WHERE clause) on a pooled connection and obfuscate the results chunk by chunk.
+    Each obfuscated chunk is spilled to a file in spill_folder, so profiles can run at the same time without
+    holding their results in memory. Returns the chunk files in order."""
+    chunk_files = []
+    with pooled_connection(connection_pool) as conn:
+        query_chunks = query_into_df_chunks(
+            schema,
+            table,
+            conn,
+            clause_dict["clause"],
+            limit=clause_dict["limit"],
+            random=random,
+            sampling=sampling,
+            sample_percentage=clause_dict.get(
+                "sample_percentage", DEFAULT_SAMPLE_PERCENTAGE
+            ),
+            sample_key=sample_key,
+            itersize=CHUNK_SIZE,
+            use_copy=EXTRACT_WITH_COPY,
+        )
+
+        for chunk_number, query_results in enumerate(query_chunks):
+            df_obfuscated = obfuscate_dataframe(
+                query_results,
+                obfuscation_plan,
+                # Only preview the obfuscation once per profile
+                show_comparison=show_obfuscation and chunk_number == 0,
+                process_pool=process_pool,
+                num_shards=OBFUSCATION_WORKERS,
+                run_secret=OBFUSCATION_SECRET,
+                key_columns=key_columns,
+            )
+
+            chunk_file = os.path.join(
+                spill_folder, f"clause_{clause_number}_chunk_{chunk_number}.pkl"
+            )
+            df_obfuscated.to_pickle(chunk_file)
+            chunk_files.append(chunk_file)
+
+    return chunk_files
+
+
+def query_and_obfuscate_clause_by_page(
+    connection_pool: ThreadedConnectionPool,
+    clause_number: int,
+    clause_dict: dict,
+    schema: str,
+    table: str,
+    random: bool,
+    obfuscation_plan: ObfuscationPlan,
+    show_obfuscation: bool,
+    checkpoint_folder: str,
+    process_pool: ProcessPoolExecutor = None,
+    sampling: str = "random",
+    sample_key: str = None,
+    key_columns: list = None,
+) -> list[str]:
+    """Resumable version of query_and_obfuscate_clause. The profile is read page by page, ordered by its unique
+    fields (`key_columns`), and every obfuscated page is saved with a checkpoint (see ClauseCheckpoint).
+    If the clause was already started, it picks up after the last saved page. Returns the page files in order."""
+    checkpoint = ClauseCheckpoint.load(
+        checkpoint_folder, clause_number, clause_dict["clause"]
+    )
+    if checkpoint.done:
+        log.info(f"Clause {clause_number} was already extracted")
+        return checkpoint.page_files
+
+    limit = clause_dict["limit"]
+    if limit and checkpoint.rows_written >= limit:
+        # The last page was saved, but the job stopped before the clause was marked as done
+        checkpoint.finish()
+        return checkpoint.page_files
+
+    with pooled_connection(connection_pool) as conn:
+        query_pages = query_into_df_pages(
+            schema,
+            table,
+            conn,
+            key_columns,
+            clause_dict["clause"],
+            limit=limit - checkpoint.rows_written if limit else False,
+            random=random,
+            sampling=sampling,
+            sample_percentage=clause_dict.get(
+                "sample_percentage", DEFAULT_SAMPLE_PERCENTAGE
+            ),
+            sample_key=sample_key,
+            after_key=checkpoint.last_key,
+            page_size=CHUNK_SIZE,
+            use_copy=EXTRACT_WITH_COPY,
+        )
+
+        for query_results, last_key in query_pages:
+            df_obfuscated = obfuscate_dataframe(
+                query_results,
+                obfuscation_plan,
+                # Only preview the obfuscation once per profile
+                show_comparison=show_obfuscation and not checkpoint.page_files,
+                process_pool=process_pool,
+                num_shards=OBFUSCATION_WORKERS,
+                run_secret=OBFUSCATION_SECRET,
+                key_columns=key_columns,
+            )
+            checkpoint.commit_page(df_obfuscated, last_key, len(query_results.index))
+
+    checkpoint.finish()
+    return checkpoint.page_files
+
+
 def explanation() -> None:
     print("\nTime to obfuscate your results...")
     print(
@@ -164,23 +458,33 @@ You will have the option to return random entries. If you don't randomize, the t
     )
 
 
-if __name__ == "__main__":
-    # Initiate logging
-    log = get_logger(__name__)
-
-    explanation()
-    schema = enter_for_default("What is the schema?", DEFAULT_SCHEMA)
-
-    base_table_name = enter_for_default(
-        "What is the table (or base table) name?", DEFAULT_TABLE
+def open_database(
+    lpass_manager: LastpassManager, max_connections: int, refresh_metadata: bool
+) -> tuple[ThreadedConnectionPool, MetadataCache]:
+    """Connect to a database, and open its metadata cache"""
+    connection_pool = connect_to_db_with_psycopg2_pool(lpass_manager, max_connections)
+    metadata_cache = MetadataCache(
+        os.path.join(
+            METADATA_CACHE_FOLDER, f"{lpass_manager.host}.{lpass_manager.database}"
+        ),
+        ttl_seconds=METADATA_CACHE_TTL_HOURS * 60 * 60,
+        refresh=refresh_metadata,
     )
 
-    # Connect to Db
-    lpass_manager = ensure_lastpass_entry_exists(BEDAP_LASTPASS_ENTRY)
-    conn = connect_to_db_with_psycopg2(lpass_manager)
+    return connection_pool, metadata_cache
 
+
+def prompt_for_job(
+    database: str,
+    schema: str,
+    base_table_name: str,
+    connection_pool: ThreadedConnectionPool,
+    metadata_cache: MetadataCache,
+) -> ObfuscationJob:
+    """Interactive front end: ask for everything else a job needs"""
     # SELECT * FROM schema.table
-    table = find_table_to_query(schema, base_table_name, conn)
+    with pooled_connection(connection_pool) as conn:
+        table = find_table_to_query(schema, base_table_name, conn, metadata_cache)
 
     # WHERE
     number_of_clauses = ensure_positive_int(
@@ -194,11 +498,24 @@ if __name__ == "__main__":
         10,
         False,
     )
-    # Determine limit of each query individually
-    where_clause_list = determine_query_limit(where_clause_list, total_limit)
+
+    # Lookup obfuscation profile (so any mismatch with the table is caught before the rest of the questions)
+    with pooled_connection(connection_pool) as conn:
+        _, unique_field_list = find_fields_to_obfuscate(
+            schema, base_table_name, table, conn, metadata_cache, compile_plan=True
+        )
 
     # Randomize results
     random = yes_true_else_false("Would you like the results randomized?")
+    sampling, sample_key = "random", None
+    if random:
+        with pooled_connection(connection_pool) as conn:
+            sampling = choose_sampling_strategy(supports_tablesample(conn))
+        if sampling == "key_hash":
+            sample_key = enter_for_default(
+                "Which integer column should the sample be keyed on?",
+                unique_field_list[0] if unique_field_list else "",
+            )
 
     # Preview Obfuscation?
     show_obfuscation = yes_true_else_false(
@@ -207,43 +524,328 @@ if __name__ == "__main__":
 
     # Define where to save restults
     results_location = enter_for_default(
-        "Where would you like the results saved?", DEFAULT_CSV_LOCATION
+        "Where would you like the results saved? (a folder, or s3://bucket/prefix/)",
+        DEFAULT_CSV_LOCATION,
+    )
+    file_name = determine_file_name(
+        table, random, number_of_clauses, total_limit, OUTPUT_FORMAT
+    )
+
+    return ObfuscationJob(
+        database,
+        schema,
+        base_table_name,
+        clauses=where_clause_list,
+        limit=total_limit or 0,
+        random=random,
+        sampling=sampling,
+        sample_key=sample_key,
+        show_obfuscation=show_obfuscation,
+        results_location=results_location,
+        file_name=file_name,
+    )
+
+
+def run_job(
+    job: ObfuscationJob,
+    connection_pool: ThreadedConnectionPool,
+    metadata_cache: MetadataCache,
+    process_pool: ProcessPoolExecutor = None,
+) -> JobResult:
+    """Query a table, obfuscate the results and save them, as described by a job"""
+    # SELECT * FROM schema.table
+    with pooled_connection(connection_pool) as conn:
+        table = find_table_to_query(
+            job.schema, job.base_table_name, conn, metadata_cache
+        )
+
+    # Determine limit of each query individually (on a copy, so the job can be run again)
+    where_clause_list = determine_query_limit(
+        copy.deepcopy(job.clauses), job.limit or False
     )
-    file_name = determine_file_name(table, random, number_of_clauses, total_limit)
 
     # Lookup obfuscation profile
-    fields_to_obfuscate, unique_field_list = find_fields_to_obfuscate(
-        schema, base_table_name, table, conn
-    )
-
-    # Loop through all the profiles and perform queries.
-    for clause_dict in where_clause_list:
-        clause = clause_dict["clause"]
-        limit = clause_dict["limit"]
-        query_results = query_into_df(
-            schema, table, conn, clause, limit=limit, random=random
-        )
-
-        try:
-            df_obfuscated = pd.concat(
-                [
-                    df_obfuscated,
-                    obfuscate_dataframe(
-                        query_results,
-                        fields_to_obfuscate,
-                        show_comparison=show_obfuscation,
-                    ),
-                ],
-            )
-        except:
-            df_obfuscated = obfuscate_dataframe(
-                query_results, fields_to_obfuscate, show_comparison=show_obfuscation
+    sampling, sample_key = job.sampling, job.sample_key
+    with pooled_connection(connection_pool) as conn:
+        obfuscation_plan, unique_field_list = find_fields_to_obfuscate(
+            job.schema,
+            job.base_table_name,
+            table,
+            conn,
+            metadata_cache,
+            compile_plan=True,
+        )
+        # Column types, so parquet files keep them
+        df_columns_dtypes = columns_from_table(job.schema, table, conn, metadata_cache)
+
+        if job.random:
+            if sampling in ("system", "bernoulli") and not supports_tablesample(conn):
+                log.warning(
+                    f"This database doesn't support TABLESAMPLE, using `random` sampling for `{job.name}`"
+                )
+                sampling = "random"
+            if sampling == "key_hash" and not sample_key:
+                assert unique_field_list, "key_hash sampling needs a sample_key"
+                sample_key = unique_field_list[0]
+            # The plain `random` sampling keeps its fixed rate, the other strategies sample just enough for the limit
+            if sampling != "random":
+                where_clause_list = determine_sample_percentages(
+                    where_clause_list, job.schema, table, conn
+                )
+
+    file_name = ensure_results_suffix(
+        job.file_name
+        or default_file_name(
+            table, job.random, job.number_of_clauses, job.limit, OUTPUT_FORMAT
+        )
+    )
+
+    # Resumable extraction pages through each profile by its unique fields, so it needs some
+    resumable = RESUMABLE_EXTRACTION and bool(unique_field_list)
+    if RESUMABLE_EXTRACTION and not resumable:
+        log.warning(
+            f"`{job.name}` has no unique fields to page through, so it can't be resumed if it stops"
+        )
+    if resumable:
+        checkpoint_folder = open_checkpoint_folder(
+            CHECKPOINT_FOLDER,
+            f"{job.name}_{file_name}",
+            {
+                "table": table,
+                "clauses": [(c["clause"], c["limit"]) for c in where_clause_list],
+                "random": job.random,
+                "sampling": sampling,
+                "sample_key": sample_key,
+                "key_columns": unique_field_list,
+            },
+        )
+
+    # Run all the profiles at the same time (up to MAX_CONNECTIONS), then save the results in profile order.
+    # Results are streamed in chunks, and each chunk is obfuscated as soon as it arrives
+    with tempfile.TemporaryDirectory() as spill_folder, ThreadPoolExecutor(
+        max_workers=min(MAX_CONNECTIONS, len(where_clause_list))
+    ) as executor:
+        unique_key_index = UniqueKeyIndex(
+            unique_field_list,
+            spill_folder=os.path.join(spill_folder, "unique_keys"),
+            max_keys_in_memory=MAX_UNIQUE_KEYS_IN_MEMORY,
+        )
+        futures = [
+            executor.submit(
+                query_and_obfuscate_clause_by_page
+                if resumable
+                else query_and_obfuscate_clause,
+                connection_pool,
+                clause_number,
+                clause_dict,
+                job.schema,
+                table,
+                job.random,
+                obfuscation_plan,
+                job.show_obfuscation,
+                checkpoint_folder if resumable else spill_folder,
+                process_pool,
+                sampling,
+                sample_key,
+                unique_field_list,
             )
+            for clause_number, clause_dict in enumerate(where_clause_list)
+        ]
+
+        with open_results_writer(
+            file_name,
+            results_folder=job.results_location,
+            df_columns_dtypes=df_columns_dtypes,
+            parquet_compression=PARQUET_COMPRESSION,
+            super_as=PARQUET_SUPER_AS,
+            output_file=open_results_output(job.results_location, file_name),
+        ) as writer:
+            try:
+                for future in futures:
+                    for chunk_file in future.result():
+                        df_obfuscated = pd.read_pickle(chunk_file)
+                        # Checkpointed pages are kept until all the results are saved
+                        if not resumable:
+                            os.remove(chunk_file)
+
+                        # Enforce uniqueness based on pre-defined unique columns
+                        if unique_field_list:
+                            df_obfuscated = unique_key_index.drop_duplicates(
+                                df_obfuscated
+                            )
+
+                        # Save results to a CSV
+                        writer.write(df_obfuscated)
+            except BaseException:
+                # Don't start the profiles that are still waiting for a connection (the ones already running are
+                # waited for when the executor shuts down)
+                for future in futures:
+                    future.cancel()
+                raise
+
+    if resumable:
+        remove_checkpoint_folder(checkpoint_folder)
+
+    output = ensure_file_slash(job.results_location) + file_name
+    log.info(f"Results saved to `{output}`")
+    return JobResult(job.name, job.database, table, output, writer.rows_written)
+
+
+def run_jobs_headless(
+    job_file: str,
+    report_path: str,
+    max_concurrent_jobs: int,
+    refresh_metadata: bool,
+    process_pool: ProcessPoolExecutor = None,
+) -> list[JobResult]:
+    """Batch front end: run every job in a job file (see job_utils.load_jobs) and write a summary report"""
+    jobs, max_jobs_per_database = load_jobs(
+        job_file,
+        defaults={
+            "database": BEDAP_LASTPASS_ENTRY,
+            "schema": DEFAULT_SCHEMA,
+            "results_location": DEFAULT_CSV_LOCATION,
+        },
+    )
+
+    # One connection pool per database, big enough for all of its jobs to query every profile at once
+    databases = {}
+    for database in {job.database for job in jobs}:
+        jobs_per_database = max_jobs_per_database.get(
+            database, DEFAULT_JOBS_PER_DATABASE
+        )
+        databases[database] = open_database(
+            LastpassManager(database),
+            MAX_CONNECTIONS * jobs_per_database,
+            refresh_metadata,
+        )
+
+    scheduler = JobScheduler(
+        lambda job: run_job(job, *databases[job.database], process_pool),
+        max_concurrent_jobs=max_concurrent_jobs,
+        max_jobs_per_database=max_jobs_per_database,
+        default_jobs_per_database=DEFAULT_JOBS_PER_DATABASE,
+    )
+    try:
+        results = scheduler.run(jobs)
+    finally:
+        for connection_pool, _ in databases.values():
+            connection_pool.closeall()
+
+    write_summary_report(results, report_path)
+    return results
+
+
+def save_run_metrics(
+    results: list[JobResult], report_path: str, prometheus_path: str = None
+) -> None:
+    """Log where the time went, and save the run's timings and counters (see library/metrics_utils.py) as a JSON
+    run report and, if a path is given, as Prometheus text metrics"""
+    report = RUN_METRICS.report()
+    if report["timers"]:
+        df_timers = (
+            pd.DataFrame(report["timers"])
+            .sort_values("seconds", ascending=False)
+            .fillna("")
+        )
+        log.info(f"Time spent per stage:\n{df_timers.to_string(index=False)}")
+
+    RUN_METRICS.write_json_report(
+        report_path, {"jobs": [asdict(result) for result in results]}
+    )
+    log.info(f"Run report saved to `{report_path}`")
+
+    if prometheus_path:
+        RUN_METRICS.write_prometheus(prometheus_path)
+        log.info(f"Prometheus metrics saved to `{prometheus_path}`")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Query a table and obfuscate the results"
+    )
+    parser.add_argument(
+        "--refresh-metadata",
+        action="store_true",
+        help="Ignore the cached table lists, column types and obfuscation profiles",
+    )
+    parser.add_argument(
+        "--jobs",
+        metavar="JOB_FILE",
+        help="Run the jobs in a YAML/JSON job file without prompting (see utils/job_utils.py)",
+    )
+    parser.add_argument(
+        "--report",
+        default=os.path.join(DEFAULT_CSV_LOCATION or "./results/", "job_summary.json"),
+        help="Where to save the summary report of a --jobs run",
+    )
+    parser.add_argument(
+        "--max-concurrent-jobs",
+        type=int,
+        default=MAX_CONCURRENT_JOBS,
+        help="Maximum number of jobs run at the same time (across all databases)",
+    )
+    parser.add_argument(
+        "--metrics-report",
+        default=METRICS_REPORT_PATH
+        or os.path.join(DEFAULT_CSV_LOCATION or "./results/", "run_report.json"),
+        help="Where to save the JSON run report (time spent per stage, rows and bytes processed)",
+    )
+    parser.add_argument(
+        "--prometheus-file",
+        default=PROMETHEUS_METRICS_FILE,
+        help="Also save the run's metrics to this file in the Prometheus text format",
+    )
+    args = parser.parse_args()
+
+    # Pull any changed obfuscation profiles from S3
+    if OBFUSCATION_PROFILE_S3_URI:
+        sync_obfuscation_profiles_from_s3(s3_resource(), OBFUSCATION_PROFILE_S3_URI)
+
+    # Start the obfuscation processes once, so they are reused by every profile
+    # (spawned rather than forked, since the profiles run in threads)
+    process_pool = None
+    if OBFUSCATION_WORKERS > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        process_pool = ProcessPoolExecutor(
+            max_workers=OBFUSCATION_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    if args.jobs:
+        results = run_jobs_headless(
+            args.jobs,
+            args.report,
+            args.max_concurrent_jobs,
+            args.refresh_metadata,
+            process_pool,
+        )
+    else:
+        explanation()
+        schema = enter_for_default("What is the schema?", DEFAULT_SCHEMA)
+
+        base_table_name = enter_for_default(
+            "What is the table (or base table) name?", DEFAULT_TABLE
+        )
+
+        # Connect to Db
+        lpass_manager = ensure_lastpass_entry_exists(BEDAP_LASTPASS_ENTRY)
+        connection_pool, metadata_cache = open_database(
+            lpass_manager, MAX_CONNECTIONS, args.refresh_metadata
+        )
+
+        job = prompt_for_job(
+            lpass_manager.lpass_entry,
+            schema,
+            base_table_name,
+            connection_pool,
+            metadata_cache,
+        )
+        results = [run_job(job, connection_pool, metadata_cache, process_pool)]
+        connection_pool.closeall()
 
-    # Enforce uniqueness based on pre-defined unique columns
-    if unique_field_list:
-        df_obfuscated = df_obfuscated.drop_duplicates(subset=unique_field_list)
+    if process_pool is not None:
+        process_pool.shutdown()
 
-    # Save results to a CSV
-    results_to_csv(df_obfuscated, file_name, results_folder=results_location)
-    log.info(f"Results saved to `{results_location}{file_name}`")
+    save_run_metrics(results, args.metrics_report, args.prometheus_file)
@@ -0,0 +1,25 @@
+import os
+import sys
+import pytest
+from psycopg2 import sql
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIR)
+
+
+def render_sql(composable) -> str:
+    """Render a composed query without a database connection (literals are shown as Python reprs)"""
+    if isinstance(composable, sql.Composed):
+        return "".join(render_sql(part) for part in composable.seq)
+    elif isinstance(composable, sql.SQL):
+        return composable.string
+    elif isinstance(composable, sql.Identifier):
+        return ".".join(f'"{name}"' for name in composable.strings)
+    elif isinstance(composable, sql.Literal):
+        return repr(composable.wrapped)
+    raise TypeError(f"Unexpected composable: {composable!r}")
+
+
+@pytest.fixture(name="render_sql")
+def render_sql_fixture():
+    return render_sql
@@ -0,0 +1,94 @@
+import pytest
+import pandas as pd
+from pandas import DataFrame as DF
+
+import main
+from utils.checkpoint_utils import ClauseCheckpoint
+from utils.obfuscation_utils import ObfuscationPlan
+
+CLAUSE = "WHERE state = 'MD'"
+
+
+@pytest.fixture
+def fake_pages(monkeypatch):
+    """Replaces the database with a table of 10 rows, read in pages of 4, and records each extraction"""
+    table = DF({"key": list(range(1, 11)), "value": list("abcdefghij")})
+    extractions = []
+
+    def fake_query_into_df_pages(
+        schema, table_name, conn, keyset_columns, clause, **kwargs
+    ):
+        extractions.append(kwargs)
+        rows = table
+        if kwargs["after_key"] is not None:
+            rows = rows[rows["key"] > kwargs["after_key"][0]]
+        if kwargs["limit"]:
+            rows = rows.head(kwargs["limit"])
+        for start in range(0, len(rows.index), 4):
+            df_page = rows.iloc[start : start + 4].reset_index(drop=True)
+            yield df_page, [int(df_page["key"].iloc[-1])]
+
+    monkeypatch.setattr(main, "query_into_df_pages", fake_query_into_df_pages)
+    monkeypatch.setattr(main, "pooled_connection", lambda pool: FakeConnection())
+    return extractions
+
+
+class FakeConnection:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def extract_clause(checkpoint_folder, limit=False) -> list:
+    return main.query_and_obfuscate_clause_by_page(
+        None,
+        0,
+        {"clause": CLAUSE, "limit": limit},
+        "schema",
+        "table",
+        False,
+        ObfuscationPlan((), ()),
+        False,
+        str(checkpoint_folder),
+        key_columns=["key"],
+    )
+
+
+def read_pages(page_files: list) -> list:
+    """The keys of the saved pages, in order"""
+    return [key for page_file in page_files for key in pd.read_pickle(page_file)["key"]]
+
+
+def test_clause_is_read_page_by_page(fake_pages, tmp_path):
+    page_files = extract_clause(tmp_path)
+
+    assert read_pages(page_files) == list(range(1, 11))
+    checkpoint = ClauseCheckpoint.load(str(tmp_path), 0, CLAUSE)
+    assert checkpoint.done
+    assert checkpoint.rows_written == 10
+    assert checkpoint.last_key == [10]
+
+
+def test_clause_resumes_after_the_last_saved_page(fake_pages, tmp_path):
+    checkpoint = ClauseCheckpoint(str(tmp_path), 0, CLAUSE)
+    checkpoint.commit_page(DF({"key": [1, 2, 3, 4]}), [4], 4)
+
+    page_files = extract_clause(tmp_path, limit=8)
+
+    assert fake_pages[0]["after_key"] == [4]
+    assert fake_pages[0]["limit"] == 4
+    assert read_pages(page_files) == list(range(1, 9))
+
+
+def test_clause_that_reached_its_limit_is_not_read_again(fake_pages, tmp_path):
+    checkpoint = ClauseCheckpoint(str(tmp_path), 0, CLAUSE)
+    checkpoint.commit_page(DF({"key": [1, 2, 3, 4]}), [4], 4)
+
+    page_files = extract_clause(tmp_path, limit=4)
+
+    # A limit of 0 would have meant no limit, and read the rest of the table
+    assert fake_pages == []
+    assert read_pages(page_files) == [1, 2, 3, 4]
+    assert ClauseCheckpoint.load(str(tmp_path), 0, CLAUSE).done
@@ -0,0 +1,91 @@
+import json
+import subprocess
+
+import pytest
+from moto import mock_aws
+
+import library.connection_utils as connection_utils
+from library.connection_utils import AwsSessionManager, LastpassManager
+
+ENTRY = "Test Database"
+LPASS_ENTRY = {
+    "username": "Obfuscator",
+    "password": "secret",
+    "note": "Type:postgres\nDatabase:analytics\nHostname:localhost\nPort:5432",
+}
+
+
+def fake_lpass(monkeypatch, show) -> list:
+    """Replace the lastpass CLI: `lpass status` succeeds, and `lpass show` calls `show`. Returns the commands run."""
+    commands = []
+
+    def bash_cmd(cmd):
+        commands.append(cmd)
+        if cmd.startswith("lpass show"):
+            return show()
+        return ""
+
+    monkeypatch.setattr(connection_utils, "bash_cmd", bash_cmd)
+    monkeypatch.setattr(connection_utils, "_lpass_cache", {})
+    return commands
+
+
+def test_lastpass_manager_reads_entry(monkeypatch):
+    commands = fake_lpass(monkeypatch, lambda: json.dumps([LPASS_ENTRY]))
+
+    lpass = LastpassManager(ENTRY)
+    assert (lpass.user, lpass.password, lpass.host, lpass.port) == (
+        "Obfuscator",
+        "secret",
+        "localhost",
+        "5432",
+    )
+
+    # The second manager for the entry uses the cached credentials
+    LastpassManager(ENTRY)
+    assert sum(cmd.startswith("lpass show") for cmd in commands) == 1
+
+
+def test_lastpass_manager_missing_entry(monkeypatch):
+    def show():
+        raise subprocess.CalledProcessError(1, "lpass show")
+
+    fake_lpass(monkeypatch, show)
+    with pytest.raises(AssertionError):
+        LastpassManager(ENTRY)
+
+
+def test_lastpass_manager_entry_without_fields(monkeypatch):
+    fake_lpass(monkeypatch, lambda: json.dumps([{"username": "Obfuscator"}]))
+    with pytest.raises(AssertionError):
+        LastpassManager(ENTRY)
+
+
+def test_lastpass_manager_login_failure_is_raised(monkeypatch):
+    def bash_cmd(cmd):
+        raise subprocess.CalledProcessError(1, cmd)
+
+    monkeypatch.setattr(connection_utils, "bash_cmd", bash_cmd)
+    monkeypatch.setattr(connection_utils, "_lpass_cache", {})
+    with pytest.raises(subprocess.CalledProcessError):
+        LastpassManager(ENTRY)
+
+
+def test_lastpass_manager_unreadable_output_is_raised(monkeypatch):
+    fake_lpass(monkeypatch, lambda: "Error: Could not find decryption key.")
+    with pytest.raises(json.JSONDecodeError):
+        LastpassManager(ENTRY)
+
+
+def test_aws_session_manager_uses_assumed_role(monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with mock_aws():
+        session_manager = AwsSessionManager("123456789012", "obfuscation")
+
+        credentials = session_manager.session.get_credentials()
+        assert credentials.method == "sts-assume-role"
+        assert credentials.access_key != "testing"
+        assert credentials.token
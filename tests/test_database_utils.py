@@ -0,0 +1,294 @@
+import math
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas import DataFrame as DF
+from psycopg2.sql import SQL
+
+import library.database_utils as database_utils
+from library.database_utils import json_safe_key_value, query_into_df_pages
+
+
+@pytest.fixture
+def fake_table(monkeypatch):
+    """Pages are read from a dataframe instead of a database, following the keyset arguments of each query"""
+    table = DF({"key": list(range(1, 11)), "value": list("abcdefghij")})
+    queries = []
+
+    def fake_generic_sql_query(schema, table_name, clause, **kwargs):
+        queries.append(kwargs)
+        return kwargs
+
+    def fake_results_to_df(conn, query):
+        rows = table
+        if query["after_key"] is not None:
+            rows = rows[rows["key"] > query["after_key"][0]]
+        return rows.head(query["limit"]).reset_index(drop=True)
+
+    monkeypatch.setattr(database_utils, "generic_sql_query", fake_generic_sql_query)
+    monkeypatch.setattr(database_utils, "results_to_df", fake_results_to_df)
+    return queries
+
+
+def test_query_into_df_pages(fake_table):
+    pages = list(query_into_df_pages("schema", "table", None, ["key"], page_size=4))
+
+    assert [df_page["key"].tolist() for df_page, _ in pages] == [
+        [1, 2, 3, 4],
+        [5, 6, 7, 8],
+        [9, 10],
+    ]
+    assert [last_key for _, last_key in pages] == [[4], [8], [10]]
+    assert [query["after_key"] for query in fake_table] == [None, [4], [8]]
+
+
+def test_query_into_df_pages_with_int_and_float_keys(monkeypatch):
+    # Too big to be stored exactly as a float
+    big_key = 2**53 + 1
+    table = DF(
+        {
+            "key": pd.Series([big_key, big_key + 2, big_key + 4], dtype="int64"),
+            "score": [0.5, 1.5, 2.5],
+        }
+    )
+    after_keys = []
+
+    def fake_results_to_df(conn, query):
+        after_keys.append(query["after_key"])
+        rows = table
+        if query["after_key"] is not None:
+            rows = rows[rows["key"] > query["after_key"][0]]
+        return rows.head(query["limit"]).reset_index(drop=True)
+
+    monkeypatch.setattr(
+        database_utils,
+        "generic_sql_query",
+        lambda schema, table, clause, **kwargs: kwargs,
+    )
+    monkeypatch.setattr(database_utils, "results_to_df", fake_results_to_df)
+
+    pages = list(
+        query_into_df_pages("schema", "table", None, ["key", "score"], page_size=2)
+    )
+
+    assert [last_key for _, last_key in pages] == [
+        [big_key + 2, 1.5],
+        [big_key + 4, 2.5],
+    ]
+    assert type(pages[0][1][0]) is int
+    assert after_keys == [None, [big_key + 2, 1.5]]
+
+
+def test_query_into_df_pages_stops_at_the_limit(fake_table):
+    pages = list(
+        query_into_df_pages(
+            "schema", "table", None, ["key"], limit=6, after_key=[2], page_size=4
+        )
+    )
+
+    assert [df_page["key"].tolist() for df_page, _ in pages] == [
+        [3, 4, 5, 6],
+        [7, 8],
+    ]
+    assert [query["limit"] for query in fake_table] == [4, 2]
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (5, 5),
+        ("x", "x"),
+        (1.5, 1.5),
+        (np.int64(2**53 + 1), 2**53 + 1),
+        (datetime.date(2020, 1, 31), "2020-01-31"),
+    ],
+)
+def test_json_safe_key_value(value, expected):
+    assert json_safe_key_value(value) == expected
+
+
+@pytest.mark.parametrize("value", [None, math.nan])
+def test_json_safe_key_value_rejects_nulls(value):
+    with pytest.raises(ValueError):
+        json_safe_key_value(value)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query):
+        self.conn.executed.append(query)
+
+    def copy_expert(self, query, file):
+        self.conn.copied.append((query, file.read()))
+
+
+class FakeConnection:
+    """Records the queries and COPY data sent to it, and whether they were committed"""
+
+    server_version = 150000
+
+    def __init__(self):
+        self.autocommit = True
+        self.executed = []
+        self.copied = []
+        self.committed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+def test_insert_df_to_db_widens_integers(monkeypatch, render_sql):
+    monkeypatch.setattr(
+        database_utils, "tables_in_schema", lambda schema, conn: DF({"table_name": []})
+    )
+    conn = FakeConnection()
+    df_columns_dtypes = DF(
+        {
+            "column_name": ["small_count", "member_id", "notes"],
+            "dtype": ["int2", "int4", "super"],
+        }
+    )
+    # Obfuscated ints can be out of the source column's range (int2 here)
+    df_chunks = [
+        DF({"small_count": [76101, None], "member_id": [1, 2], "notes": ["{}", "x"]}),
+        DF({"small_count": [3], "member_id": [3], "notes": [None]}),
+    ]
+
+    num_rows = database_utils.insert_df_to_db(
+        iter(df_chunks),
+        conn,
+        "obfuscated",
+        schema="scratch",
+        df_columns_dtypes=df_columns_dtypes,
+    )
+
+    assert num_rows == 3
+    assert conn.committed and conn.autocommit
+    assert render_sql(conn.executed[0]).strip() == (
+        'CREATE TABLE "scratch"."obfuscated" '
+        '("small_count" int8, "member_id" int8, "notes" text)'
+    )
+    assert [data for _, data in conn.copied] == [
+        "76101,1,{}\n\\N,2,x\n",
+        "3,3,\\N\n",
+    ]
+    assert '"scratch"."obfuscated"' in render_sql(conn.copied[0][0])
+
+
+def test_insert_df_to_db_fails_if_the_table_exists(monkeypatch):
+    monkeypatch.setattr(
+        database_utils,
+        "tables_in_schema",
+        lambda schema, conn: DF({"table_name": ["obfuscated"]}),
+    )
+
+    with pytest.raises(ValueError):
+        database_utils.insert_df_to_db(DF({"a": [1]}), FakeConnection(), "obfuscated")
+
+
+class FakeCopyCursor:
+    """Returns `copy_data` for any COPY ... TO STDOUT, with the columns of `description`"""
+
+    def __init__(self, description, copy_data):
+        self.description = description
+        self.copy_data = copy_data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query):
+        pass
+
+    def copy_expert(self, query, file):
+        file.write(self.copy_data.encode("utf-8"))
+
+
+class FakeCopyConnection:
+    encoding = "UTF8"
+
+    def __init__(self, description, copy_data):
+        self.description = description
+        self.copy_data = copy_data
+
+    def cursor(self):
+        return FakeCopyCursor(self.description, self.copy_data)
+
+
+COPY_COLUMNS = [
+    ("member_id", 20),
+    ("zip_code", 1043),
+    ("score", 701),
+    ("active", 16),
+    ("details", 3802),
+    ("notes", 25),
+]
+# (text values are sent with COPY_TEXT_PREFIX in front of them)
+COPY_DATA = (
+    '1,_02134,1.5,t,"{""plan"": ""A""}","_"\n'
+    "2,\\N,\\N,f,\\N,\\N\n"
+    '3,_00501,-2,\\N,"[1, 2]","_says ""hi"",\nthen leaves"\n'
+    '4,_,0,t,\\N,"_\\N"\n'
+)
+
+
+def test_results_to_df_with_copy():
+    df = database_utils.results_to_df_with_copy(
+        FakeCopyConnection(COPY_COLUMNS, COPY_DATA), SQL("SELECT * FROM members")
+    )
+
+    assert list(df.columns) == [name for name, _ in COPY_COLUMNS]
+    assert df["member_id"].tolist() == [1, 2, 3, 4]
+    assert df["member_id"].dtype == "int64"
+    # Text is kept as is (leading zeros), and NULLs can be told apart from empty strings
+    assert df["zip_code"].tolist()[::2] == ["02134", "00501"]
+    assert df["notes"].tolist()[::2] == ["", 'says "hi",\nthen leaves']
+    assert pd.isna(df["zip_code"][1]) and pd.isna(df["notes"][1])
+    # ... including text that is the same as the NULL marker
+    assert df["zip_code"][3] == "" and df["notes"][3] == "\\N"
+    assert df["score"].tolist()[::2] == [1.5, -2.0]
+    assert df["active"].tolist()[:2] == [True, False]
+    assert df["details"].tolist()[::2] == [{"plan": "A"}, [1, 2]]
+
+
+def test_query_table_with_copy_in_chunks():
+    chunks = list(
+        database_utils.query_table_with_copy(
+            FakeCopyConnection(COPY_COLUMNS, COPY_DATA),
+            SQL("SELECT * FROM members"),
+            itersize=2,
+        )
+    )
+
+    assert [chunk["member_id"].tolist() for chunk in chunks] == [[1, 2], [3, 4]]
+    assert [list(chunk.index) for chunk in chunks] == [[0, 1], [0, 1]]
+
+
+def test_query_table_with_copy_without_results():
+    chunks = list(
+        database_utils.query_table_with_copy(
+            FakeCopyConnection(COPY_COLUMNS, ""), SQL("SELECT * FROM members")
+        )
+    )
+
+    assert len(chunks) == 1
+    assert chunks[0].empty
+    assert list(chunks[0].columns) == [name for name, _ in COPY_COLUMNS]
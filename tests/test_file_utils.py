@@ -0,0 +1,36 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import DataFrame as DF
+
+from library.file_utils import ParquetResultsWriter
+from utils.obfuscation_utils import obfuscate_dataframe
+
+
+def test_obfuscated_int2_round_trips_through_parquet(tmp_path):
+    df_columns_dtypes = DF(
+        {"column_name": ["member_id", "small_count"], "dtype": ["int4", "int2"]}
+    )
+    fields_to_obfuscate = DF(
+        {"dtype": ["int", "int"]}, index=pd.Index(["member_id", "small_count"])
+    )
+    df = DF({"member_id": [1999999999, 7], "small_count": [12345, 32767]})
+
+    df_obfuscated = obfuscate_dataframe(
+        df, fields_to_obfuscate, show_comparison=False, run_secret="secret"
+    )
+    # Shifting the digits takes 32767 out of the int2 range
+    assert df_obfuscated["small_count"].max() > 32767
+
+    with ParquetResultsWriter(
+        "results.parquet", str(tmp_path), df_columns_dtypes=df_columns_dtypes
+    ) as writer:
+        writer.write(df_obfuscated)
+
+    table = pq.read_table(tmp_path / "results.parquet")
+    assert table.schema.field("small_count").type == pa.int64()
+    assert table.schema.field("member_id").type == pa.int64()
+    assert table.to_pandas()["small_count"].tolist() == list(
+        df_obfuscated["small_count"]
+    )
+    assert table.to_pandas()["member_id"].tolist() == list(df_obfuscated["member_id"])
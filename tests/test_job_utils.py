@@ -0,0 +1,133 @@
+import os
+import threading
+
+import pytest
+
+from utils.job_utils import JobResult, JobScheduler, ObfuscationJob, load_jobs
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def make_job(name: str, database: str = "BEDAP_REDSHIFT", **kwargs) -> ObfuscationJob:
+    return ObfuscationJob(database, "basetables", name, name=name, **kwargs)
+
+
+def test_clause_percentages_can_be_rounded():
+    # 8 x 11.1 + 11.2 is 99.99999999999999 in floating point
+    clauses = [{"clause": f"state_code = {i}", "percentage": 11.1} for i in range(8)]
+    clauses.append({"clause": "WHERE state_code = 8", "percentage": "11.2"})
+
+    job = make_job("beneficiaries", clauses=clauses)
+
+    assert job.number_of_clauses == 9
+    assert job.clauses[0]["clause"] == "WHERE state_code = 0"
+    assert job.clauses[8]["clause"] == "WHERE state_code = 8"
+
+
+@pytest.mark.parametrize(
+    "clause", ["WHERE\tstate = 'MD'", "where\n  state = 'MD'", "  Where state = 'MD'"]
+)
+def test_clauses_starting_with_where_are_kept(clause):
+    job = make_job("beneficiaries", clauses=[{"clause": clause, "percentage": 100}])
+
+    assert job.clauses[0]["clause"] == clause
+
+
+def test_clause_percentages_must_add_up_to_100():
+    with pytest.raises(AssertionError):
+        make_job(
+            "beneficiaries",
+            clauses=[
+                {"clause": "WHERE state = 'MD'", "percentage": 50},
+                {"clause": "WHERE state = 'VA'", "percentage": 40},
+            ],
+        )
+
+
+def test_load_jobs():
+    jobs, max_jobs_per_database = load_jobs(
+        os.path.join(ROOT_DIR, "jobs_example.yaml"), defaults={"limit": 10}
+    )
+
+    assert [job.name for job in jobs][:2] == [
+        "basetables.beneficiaries",
+        "basetables.claims",
+    ]
+    assert jobs[0].limit == 1000 and jobs[1].limit == 500
+    assert all(job.database == "BEDAP_REDSHIFT" for job in jobs)
+    assert max_jobs_per_database == {"BEDAP_REDSHIFT": 2}
+
+
+class RecordingJobs:
+    """Runs fake jobs, recording how many run at once (overall and per database)"""
+
+    def __init__(self, blocking_jobs: dict = None):
+        self.lock = threading.Lock()
+        self.started = {}
+        self.running = {}
+        self.max_running = {}
+        self.max_running_overall = 0
+        # Jobs that only finish once another job has started
+        self.blocking_jobs = blocking_jobs or {}
+
+    def __call__(self, job: ObfuscationJob) -> JobResult:
+        with self.lock:
+            self.started.setdefault(job.name, threading.Event()).set()
+            self.running[job.database] = self.running.get(job.database, 0) + 1
+            self.max_running[job.database] = max(
+                self.max_running.get(job.database, 0), self.running[job.database]
+            )
+            self.max_running_overall = max(
+                self.max_running_overall, sum(self.running.values())
+            )
+        try:
+            if job.name == "fails":
+                raise ValueError("The table doesn't exist")
+            if job.name in self.blocking_jobs:
+                other_job = self.blocking_jobs[job.name]
+                with self.lock:
+                    started = self.started.setdefault(other_job, threading.Event())
+                assert started.wait(timeout=5), f"{other_job} never started"
+            return JobResult(job.name, job.database, rows_written=len(job.name))
+        finally:
+            with self.lock:
+                self.running[job.database] -= 1
+
+
+def test_scheduler_limits_jobs_per_database():
+    jobs = [make_job(f"a{i}", "A") for i in range(4)] + [
+        make_job(f"b{i}", "B") for i in range(4)
+    ]
+    run_job = RecordingJobs()
+
+    results = JobScheduler(
+        run_job, max_concurrent_jobs=3, max_jobs_per_database={"A": 2}
+    ).run(jobs)
+
+    assert [result.name for result in results] == [job.name for job in jobs]
+    assert all(result.status == "succeeded" for result in results)
+    assert run_job.max_running["A"] <= 2
+    assert run_job.max_running["B"] == 1
+    assert run_job.max_running_overall <= 3
+
+
+def test_jobs_waiting_on_a_database_dont_hold_up_other_databases():
+    # The first job on A only finishes once the job on B has started. If the other jobs on A took the free
+    # thread while waiting for A's only slot, the job on B would never start.
+    jobs = [make_job(f"a{i}", "A") for i in range(3)] + [make_job("b0", "B")]
+    run_job = RecordingJobs(blocking_jobs={"a0": "b0"})
+
+    results = JobScheduler(run_job, max_concurrent_jobs=2).run(jobs)
+
+    assert all(result.status == "succeeded" for result in results)
+    assert run_job.max_running["A"] == 1
+
+
+def test_failed_job_does_not_stop_the_others():
+    jobs = [make_job("fails"), make_job("works")]
+
+    results = JobScheduler(RecordingJobs(), max_concurrent_jobs=1).run(jobs)
+
+    assert [result.status for result in results] == ["failed", "succeeded"]
+    assert "doesn't exist" in results[0].error
+    assert results[1].rows_written == 5
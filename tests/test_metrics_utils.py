@@ -0,0 +1,75 @@
+import json
+
+import library.database_utils
+import library.file_utils
+import library.metrics_utils
+from library.metrics_utils import RunMetrics
+
+
+def test_metrics_are_shared_by_every_module():
+    # The library's modules import it through the package, like everything else
+    for module in (library.database_utils, library.file_utils):
+        assert module.count.__self__ is library.metrics_utils.RUN_METRICS
+        assert module.timer.__self__ is library.metrics_utils.RUN_METRICS
+
+    library.database_utils.count("rows", 3, stage="test_shared")
+    counters = library.metrics_utils.RUN_METRICS.report()["counters"]
+    assert {"name": "rows", "stage": "test_shared", "value": 3} in counters
+
+
+def test_report():
+    metrics = RunMetrics()
+    for _ in range(2):
+        with metrics.timer("obfuscate_column", column="ssn", dtype="varchar"):
+            pass
+    metrics.count("rows", 500, stage="fetch")
+    metrics.count("rows", 250, stage="fetch")
+
+    report = metrics.report()
+
+    assert [
+        {key: value for key, value in timer.items() if key != "seconds"}
+        for timer in report["timers"]
+    ] == [
+        {"stage": "obfuscate_column", "column": "ssn", "dtype": "varchar", "calls": 2}
+    ]
+    assert report["counters"] == [{"name": "rows", "stage": "fetch", "value": 750}]
+
+
+def test_timer_counts_calls_that_raise():
+    metrics = RunMetrics()
+    try:
+        with metrics.timer("query_execute"):
+            raise ValueError
+    except ValueError:
+        pass
+
+    assert metrics.report()["timers"][0]["calls"] == 1
+
+
+def test_write_json_report(tmp_path):
+    metrics = RunMetrics()
+    metrics.count("bytes", 1024, stage="write")
+
+    metrics.write_json_report(str(tmp_path / "run.json"), extra={"jobs": ["members"]})
+
+    with open(tmp_path / "run.json") as f:
+        report = json.load(f)
+    assert report["counters"] == [{"name": "bytes", "stage": "write", "value": 1024}]
+    assert report["jobs"] == ["members"]
+
+
+def test_write_prometheus(tmp_path):
+    metrics = RunMetrics(prefix="obfuscation")
+    with metrics.timer("fetch", method="copy"):
+        pass
+    metrics.count("rows", 10, stage="fetch", table='say "hi"')
+
+    metrics.write_prometheus(str(tmp_path / "metrics.prom"))
+
+    lines = (tmp_path / "metrics.prom").read_text().splitlines()
+    assert "# TYPE obfuscation_stage_seconds_total counter" in lines
+    assert 'obfuscation_stage_calls_total{stage="fetch",method="copy"} 1' in lines
+    assert "# TYPE obfuscation_rows_total counter" in lines
+    assert 'obfuscation_rows_total{stage="fetch",table="say \\"hi\\""} 10' in lines
+    assert not (tmp_path / "metrics.prom.tmp").exists()
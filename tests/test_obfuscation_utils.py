@@ -0,0 +1,324 @@
+import datetime
+import itertools
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.obfuscation_utils import (
+    MAX_INT_TO_SHIFT,
+    keyed_row_randomness,
+    obfuscate_date,
+    obfuscate_date_column,
+    obfuscate_int,
+    obfuscate_int_column,
+    obfuscate_super,
+    obfuscate_super_column,
+    obfuscate_varchar,
+    obfuscate_varchar_column,
+    obfuscation_profile_path,
+    sniff_super_plan,
+)
+
+VARCHAR_VALUES = [
+    None,
+    "",
+    "John Smith",
+    "MiXeD CaSe",
+    "0903397",
+    "1EG4-TE5-MK73",
+    "Apt. #4, 12 Main St.",
+    "Zoë Ångström 42",
+    # Strings that ast.literal_eval can parse
+    "['Maryland', 21201]",
+    "{'city': 'Baltimore', 'zip': '21201'}",
+    "None",
+    "True",
+    "3.5",
+    "-12",
+    "b'bytes'",
+    "[not a list",
+]
+
+
+def test_obfuscation_profile_path(monkeypatch):
+    monkeypatch.setenv("OBFUSCATION_PROFILE_FOLDER_NAME", "obfuscation_profiles")
+
+    assert obfuscation_profile_path("mdcr", "members") == os.path.join(
+        os.getcwd(), "obfuscation_profiles", "mdcr.members.csv"
+    )
+
+
+def test_obfuscation_profile_path_without_a_folder(monkeypatch):
+    monkeypatch.delenv("OBFUSCATION_PROFILE_FOLDER_NAME", raising=False)
+
+    with pytest.raises(ValueError, match="OBFUSCATION_PROFILE_FOLDER_NAME"):
+        obfuscation_profile_path("mdcr", "members")
+
+
+def rows_for_every_random_int(values: list) -> tuple:
+    """Every value paired with every random int (1-9), and a random number of days"""
+    rows = list(itertools.product(values, range(1, 10)))
+    column = pd.Series([value for value, random_int in rows], dtype=object)
+    random_ints = [random_int for value, random_int in rows]
+    random_days = [(i * 37) % 1000 + 1 for i in range(len(rows))]
+    return column, random_ints, random_days
+
+
+@pytest.mark.parametrize("field_name", [None, "first_name", "hicn", "mbi_id"])
+def test_obfuscate_varchar_column_matches_obfuscate_varchar(field_name):
+    column, random_ints, random_days = rows_for_every_random_int(VARCHAR_VALUES)
+
+    expected = [
+        obfuscate_varchar(value, random_int, random_day, field_name)
+        for value, random_int, random_day in zip(column, random_ints, random_days)
+    ]
+    output = obfuscate_varchar_column(column, random_ints, random_days, field_name)
+
+    assert output.tolist() == expected
+    assert output.index.equals(column.index)
+
+
+def test_obfuscate_int_column_matches_obfuscate_int():
+    values = [0, 7, 10, 903397, 9814286, 123456789012, -5, -90210]
+    column, random_ints, random_days = rows_for_every_random_int(values)
+
+    output = obfuscate_int_column(column.astype("int64"), random_ints, random_days)
+
+    assert str(output.dtype) == "Int64"
+    # obfuscate_int returns strings, which keep leading zeros created by the shift
+    assert output.tolist() == [
+        int(obfuscate_int(value, random_int, random_day))
+        for value, random_int, random_day in zip(column, random_ints, random_days)
+    ]
+
+
+def test_obfuscate_int_column_drops_leading_zeros():
+    column = pd.Series([9814286], dtype="int64")
+
+    assert obfuscate_int(9814286, 1, 1) == "0925397"
+    assert obfuscate_int_column(column, [1], [1]).tolist() == [925397]
+
+
+def test_obfuscate_int_column_negative_values():
+    column = pd.Series([-12, -9, -1], dtype="int64")
+
+    assert obfuscate_int_column(column, [2, 1, 9], [1, 1, 1]).tolist() == [-34, 0, 0]
+
+
+@pytest.mark.parametrize(
+    "column",
+    [
+        pd.Series([12, None, 345], dtype="Int64"),
+        # An int column with NULLs read as floats
+        pd.Series([12.0, math.nan, 345.0]),
+        pd.Series([12, None, 345], dtype=object),
+    ],
+)
+def test_obfuscate_int_column_keeps_nulls(column):
+    output = obfuscate_int_column(column, [3, 3, 3], [1, 1, 1])
+
+    assert str(output.dtype) == "Int64"
+    assert output[0] == 45 and output[2] == 678
+    assert output.isna().tolist() == [False, True, False]
+
+
+def test_obfuscate_int_column_huge_values_use_strings():
+    values = [MAX_INT_TO_SHIFT, 12, 12345678901234567890, None]
+    column = pd.Series(values, dtype=object)
+
+    output = obfuscate_int_column(column, [1, 1, 1, 1], [1, 1, 1, 1])
+
+    assert output.dtype == object
+    assert output.tolist() == [obfuscate_int(value, 1, 1) for value in values]
+    assert output[0] == "2111111111111111111"
+
+    # A nullable int8 column (e.g. read with COPY) has pd.NA for its NULLs
+    column = pd.Series([2**62, pd.NA], dtype="Int64")
+
+    output = obfuscate_int_column(column, [1, 1], [1, 1])
+
+    assert output.tolist() == [obfuscate_int(2**62, 1, 1), None]
+
+
+# Dates as psycopg2 fetches them (the COPY path reads them as "YYYY-MM-DD" strings), including the sentinel
+# 9999-12-31 and dates that go out of range once shifted
+DATE_VALUES = [
+    datetime.date(2015, 6, 1),
+    datetime.date(1980, 1, 31),
+    datetime.date(2090, 1, 1),
+    datetime.date(9999, 12, 31),
+    datetime.date(1, 1, 3),
+    None,
+]
+
+
+def formatted_dates(column: pd.Series) -> list:
+    """The dates of an obfuscated date column, formatted like obfuscate_date's output"""
+    return [
+        None if pd.isna(value) else value for value in column.dt.strftime("%Y-%m-%d")
+    ]
+
+
+@pytest.mark.parametrize("read_with_copy", [False, True])
+def test_obfuscate_date_column_matches_obfuscate_date(read_with_copy):
+    column, random_ints, random_days = rows_for_every_random_int(DATE_VALUES)
+
+    expected = [
+        obfuscate_date(value, random_day)
+        for value, random_day in zip(column, random_days)
+    ]
+    if read_with_copy:
+        column = column.map(lambda value: value.isoformat(), na_action="ignore")
+    output = obfuscate_date_column(column, random_ints, random_days)
+
+    assert formatted_dates(output) == expected
+    assert expected.count(None) > len(DATE_VALUES)
+
+
+def test_obfuscate_date_column_timestamps():
+    timestamps = [
+        datetime.datetime(2015, 6, 1, 13, 45),
+        datetime.datetime(2090, 1, 1, 23, 59),
+        None,
+    ]
+    column = pd.Series(timestamps, dtype=object)
+
+    output = obfuscate_date_column(column, [1, 1, 1], [10, 10, 10])
+
+    assert formatted_dates(output) == [
+        obfuscate_date(value, 10) for value in timestamps
+    ]
+    assert formatted_dates(output) == ["2015-05-22", "2090-01-11", None]
+
+
+def test_obfuscate_date_column_keeps_time_zones():
+    column = pd.Series(
+        pd.to_datetime(["2015-06-01 23:30", "2090-01-01 00:30", None]).tz_localize(
+            "US/Eastern"
+        )
+    )
+
+    output = obfuscate_date_column(column, [1, 1, 1], [10, 10, 10])
+
+    assert str(output.dt.tz) == "US/Eastern"
+    # The dates are shifted in their own time zone
+    assert formatted_dates(output) == ["2015-05-22", "2090-01-11", None]
+
+
+# Columns of "super" values that each decoder plan is picked for (or none of them), with a few values that don't fit
+SUPER_COLUMNS = {
+    "json_object": [
+        '{"city": "Baltimore", "zip": "21201", "moved_in": "2015-06-01", "units": 3}',
+        '{"name": "John", "spouse": null, "active": true}',
+        '{"nested": {"code": "A1"}, "ids": [1, 2]}',
+        "{'python': 'dict'}",
+        '{"escaped": "line\\nbreak"}',
+        None,
+    ],
+    # (JSON arrays are returned unchanged, like obfuscate_super does)
+    "json_array": ['["a", "b", 1]', "[1, 2, 3]", '[{"a": "b"}]', "[", "plain"],
+    "iso_date": ["2015-06-01", "1999-12-31", "2090-01-01", "2020-02-30", "Jan 1"],
+    "int": ["0", "12", "-345", "903397", "0123", "1.5"],
+    "plain_string": ["John Smith", "Main St 12", "x", "Zoë", "None", "set()"],
+    None: ["(1, 2)", "{1, 2}", "b'bytes'", "None", "True", "1.5", "Name"],
+}
+
+
+@pytest.mark.parametrize("plan", list(SUPER_COLUMNS))
+def test_obfuscate_super_column_matches_obfuscate_super(plan):
+    column, random_ints, random_days = rows_for_every_random_int(SUPER_COLUMNS[plan])
+
+    assert sniff_super_plan(column.to_numpy(dtype=object)) == plan
+
+    expected = [
+        json.dumps(obfuscate_super(value, random_int, random_day))
+        for value, random_int, random_day in zip(column, random_ints, random_days)
+    ]
+    output = obfuscate_super_column(column, random_ints, random_days)
+
+    assert output.tolist() == expected
+
+
+def test_obfuscate_super_column_leaves_json_arrays_unchanged():
+    column = pd.Series(['["John", 12]'], dtype=object)
+
+    assert obfuscate_super_column(column, [1], [1]).tolist() == [
+        json.dumps('["John", 12]')
+    ]
+
+
+def members(num_rows: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "member_id": np.arange(num_rows),
+            "state": np.where(np.arange(num_rows) % 2 == 0, "MD", "VA"),
+            "first_name": [f"Name {i}" for i in range(num_rows)],
+        }
+    )
+
+
+def test_keyed_row_randomness_is_the_same_however_rows_are_split():
+    df = members(1000)
+    rand_ints, rand_days = keyed_row_randomness(df, ["member_id", "state"], "secret")
+
+    for num_splits in (3, 7):
+        splits = np.array_split(np.arange(len(df.index)), num_splits)
+        # (in reverse order, like chunks that come back from different WHERE clauses or shards out of order)
+        split_randomness = [
+            keyed_row_randomness(df.iloc[rows], ["member_id", "state"], "secret")
+            for rows in reversed(splits)
+        ]
+        assert np.array_equal(
+            np.concatenate([ints for ints, days in reversed(split_randomness)]),
+            rand_ints,
+        )
+        assert np.array_equal(
+            np.concatenate([days for ints, days in reversed(split_randomness)]),
+            rand_days,
+        )
+
+
+def test_keyed_row_randomness_is_the_same_however_keys_are_read():
+    dfs = [
+        pd.DataFrame({"member_id": [5, 6]}),
+        pd.DataFrame({"member_id": [5.0, 6.0]}),
+        pd.DataFrame({"member_id": ["5", "6"]}),
+        pd.DataFrame({"member_id": pd.array([5, 6], dtype="Int64")}),
+    ]
+
+    randomness = [keyed_row_randomness(df, ["member_id"], "secret") for df in dfs]
+
+    for rand_ints, rand_days in randomness[1:]:
+        assert np.array_equal(rand_ints, randomness[0][0])
+        assert np.array_equal(rand_days, randomness[0][1])
+
+
+def test_keyed_row_randomness_depends_on_the_secret():
+    df = members(1000)
+
+    rand_ints, rand_days = keyed_row_randomness(df, ["member_id"], "secret")
+    other_ints, other_days = keyed_row_randomness(df, ["member_id"], "other secret")
+
+    assert (rand_ints != other_ints).mean() > 0.5
+    assert (rand_days != other_days).mean() > 0.5
+
+
+def test_keyed_row_randomness_ranges():
+    rand_ints, rand_days = keyed_row_randomness(members(10000), None, "secret")
+
+    assert rand_ints.min() == 1 and rand_ints.max() == 9
+    assert rand_days.min() >= 1 and rand_days.max() <= 1000
+    assert len(np.unique(rand_ints)) == 9
+    assert len(np.unique(rand_days)) > 900
+
+
+def test_keyed_row_randomness_null_keys_get_the_same_values():
+    df = pd.DataFrame({"member_id": [None, math.nan, pd.NA, 5]}, dtype=object)
+
+    rand_ints, rand_days = keyed_row_randomness(df, ["member_id"], "secret")
+
+    assert len(set(rand_ints[:3])) == 1 and len(set(rand_days[:3])) == 1
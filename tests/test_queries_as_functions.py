@@ -0,0 +1,83 @@
+import pytest
+
+from psycopg2.sql import SQL
+
+from library.queries_as_functions import (
+    copy_to_stdout_query,
+    generic_sql_query,
+    where_clause_condition,
+)
+
+
+def test_keyset_pages_leave_out_null_keys(render_sql):
+    query = render_sql(
+        generic_sql_query("schema", "table", keyset_columns=["a", "b"], limit=10)
+    )
+
+    assert '"a" IS NOT NULL AND "b" IS NOT NULL' in query
+    assert 'ORDER BY "a", "b"' in query
+    assert "LIMIT 10" in query
+
+
+def test_keyset_pages_start_after_the_last_key(render_sql):
+    query = render_sql(
+        generic_sql_query(
+            "schema",
+            "table",
+            "WHERE state = 'MD' OR state = 'VA'",
+            keyset_columns=["a", "b"],
+            after_key=[1, "x"],
+        )
+    )
+
+    assert (
+        "WHERE (state = 'MD' OR state = 'VA') AND \"a\" IS NOT NULL AND \"b\" IS NOT NULL "
+        'AND (("a" > 1) OR ("a" = 1 AND "b" > \'x\'))'
+    ) in query
+
+
+def test_copy_to_stdout_query_prefixes_text_columns(render_sql):
+    query = render_sql(
+        copy_to_stdout_query(
+            SQL("SELECT * FROM members"), ["member_id", "notes"], ["notes"]
+        )
+    )
+
+    assert (
+        'COPY (SELECT "member_id", \'_\' || "notes" AS "notes" FROM (SELECT * FROM members) AS results) '
+        "TO STDOUT WITH (FORMAT csv, NULL '\\\\N')"
+    ) in query
+
+
+def test_key_hash_sampling_buckets_negative_keys(render_sql):
+    query = render_sql(
+        generic_sql_query(
+            "schema",
+            "table",
+            random=True,
+            sample_percentage=10,
+            sampling="key_hash",
+            sample_key="beneficiary_key",
+        )
+    )
+
+    assert 'MOD(ABS("beneficiary_key"), 10000) < 1000' in query
+
+
+@pytest.mark.parametrize(
+    "clause",
+    [
+        "WHERE state = 'MD'",
+        "where state = 'MD'",
+        "  WHERE  state = 'MD'  ",
+        "\nWhere\n  state = 'MD'\n",
+    ],
+)
+def test_where_clause_condition(clause):
+    assert where_clause_condition(clause) == "state = 'MD'"
+
+
+@pytest.mark.parametrize("clause", ["state = 'MD'", "WHEREstate = 'MD'", "WHERE "])
+def test_where_clause_condition_rejects_clauses_without_where(clause):
+    with pytest.raises(AssertionError):
+        where_clause_condition(clause)
@@ -0,0 +1,281 @@
+import os
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import library.s3_utils as s3_utils
+from library.s3_utils import (
+    MIN_PART_SIZE,
+    SYNC_MANIFEST_NAME,
+    S3MultipartUpload,
+    check_if_bucket_exists,
+    check_if_file_exists_in_s3,
+    check_if_files_exist_in_s3,
+    pull_file_from_s3,
+    sync_s3_prefix_to_folder,
+)
+
+BUCKET = "obfuscation-results"
+
+
+@pytest.fixture
+def s3_resource(monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(s3_utils, "RETRY_BACKOFF_SECONDS", 0)
+
+    with mock_aws():
+        s3_resource = boto3.resource("s3")
+        s3_resource.create_bucket(Bucket=BUCKET)
+        yield s3_resource
+
+
+def failing_upload_part(upload: S3MultipartUpload, failures: int) -> list:
+    """Make the first `failures` part uploads fail, and record every attempt's part number"""
+    upload_part = upload._client.upload_part
+    attempts = []
+
+    def flaky_upload_part(**kwargs):
+        attempts.append(kwargs["PartNumber"])
+        if len(attempts) <= failures:
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "SlowDown",
+                        "Message": "Please reduce your request rate",
+                    }
+                },
+                "UploadPart",
+            )
+        return upload_part(**kwargs)
+
+    upload._client.upload_part = flaky_upload_part
+    return attempts
+
+
+def read_object(s3_resource, key: str) -> bytes:
+    return s3_resource.Object(BUCKET, key).get()["Body"].read()
+
+
+def test_multipart_upload(s3_resource):
+    data = os.urandom(2 * MIN_PART_SIZE + 1000)
+
+    with S3MultipartUpload(
+        s3_resource, BUCKET, "results.csv", part_size=MIN_PART_SIZE
+    ) as upload:
+        for start in range(0, len(data), 1_000_000):
+            upload.write(data[start : start + 1_000_000])
+        assert upload.tell() == len(data)
+
+    assert read_object(s3_resource, "results.csv") == data
+
+
+def test_small_upload_is_a_single_put(s3_resource):
+    with S3MultipartUpload(s3_resource, BUCKET, "results.csv") as upload:
+        upload.write(b"a,b\n1,2\n")
+
+    assert read_object(s3_resource, "results.csv") == b"a,b\n1,2\n"
+
+
+def test_failed_part_is_retried(s3_resource):
+    data = os.urandom(MIN_PART_SIZE + 1000)
+    upload = S3MultipartUpload(
+        s3_resource,
+        BUCKET,
+        "results.csv",
+        part_size=MIN_PART_SIZE,
+        max_retries=2,
+        # One part at a time, so the attempts are in order
+        max_concurrency=1,
+    )
+    attempts = failing_upload_part(upload, failures=2)
+
+    with upload:
+        upload.write(data)
+
+    assert attempts == [1, 1, 1, 2]
+    assert read_object(s3_resource, "results.csv") == data
+
+
+def test_upload_is_aborted_when_a_part_keeps_failing(s3_resource):
+    upload = S3MultipartUpload(
+        s3_resource,
+        BUCKET,
+        "results.csv",
+        part_size=MIN_PART_SIZE,
+        max_retries=1,
+        max_concurrency=1,
+    )
+    attempts = failing_upload_part(upload, failures=10)
+
+    with pytest.raises(ClientError):
+        with upload:
+            upload.write(os.urandom(MIN_PART_SIZE + 1000))
+
+    assert attempts == [1, 1]
+    client = s3_resource.meta.client
+    assert "Contents" not in client.list_objects_v2(Bucket=BUCKET)
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=BUCKET)
+
+
+def test_upload_is_aborted_when_writing_fails(s3_resource):
+    with pytest.raises(RuntimeError):
+        with S3MultipartUpload(
+            s3_resource, BUCKET, "results.csv", part_size=MIN_PART_SIZE
+        ) as upload:
+            upload.write(os.urandom(MIN_PART_SIZE + 1000))
+            raise RuntimeError("The query failed")
+
+    client = s3_resource.meta.client
+    assert "Contents" not in client.list_objects_v2(Bucket=BUCKET)
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=BUCKET)
+
+
+def test_sync_only_downloads_changed_objects(s3_resource, tmp_path):
+    client = s3_resource.meta.client
+    download_file = client.download_file
+    downloaded = []
+
+    def recording_download_file(bucket, key, path, **kwargs):
+        downloaded.append(key)
+        return download_file(bucket, key, path, **kwargs)
+
+    client.download_file = recording_download_file
+    bucket = s3_resource.Bucket(BUCKET)
+    bucket.put_object(Key="profiles/mdcr.members.csv", Body=b"column_name\nid\n")
+    bucket.put_object(Key="profiles/mdcr.claims.csv", Body=b"column_name\nclaim_id\n")
+    bucket.put_object(Key="profiles/README.md", Body=b"not a profile")
+    bucket.put_object(Key="profiles/old/mdcr.members.csv", Body=b"not synced")
+
+    def sync() -> dict:
+        downloaded.clear()
+        return sync_s3_prefix_to_folder(
+            s3_resource, BUCKET, "profiles", str(tmp_path), suffix=".csv"
+        )
+
+    local_paths = sync()
+    assert sorted(downloaded) == [
+        "profiles/mdcr.claims.csv",
+        "profiles/mdcr.members.csv",
+    ]
+    assert open(local_paths["profiles/mdcr.members.csv"], "rb").read() == (
+        b"column_name\nid\n"
+    )
+
+    # Up to date, so nothing is downloaded again
+    sync()
+    assert downloaded == []
+
+    # A changed object (new ETag) and a missing local file are downloaded again
+    bucket.put_object(Key="profiles/mdcr.members.csv", Body=b"column_name\nmember_id\n")
+    os.remove(local_paths["profiles/mdcr.claims.csv"])
+    sync()
+    assert sorted(downloaded) == [
+        "profiles/mdcr.claims.csv",
+        "profiles/mdcr.members.csv",
+    ]
+    assert open(local_paths["profiles/mdcr.members.csv"], "rb").read() == (
+        b"column_name\nmember_id\n"
+    )
+
+    # A removed object is removed locally, and from the manifest
+    s3_resource.Object(BUCKET, "profiles/mdcr.claims.csv").delete()
+    local_paths = sync()
+    assert downloaded == []
+    assert list(local_paths) == ["profiles/mdcr.members.csv"]
+    assert sorted(os.listdir(tmp_path)) == [SYNC_MANIFEST_NAME, "mdcr.members.csv"]
+
+
+def recording_calls(client, method: str) -> list:
+    """Record the keyword arguments of every call to one of the client's methods"""
+    original = getattr(client, method)
+    calls = []
+
+    def recording_method(**kwargs):
+        calls.append(kwargs)
+        return original(**kwargs)
+
+    setattr(client, method, recording_method)
+    return calls
+
+
+def test_bucket_existence_is_cached_per_client(s3_resource):
+    head_bucket_calls = recording_calls(s3_resource.meta.client, "head_bucket")
+
+    assert check_if_bucket_exists(s3_resource, BUCKET)
+    assert check_if_bucket_exists(s3_resource, BUCKET)
+    assert not check_if_bucket_exists(s3_resource, "missing-bucket")
+    assert len(head_bucket_calls) == 2
+
+    # Another session (e.g. with other credentials) asks S3 again
+    other_s3_resource = boto3.Session().resource("s3")
+    other_head_bucket_calls = recording_calls(
+        other_s3_resource.meta.client, "head_bucket"
+    )
+    assert check_if_bucket_exists(other_s3_resource, BUCKET)
+    assert len(other_head_bucket_calls) == 1
+
+
+def test_check_if_files_exist_in_s3(s3_resource):
+    bucket = s3_resource.Bucket(BUCKET)
+    for key in ["results/a.csv", "results/b.csv", "results/old/c.csv", "d.csv"]:
+        bucket.put_object(Key=key, Body=b"x")
+    list_calls = recording_calls(s3_resource.meta.client, "list_objects_v2")
+
+    exists = check_if_files_exist_in_s3(
+        s3_resource,
+        BUCKET,
+        [
+            "results/a.csv",
+            "results/b.csv",
+            "results/c.csv",
+            "results/old/c.csv",
+            "d.csv",
+        ],
+    )
+
+    assert exists == {
+        "results/a.csv": True,
+        "results/b.csv": True,
+        "results/c.csv": False,
+        "results/old/c.csv": True,
+        "d.csv": True,
+    }
+    # One listing per folder, and only the key itself for folders with one key
+    assert sorted(call["Prefix"] for call in list_calls) == [
+        "d.csv",
+        "results/",
+        "results/old/c.csv",
+    ]
+    assert check_if_files_exist_in_s3(s3_resource, "missing-bucket", ["d.csv"]) == {
+        "d.csv": False
+    }
+
+
+def test_check_if_file_exists_in_s3(s3_resource):
+    s3_resource.Bucket(BUCKET).put_object(Key="results/a.csv", Body=b"x")
+    s3_resource.Bucket(BUCKET).put_object(Key="results/a.csv.bak", Body=b"x")
+    head_object_calls = recording_calls(s3_resource.meta.client, "head_object")
+
+    assert check_if_file_exists_in_s3(s3_resource, BUCKET, "a.csv", "results")
+    assert check_if_file_exists_in_s3(s3_resource, BUCKET, "results/a.csv")
+    assert not check_if_file_exists_in_s3(s3_resource, BUCKET, "a.cs", "results")
+    assert not check_if_file_exists_in_s3(s3_resource, BUCKET, "a.csv")
+    assert not check_if_file_exists_in_s3(s3_resource, "missing-bucket", "a.csv")
+    assert head_object_calls == []
+
+
+def test_pull_file_from_s3(s3_resource, tmp_path):
+    s3_resource.Bucket(BUCKET).put_object(Key="results/a.csv", Body=b"a,b\n")
+
+    assert pull_file_from_s3(
+        s3_resource, BUCKET, "a.csv", "results", str(tmp_path), "local.csv"
+    )
+    assert (tmp_path / "local.csv").read_bytes() == b"a,b\n"
+    assert not pull_file_from_s3(
+        s3_resource, BUCKET, "missing.csv", "results", str(tmp_path)
+    )
+    assert not (tmp_path / "missing.csv").exists()
@@ -0,0 +1,93 @@
+import math
+
+import numpy as np
+import pytest
+from pandas import DataFrame as DF
+
+import utils.uniqueness_utils as uniqueness_utils
+from utils.uniqueness_utils import UniqueKeyIndex, normalized_key_columns
+
+
+def test_normalized_key_columns():
+    df = DF(
+        {
+            "int_with_nulls": [5.0, math.nan, 7.0],
+            "mixed": [5, "5", 5.0],
+            "float": [0.5, 1.0, None],
+        }
+    )
+
+    keys = normalized_key_columns(df, list(df.columns))
+
+    assert keys["int_with_nulls"].tolist() == ["5", "<NA>", "7"]
+    assert keys["mixed"].tolist() == ["5", "5", "5"]
+    assert keys["float"].tolist() == ["0.5", "1.0", "<NA>"]
+
+
+@pytest.mark.parametrize("max_keys_in_memory", [1_000_000, 2])
+def test_duplicates_with_different_dtypes_are_dropped(tmp_path, max_keys_in_memory):
+    unique_keys = UniqueKeyIndex(
+        ["member_id", "state"], str(tmp_path), max_keys_in_memory=max_keys_in_memory
+    )
+    chunks = [
+        DF({"member_id": [1, 2, 3], "state": ["MD", "MD", "VA"]}),
+        # An int column with NULLs is read as floats
+        DF({"member_id": [2.0, 4.0, math.nan], "state": ["MD", "MD", "VA"]}),
+        # ... and a column of mixed values as objects
+        DF(
+            {
+                "member_id": ["3", 4, 5.0, None, 5],
+                "state": ["VA", "MD", "VA", "VA", "VA"],
+            }
+        ),
+    ]
+
+    kept = [unique_keys.drop_duplicates(chunk) for chunk in chunks]
+
+    assert [len(chunk.index) for chunk in kept] == [3, 2, 1]
+    assert kept[2]["member_id"].tolist() == [5.0]
+    assert unique_keys.num_keys == 6
+
+
+@pytest.mark.parametrize("max_keys_in_memory", [1_000_000, 2])
+def test_keys_with_colliding_hashes_are_kept(tmp_path, monkeypatch, max_keys_in_memory):
+    # Every key gets the same hash
+    monkeypatch.setattr(
+        uniqueness_utils,
+        "hash_key_strings",
+        lambda keys: np.zeros(len(keys), dtype="uint64"),
+    )
+    unique_keys = UniqueKeyIndex(
+        ["member_id"], str(tmp_path), max_keys_in_memory=max_keys_in_memory
+    )
+    chunks = [
+        DF({"member_id": [1, 2, 3]}),
+        DF({"member_id": [2, 4, 5]}),
+        DF({"member_id": [1, 5, 6, 7]}),
+    ]
+
+    kept = [unique_keys.drop_duplicates(chunk) for chunk in chunks]
+
+    assert [chunk["member_id"].tolist() for chunk in kept] == [
+        [1, 2, 3],
+        [4, 5],
+        [6, 7],
+    ]
+    assert unique_keys.num_keys == 7
+
+
+def test_spilled_runs_are_merged(tmp_path):
+    unique_keys = UniqueKeyIndex(
+        ["member_id"], str(tmp_path), max_keys_in_memory=3, num_partitions=1
+    )
+
+    kept = 0
+    for start in range(0, 400, 4):
+        # 4 new keys, and 2 that were already seen
+        chunk = DF({"member_id": list(range(start, start + 4)) + [0, start // 2]})
+        kept += len(unique_keys.drop_duplicates(chunk).index)
+
+    assert kept == 400
+    assert unique_keys.num_keys == 400
+    # 100 spills end up in a handful of runs
+    assert len(list(tmp_path.glob("unique_keys_*_strings.npy"))) <= 7
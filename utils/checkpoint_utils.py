@@ -0,0 +1,127 @@
+from __future__ import annotations
+import os
+import json
+import shutil
+import hashlib
+from dataclasses import dataclass, field, asdict
+from library.log_config import get_logger
+
+from pandas import DataFrame as DF
+
+# Initiate logging
+log = get_logger(__name__)
+
+JOB_SPEC_FILE = "job.json"
+
+
+def open_checkpoint_folder(checkpoint_root: str, job_name: str, job_spec: dict) -> str:
+    """Returns the checkpoint folder of a job, creating it if needed.
+
+    `job_spec` describes what the job extracts (table, clauses, limits, ...). If the folder holds checkpoints of a
+    job with a different spec (e.g. a newer version of the table), they are thrown away, so nothing is resumed from
+    a different extraction.
+    """
+    safe_name = "".join(c if c.isalnum() or c in "._-" else "_" for c in job_name)
+    spec_hash = hashlib.sha256(
+        json.dumps(job_spec, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    checkpoint_folder = os.path.join(checkpoint_root, safe_name)
+    spec_path = os.path.join(checkpoint_folder, JOB_SPEC_FILE)
+
+    if os.path.exists(spec_path):
+        with open(spec_path) as f:
+            if json.load(f).get("spec_hash") == spec_hash:
+                log.info(f"Resuming `{job_name}` from `{checkpoint_folder}`")
+                return checkpoint_folder
+
+        log.info(f"The checkpoints of `{job_name}` are out of date, starting over")
+        shutil.rmtree(checkpoint_folder)
+
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    write_json_atomically(
+        {"spec_hash": spec_hash, "spec": job_spec}, spec_path, default=str
+    )
+    return checkpoint_folder
+
+
+def remove_checkpoint_folder(checkpoint_folder: str) -> None:
+    """Delete a job's checkpoints, once its results have been saved"""
+    shutil.rmtree(checkpoint_folder, ignore_errors=True)
+    log.info(f"Removed the checkpoints in `{checkpoint_folder}`")
+
+
+@dataclass
+class ClauseCheckpoint:
+    """Progress of a profile (WHERE clause) that is extracted page by page (see query_into_df_pages).
+
+    Every obfuscated page is saved to its own file before the checkpoint is updated with the page's last key and the
+    number of rows read so far, so a job that is restarted picks up after the last saved page, without reading or
+    obfuscating the earlier pages again.
+    """
+
+    checkpoint_folder: str
+    clause_number: int
+    clause: str = None
+    last_key: list = None
+    rows_written: int = 0
+    page_files: list = field(default_factory=list)
+    done: bool = False
+
+    @classmethod
+    def load(
+        cls, checkpoint_folder: str, clause_number: int, clause: str = None
+    ) -> ClauseCheckpoint:
+        """Returns the saved checkpoint of a clause, or a new one if there isn't one"""
+        checkpoint = cls(checkpoint_folder, clause_number, clause)
+        if os.path.exists(checkpoint.path):
+            with open(checkpoint.path) as f:
+                saved = json.load(f)
+            if saved["clause"] == clause:
+                checkpoint = cls(checkpoint_folder, **saved)
+                log.info(
+                    f"Clause {clause_number}: resuming after {checkpoint.rows_written} rows "
+                    f"(last key {checkpoint.last_key})"
+                )
+
+        return checkpoint
+
+    @property
+    def path(self) -> str:
+        return os.path.join(
+            self.checkpoint_folder, f"clause_{self.clause_number}.checkpoint.json"
+        )
+
+    def commit_page(self, df_page: DF, last_key: list, rows_read: int) -> None:
+        """Save an obfuscated page, then record it (and where the next page starts) in the checkpoint"""
+        page_file = os.path.join(
+            self.checkpoint_folder,
+            f"clause_{self.clause_number}_page_{len(self.page_files)}.pkl",
+        )
+        temp_path = page_file + ".tmp"
+        df_page.to_pickle(temp_path)
+        os.replace(temp_path, page_file)
+
+        self.page_files.append(page_file)
+        self.last_key = last_key
+        self.rows_written += rows_read
+        self.save()
+
+    def finish(self) -> None:
+        """Mark the clause as fully extracted"""
+        self.done = True
+        self.save()
+
+    def save(self) -> None:
+        checkpoint = asdict(self)
+        del checkpoint["checkpoint_folder"]
+        write_json_atomically(checkpoint, self.path)
+
+
+def write_json_atomically(value, path: str, **kwargs) -> None:
+    """Write to a temp file and rename it, so a partially written file is never read"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(value, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,205 @@
+from __future__ import annotations
+import os
+import json
+import math
+import time
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field, asdict
+from typing import Callable
+from library.log_config import get_logger
+from library.file_utils import ensure_file_slash, make_dir_if_not_exists
+from library.queries_as_functions import WHERE_CLAUSE_PATTERN
+
+# Initiate logging
+log = get_logger(__name__)
+
+
+@dataclass
+class ObfuscationJob:
+    """Everything needed to query a table and save its obfuscated results.
+
+    `database` is the LastPass entry with the database credentials. `clauses` is a list of profiles
+    ({"clause": "WHERE ...", "percentage": 20}), whose percentages add up to 100 (no clauses = the whole table).
+    A limit of 0 means no limit. If `file_name` is None, a default name is built from the table and the options.
+    """
+
+    database: str
+    schema: str
+    base_table_name: str
+    clauses: list = field(default_factory=list)
+    limit: int = 0
+    random: bool = False
+    sampling: str = "random"
+    sample_key: str = None
+    show_obfuscation: bool = False
+    results_location: str = "./results/"
+    file_name: str = None
+    name: str = None
+
+    def __post_init__(self) -> None:
+        if not self.clauses:
+            self.clauses = [{"clause": None, "percentage": 100}]
+
+        for clause_dict in self.clauses:
+            clause = clause_dict.get("clause")
+            # If they didn't include "WHERE" in the clause, add it
+            if clause and not WHERE_CLAUSE_PATTERN.match(clause):
+                clause_dict["clause"] = "WHERE " + clause
+
+        total_percentage = sum(float(c["percentage"]) for c in self.clauses)
+        # (compared with a tolerance, since e.g. 33.3 + 33.3 + 33.4 isn't exactly 100 in floating point)
+        assert math.isclose(
+            total_percentage, 100
+        ), f"The clause percentages of {self.schema}.{self.base_table_name} add up to {total_percentage}%, not 100%"
+
+        if self.name is None:
+            self.name = f"{self.schema}.{self.base_table_name}"
+
+    @property
+    def number_of_clauses(self) -> int:
+        """Number of profiles (0 if the whole table is queried)"""
+        return len([c for c in self.clauses if c.get("clause")])
+
+
+@dataclass
+class JobResult:
+    """Summary of a job that was run"""
+
+    name: str
+    database: str
+    table: str = None
+    output: str = None
+    rows_written: int = 0
+    duration_seconds: float = 0
+    status: str = "succeeded"
+    error: str = None
+
+
+def load_jobs(
+    job_file: str, defaults: dict = None
+) -> tuple[list[ObfuscationJob], dict]:
+    """Reads a YAML or JSON job file.
+
+    The file has a list of `jobs` (each with the fields of ObfuscationJob, where `table` can be used for the base
+    table name), optional `defaults` applied to every job (on top of the `defaults` passed in), and an optional
+    `max_jobs_per_database` ({"<LastPass entry>": 2, ...}). Returns the jobs and the per-database concurrency limits.
+    """
+    with open(job_file) as f:
+        if job_file.endswith((".yaml", ".yml")):
+            # PyYAML is only needed for YAML job files
+            import yaml
+
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+
+    defaults = {
+        **{key: value for key, value in (defaults or {}).items() if value is not None},
+        **spec.get("defaults", {}),
+    }
+    jobs = []
+    for job_spec in spec["jobs"]:
+        job_spec = {**defaults, **job_spec}
+        if "table" in job_spec:
+            job_spec["base_table_name"] = job_spec.pop("table")
+        jobs.append(ObfuscationJob(**job_spec))
+
+    log.info(f"Loaded {len(jobs)} jobs from `{job_file}`")
+    return jobs, spec.get("max_jobs_per_database", {})
+
+
+@dataclass
+class JobScheduler:
+    """Runs jobs concurrently, with at most `max_jobs_per_database` of them (by default `default_jobs_per_database`)
+    running against the same database at once, and `max_concurrent_jobs` in total.
+    A job that fails is reported as failed without stopping the others."""
+
+    run_job: Callable[[ObfuscationJob], JobResult]
+    max_concurrent_jobs: int = 4
+    max_jobs_per_database: dict = field(default_factory=dict)
+    default_jobs_per_database: int = 1
+
+    def run(self, jobs: list[ObfuscationJob]) -> list[JobResult]:
+        """Run every job, and return their results in the same order.
+        Jobs wait in a queue per database, and are only handed to a thread once their database has a free slot,
+        so jobs waiting on a busy database never hold up the threads that could run jobs on another one."""
+        queued_jobs = {}
+        for index, job in enumerate(jobs):
+            queued_jobs.setdefault(job.database, deque()).append((index, job))
+        database_slots = {
+            database: self.max_jobs_per_database.get(
+                database, self.default_jobs_per_database
+            )
+            for database in queued_jobs
+        }
+        assert all(
+            slots >= 1 for slots in database_slots.values()
+        ), f"Every database needs at least one job slot: {database_slots}"
+
+        running_jobs = {database: 0 for database in queued_jobs}
+        results = [None] * len(jobs)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_jobs) as executor:
+            while queued_jobs or futures:
+                # Fill the free threads, taking turns between the databases that have a free slot
+                submitted = True
+                while submitted and len(futures) < self.max_concurrent_jobs:
+                    submitted = False
+                    for database in list(queued_jobs):
+                        if len(futures) >= self.max_concurrent_jobs:
+                            break
+                        if running_jobs[database] >= database_slots[database]:
+                            continue
+
+                        index, job = queued_jobs[database].popleft()
+                        if not queued_jobs[database]:
+                            del queued_jobs[database]
+                        running_jobs[database] += 1
+                        futures[executor.submit(self._run_job, job)] = index
+                        submitted = True
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    running_jobs[jobs[index].database] -= 1
+                    results[index] = future.result()
+
+        return results
+
+    def _run_job(self, job: ObfuscationJob) -> JobResult:
+        log.info(f"Starting job `{job.name}`")
+        start_time = time.perf_counter()
+        try:
+            result = self.run_job(job)
+        except Exception as e:
+            log.exception(f"Job `{job.name}` failed")
+            result = JobResult(job.name, job.database, status="failed", error=repr(e))
+        result.duration_seconds = time.perf_counter() - start_time
+
+        log.info(
+            f"Job `{job.name}` {result.status} in {result.duration_seconds:.1f}s ({result.rows_written} rows)"
+        )
+        return result
+
+
+def write_summary_report(results: list[JobResult], report_path: str) -> None:
+    """Log a summary of the jobs that ran, and save it as JSON"""
+    df_summary = pd.DataFrame([asdict(result) for result in results])
+    log.info(f"Job summary:\n{df_summary.to_string(index=False)}")
+
+    report_folder = os.path.dirname(report_path)
+    if report_folder:
+        make_dir_if_not_exists(ensure_file_slash(report_folder))
+    with open(report_path, "w") as f:
+        json.dump(
+            {
+                "jobs": [asdict(result) for result in results],
+                "total_rows_written": sum(result.rows_written for result in results),
+                "failed_jobs": sum(result.status == "failed" for result in results),
+            },
+            f,
+            indent=2,
+        )
+    log.info(f"Job summary saved to `{report_path}`")
@@ -1,45 +1,156 @@
+from __future__ import annotations
 import json
-from multiprocessing.connection import Connection
-from black import out
 import pandas as pd
 import os
 import codecs
 from dotenv import load_dotenv
 from library.log_config import get_logger
+from psycopg2.extensions import connection as Connection
 from library.database_utils import columns_from_table
+from library.cache_utils import MetadataCache, file_fingerprint
+from library.s3_utils import sync_s3_prefix_to_folder, split_s3_uri
+from library.metrics_utils import timer, count
+from utils.uniqueness_utils import normalized_key_columns
 from datetime import datetime
 import datetime as dt
 import random
 import math
 import ast
+import re
+import string
+import hashlib
 import numpy as np
+from itertools import repeat
+from dataclasses import dataclass
+from typing import Callable, TYPE_CHECKING
 
 from pandas import DataFrame as DF
 
+if TYPE_CHECKING:
+    # Only used for type hints (importing it loads multiprocessing)
+    from concurrent.futures import ProcessPoolExecutor
+
 # Initiate logging
 log = get_logger(__name__)
 
 load_dotenv()
-OBFUSCATION_PROFILE_FOLDER_NAME = os.environ.get("OBFUSCATION_PROFILE_FOLDER_NAME")
-ROOT_DIR = os.path.dirname(os.path.abspath(OBFUSCATION_PROFILE_FOLDER_NAME))
+
+# Translation tables used to obfuscate whole varchar columns at once. Each table applies rot13 to the letters
+# and shifts every digit by the row's random int (mod 10), so there is one table per possible shift (0-9)
+ROT13_TABLE = str.maketrans(
+    string.ascii_lowercase + string.ascii_uppercase,
+    string.ascii_lowercase[13:]
+    + string.ascii_lowercase[:13]
+    + string.ascii_uppercase[13:]
+    + string.ascii_uppercase[:13],
+)
+DIGIT_SHIFT_TABLES = [
+    str.maketrans(string.digits, string.digits[shift:] + string.digits[:shift])
+    for shift in range(10)
+]
+VARCHAR_TRANSLATION_TABLES = [
+    {**ROT13_TABLE, **digit_shift_table} for digit_shift_table in DIGIT_SHIFT_TABLES
+]
+# Postgres text can't hold NUL characters, so it is safe to join a column on it and translate it in one call
+VARCHAR_JOIN_SEPARATOR = "\x00"
+# Names that can start a Python or JSON literal (e.g. None, b'...', set(), null), so a string starting with any
+# other name can't be parsed by ast.literal_eval, json.loads or strptime
+LITERAL_NAMES = {
+    "True",
+    "False",
+    "None",
+    "set",
+    "true",
+    "false",
+    "null",
+    "NaN",
+    "Infinity",
+}
+LEADING_NAME_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+ISO_DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+# Integers (no leading zeros or "+", and small enough to avoid int64 issues) that ast.literal_eval reads back unchanged
+INT_PATTERN = re.compile(r"0|-?[1-9]\d{0,17}")
+# Number of values sampled from a column to decide how to decode it
+SNIFF_SAMPLE_SIZE = 100
+# Shards smaller than this aren't worth sending to another process
+MIN_ROWS_PER_SHARD = 10000
+# Integers this large (19+ digits) could overflow int64 once their digits are shifted
+MAX_INT_TO_SHIFT = 10**18
+
+
+def obfuscation_profile_folder() -> str:
+    """Path to the folder with the obfuscation profiles (OBFUSCATION_PROFILE_FOLDER_NAME in the .env file)"""
+    folder_name = os.environ.get("OBFUSCATION_PROFILE_FOLDER_NAME")
+    if not folder_name:
+        raise ValueError(
+            "OBFUSCATION_PROFILE_FOLDER_NAME is not set, add it to the .env file (see .env_example)"
+        )
+    root_dir = os.path.dirname(os.path.abspath(folder_name))
+
+    return root_dir + "/" + folder_name + "/"
+
+
+def obfuscation_profile_path(schema: str, base_table_name: str) -> str:
+    """Path to the obfuscation profile csv of a table"""
+    path = obfuscation_profile_folder()
+    file = schema + "." + base_table_name + ".csv"
+
+    return path + file
+
+
+def sync_obfuscation_profiles_from_s3(s3_resource, s3_uri: str) -> None:
+    """Syncs the `schema.table.csv` obfuscation profiles under an s3://bucket/prefix/ into the local profile folder,
+    only downloading the ones that changed since the last sync"""
+    bucket, prefix = split_s3_uri(s3_uri)
+    sync_s3_prefix_to_folder(
+        s3_resource,
+        bucket,
+        prefix,
+        obfuscation_profile_folder(),
+        suffix=".csv",
+    )
 
 
 def read_in_obfuscation_profile(schema: str, base_table_name: str) -> DF:
     """Reads in the obfuscation profile as a csv and returns a dataframe of the data"""
-    path = ROOT_DIR + "/" + OBFUSCATION_PROFILE_FOLDER_NAME + "/"
+    path = obfuscation_profile_folder()
     file = schema + "." + base_table_name + ".csv"
 
-    df_obfuscation_profile = pd.read_csv(path + file)
+    df_obfuscation_profile = pd.read_csv(
+        obfuscation_profile_path(schema, base_table_name)
+    )
     log.info(f"Reading in obfuscation profile from {file}; located: {path}")
     return df_obfuscation_profile
 
 
 def find_fields_to_obfuscate(
-    schema: str, base_table_name: str, table: str, conn: Connection
+    schema: str,
+    base_table_name: str,
+    table: str,
+    conn: Connection,
+    cache: MetadataCache = None,
+    compile_plan: bool = False,
 ) -> DF:
-    """Compares obfuscation profile with fields in table to ensure they line up and returns fields to obfuscate and data types"""
+    """Compares obfuscation profile with fields in table to ensure they line up and returns fields to obfuscate and data types.
+    If a metadata cache is passed in, the results are reused until they expire or the obfuscation profile changes.
+    If compile_plan is True, a compiled ObfuscationPlan for the table's columns is returned instead of the dataframe."""
+    if cache is not None:
+        cache_key = f"profile.{schema}.{base_table_name}.{table}"
+        fingerprint = file_fingerprint(
+            obfuscation_profile_path(schema, base_table_name)
+        )
+        cached = cache.get(cache_key, fingerprint)
+        if cached is not None:
+            df_obfuscate, unique_list = cached
+            if compile_plan:
+                df_table_columns = columns_from_table(schema, table, conn, cache)
+                df_obfuscate = ObfuscationPlan.compile(
+                    df_obfuscate, df_table_columns["column_name"]
+                )
+            return df_obfuscate, unique_list
+
     df_obfuscation_profile = read_in_obfuscation_profile(schema, base_table_name)
-    df_table_columns = columns_from_table(schema, table, conn)
+    df_table_columns = columns_from_table(schema, table, conn, cache)
 
     # Try/Except in order to catch if the user doesn't define fields to be unique
     try:
@@ -88,6 +199,12 @@ def find_fields_to_obfuscate(
 
     log.info(f"Found the following columns to obfuscate: \n{df_obfuscate}")
 
+    if cache is not None:
+        cache.set(cache_key, (df_obfuscate, unique_list), fingerprint)
+    if compile_plan:
+        df_obfuscate = ObfuscationPlan.compile(
+            df_obfuscate, df_table_columns["column_name"]
+        )
     return df_obfuscate, unique_list
 
 
@@ -104,18 +221,19 @@ def obfuscate_varchar(
         changed_flag = False
 
         # Some strings are actually lists or dicts. But some strings throw an error.
-        try:
-            temp_literal = ast.literal_eval(temp)
-            actual_type = type(temp_literal)
-
-            if actual_type is list:
-                output = obfuscate_list(temp_literal, random_int, random_days)
-                changed_flag = True
-            elif actual_type is dict:
-                output = obfuscate_dict(temp_literal, random_int, random_days)
-                changed_flag = True
-        except:
-            pass
+        if not is_plain_string(temp):
+            try:
+                temp_literal = ast.literal_eval(temp)
+                actual_type = type(temp_literal)
+
+                if actual_type is list:
+                    output = obfuscate_list(temp_literal, random_int, random_days)
+                    changed_flag = True
+                elif actual_type is dict:
+                    output = obfuscate_dict(temp_literal, random_int, random_days)
+                    changed_flag = True
+            except:
+                pass
 
         if not changed_flag:
             try:
@@ -127,11 +245,14 @@ def obfuscate_varchar(
             output = ""
 
             # For every digit in the string, add a random int and take the modulus to ensure it's single digit
-            for c in temp:
-                if c.isnumeric():
-                    output += str((int(c) + random_int) % 10)
-                else:
-                    output += c
+            if temp.isascii():
+                output = temp.translate(DIGIT_SHIFT_TABLES[random_int % 10])
+            else:
+                for c in temp:
+                    if c.isnumeric():
+                        output += str((int(c) + random_int) % 10)
+                    else:
+                        output += c
 
             # Special treatment for MBI and HICN fields as instructed by Cheryl
             # (https://github.cms.gov/CMS-MAX/synthetic-data/pull/5#discussion_r320900)
@@ -144,6 +265,61 @@ def obfuscate_varchar(
         return output
 
 
+def obfuscate_varchar_column(
+    column: pd.Series, random_ints, random_days, field_name: str = None
+) -> pd.Series:
+    """
+    Vectorized version of obfuscate_varchar for an entire column.
+    Plain ASCII strings are grouped by their random int and translated in bulk. Anything else (None, lists/dicts
+    stored as strings, non-ASCII text, etc.) falls back to obfuscate_varchar, so the output is identical.
+    """
+    values = column.to_numpy(dtype=object)
+    random_ints = np.asarray(random_ints)
+    random_days = np.asarray(random_days)
+    output = np.empty(len(values), dtype=object)
+
+    # Only strings that can't be a list or dict literal, and whose only numeric characters are 0-9, are safe to translate
+    fast_path = np.fromiter(
+        (
+            isinstance(value, str)
+            and value.isascii()
+            and "[" not in value
+            and "{" not in value
+            for value in values
+        ),
+        dtype=bool,
+        count=len(values),
+    )
+
+    for i in np.flatnonzero(~fast_path):
+        output[i] = obfuscate_varchar(
+            values[i], int(random_ints[i]), int(random_days[i]), field_name
+        )
+
+    shifts = random_ints % 10
+    for shift in np.unique(shifts[fast_path]):
+        idx = np.flatnonzero(fast_path & (shifts == shift))
+        group = values[idx]
+        table = VARCHAR_TRANSLATION_TABLES[shift]
+
+        joined = VARCHAR_JOIN_SEPARATOR.join(group)
+        if joined.count(VARCHAR_JOIN_SEPARATOR) == len(group) - 1:
+            translated = joined.translate(table).split(VARCHAR_JOIN_SEPARATOR)
+        else:
+            translated = [value.translate(table) for value in group]
+
+        # Special treatment for MBI and HICN fields (see obfuscate_varchar)
+        if field_name is not None:
+            if "hicn" in field_name:
+                translated = [value.replace(value[:3], "MAX") for value in translated]
+            elif "mbi" in field_name:
+                translated = [value.replace(value[4:6], "TE") for value in translated]
+
+        output[idx] = translated
+
+    return pd.Series(output, index=column.index, name=column.name, dtype=object)
+
+
 def obfuscate_int(input: int, random_int: int, random_days: int) -> int:
     """
     Obfuscate an integer by adding a random integer to evey digit
@@ -158,6 +334,58 @@ def obfuscate_int(input: int, random_int: int, random_days: int) -> int:
         return output
 
 
+def obfuscate_int_column(column: pd.Series, random_ints, random_days) -> pd.Series:
+    """
+    Vectorized version of obfuscate_int for an entire column.
+    Every digit is shifted by the row's random int with integer arithmetic, and a nullable integer column is returned.
+    (Leading zeros created by the shift are not kept, e.g. "0978" comes back as 978)
+    """
+    random_ints = np.asarray(random_ints, dtype="int64")
+
+    if pd.api.types.is_integer_dtype(column.dtype):
+        missing = column.isna().to_numpy()
+        values = column.to_numpy(dtype="int64", na_value=0)
+    else:
+        try:
+            # Keep integers stored in object/float columns exact (floats lose precision past 2**53)
+            numbers = pd.array(column.to_numpy(dtype=object), dtype="Int64")
+            missing = numbers.isna()
+            values = numbers.to_numpy(dtype="int64", na_value=0)
+        except (TypeError, ValueError, OverflowError):
+            # Non-integral (or huge) values are truncated the same way int() would
+            numbers = pd.to_numeric(column)
+            missing = numbers.isna().to_numpy()
+            values = np.trunc(numbers.to_numpy(dtype="float64", na_value=0))
+
+    # Numbers with 19+ digits could overflow int64 once shifted, so they go through the string path
+    if (np.abs(values) >= MAX_INT_TO_SHIFT).any():
+        # (obfuscate_int can't take pd.NA, e.g. from an Int64 column)
+        output = [
+            None if is_missing else obfuscate_int(value, random_int, random_day)
+            for value, is_missing, random_int, random_day in zip(
+                column, missing, random_ints, np.asarray(random_days)
+            )
+        ]
+        return pd.Series(output, index=column.index, name=column.name, dtype=object)
+
+    values = values.astype("int64")
+    remaining = np.abs(values)
+    shifted = np.zeros(len(values), dtype="int64")
+    place = 1
+    digit = 0
+    # Peel off one digit at a time (every number has at least one digit, including 0)
+    while digit == 0 or (remaining > 0).any():
+        has_digit = (remaining > 0) | (digit == 0)
+        shifted += np.where(has_digit, (remaining % 10 + random_ints) % 10, 0) * place
+        remaining //= 10
+        place *= 10
+        digit += 1
+
+    output = pd.array(np.where(values < 0, -shifted, shifted), dtype="Int64")
+    output[missing] = pd.NA
+    return pd.Series(output, index=column.index, name=column.name)
+
+
 def obfuscate_date(input, rand_days: int) -> str:
     """
     Obfuscate a date by adding or subracting a random number of days from it.
@@ -186,6 +414,27 @@ def obfuscate_date(input, rand_days: int) -> str:
         return input
 
 
+def obfuscate_date_column(column: pd.Series, random_ints, random_days) -> pd.Series:
+    """
+    Vectorized version of obfuscate_date for an entire column.
+    "Now" is only looked up once, and NaT stays NaT. The output is kept as a datetime column (truncated to the day,
+    like obfuscate_date's YYYY-MM-DD strings) so it is only formatted once, when the results are written.
+    Dates shifted out of the years 1-9999 become NaT.
+    """
+    dates = pd.to_datetime(column)
+    now = pd.Timestamp.now(tz=dates.dt.tz)
+    shift = np.asarray(random_days, dtype="int64").astype("timedelta64[D]")
+
+    # Keep dates in the past in the past, and dates in the future in the future.
+    shifted = dates + np.where(dates < now, -shift, shift)
+
+    # Dates shifted past year 9999 (e.g. the sentinel 9999-12-31) or before year 1 can't be written back to the
+    # database, so they become NULL (like obfuscate_date, where the shift raises an OverflowError)
+    shifted = shifted.where((shifted.dt.year >= 1) & (shifted.dt.year <= 9999))
+
+    return shifted.dt.normalize()
+
+
 def obfuscate_super(input: str, random_int: int, random_days: int):
     """Obfuscates a "super" data type from Postgres"""
     try:
@@ -195,10 +444,24 @@ def obfuscate_super(input: str, random_int: int, random_days: int):
     return output
 
 
+def is_plain_string(value) -> bool:
+    """True if the value is a string that starts with a name which can't begin a literal (e.g. "John", not "None").
+    ast.literal_eval, json.loads and strptime would all fail on it, so it can only be obfuscated as text."""
+    if not isinstance(value, str):
+        return False
+
+    match = LEADING_NAME_PATTERN.match(value)
+    if match is None or match.group() in LITERAL_NAMES:
+        return False
+
+    # Prefixed string literals (e.g. b'...', r"...")
+    return value[match.end() : match.end() + 1] not in ("'", '"')
+
+
 def find_actual_datatype(value: str) -> tuple:
     """Determines the underlying datatype (dict, date, etc.) given a string"""
     value_type = type(value)
-    if value_type is str:
+    if value_type is str and not is_plain_string(value):
         try:
             # If it is in a dictionary with a null value, ast.literal_eval will throw an error
             value = ast.literal_eval(value)
@@ -262,6 +525,153 @@ def obfuscate_dict(input: dict, random_int: int, random_days: int) -> dict:
     return output
 
 
+def fits_plain_string(value) -> bool:
+    return is_plain_string(value) and value.isascii()
+
+
+def obfuscate_plain_strings(values, random_ints, random_days) -> list:
+    """A plain string can only be rot13'd and have its digits shifted (with no field name)"""
+    return [
+        value.translate(VARCHAR_TRANSLATION_TABLES[random_int % 10])
+        for value, random_int in zip(values, random_ints)
+    ]
+
+
+def fits_json_object(value) -> bool:
+    # Without backslashes (escapes), ast.literal_eval and json.loads decode JSON to the same dictionary
+    return isinstance(value, str) and value.lstrip()[:1] == "{" and "\\" not in value
+
+
+def obfuscate_json_objects(values, random_ints, random_days) -> list:
+    output = []
+    for value, random_int, random_day in zip(values, random_ints, random_days):
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            decoded = None
+
+        if type(decoded) is dict:
+            try:
+                output.append(obfuscate_dict(decoded, int(random_int), int(random_day)))
+            except:
+                # Same as obfuscate_super
+                output.append(value)
+        else:
+            output.append(obfuscate_super(value, int(random_int), int(random_day)))
+
+    return output
+
+
+def fits_json_array(value) -> bool:
+    return isinstance(value, str) and value.lstrip()[:1] == "[" and "\\" not in value
+
+
+def obfuscate_json_arrays(values, random_ints, random_days) -> list:
+    output = []
+    for value, random_int, random_day in zip(values, random_ints, random_days):
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            decoded = None
+
+        if type(decoded) is list:
+            # obfuscate_super returns lists as they are, since find_actual_type_and_obfuscate
+            # calls obfuscate_list without random_days
+            output.append(value)
+        else:
+            output.append(obfuscate_super(value, int(random_int), int(random_day)))
+
+    return output
+
+
+def fits_iso_date(value) -> bool:
+    return isinstance(value, str) and ISO_DATE_PATTERN.fullmatch(value) is not None
+
+
+def obfuscate_iso_dates(values, random_ints, random_days) -> list:
+    dates = pd.to_datetime(pd.Series(values), format="%Y-%m-%d", errors="coerce")
+    today = pd.Timestamp(datetime.now().date())
+    shift = np.asarray(random_days, dtype="int64").astype("timedelta64[D]")
+
+    # Keep dates in the past in the past, and dates in the future in the future (like obfuscate_date)
+    shifted = (dates + np.where(dates < today, -shift, shift)).dt.strftime("%Y-%m-%d")
+
+    output = list(shifted)
+    # Dates pandas can't parse (e.g. out of range) are handled by obfuscate_super
+    for i in np.flatnonzero(dates.isna().to_numpy()):
+        output[i] = obfuscate_super(values[i], int(random_ints[i]), int(random_days[i]))
+
+    return output
+
+
+def fits_int(value) -> bool:
+    return isinstance(value, str) and INT_PATTERN.fullmatch(value) is not None
+
+
+# Ways to decode and obfuscate a whole "super" column: (check if a value fits, obfuscate the values that fit)
+SUPER_DECODER_PLANS = {
+    "plain_string": (fits_plain_string, obfuscate_plain_strings),
+    "json_object": (fits_json_object, obfuscate_json_objects),
+    "json_array": (fits_json_array, obfuscate_json_arrays),
+    "iso_date": (fits_iso_date, obfuscate_iso_dates),
+    # Integers only have their digits shifted, the same as plain strings
+    "int": (fits_int, obfuscate_plain_strings),
+}
+
+
+def sniff_super_plan(values, sample_size: int = SNIFF_SAMPLE_SIZE) -> str:
+    """Samples the first non-null values of a column and returns the decoder plan that fits most of them
+    (or None if no plan fits at least half of the sample)"""
+    sample = [value for value in values[: sample_size * 2] if value is not None][
+        :sample_size
+    ]
+    if not sample:
+        return None
+
+    fit_counts = {
+        plan: sum(fits(value) for value in sample)
+        for plan, (fits, obfuscate) in SUPER_DECODER_PLANS.items()
+    }
+    plan = max(fit_counts, key=fit_counts.get)
+
+    if fit_counts[plan] * 2 < len(sample):
+        return None
+    return plan
+
+
+def obfuscate_super_column(column: pd.Series, random_ints, random_days) -> pd.Series:
+    """
+    Column version of obfuscate_super, which also converts the results to JSON.
+    The first values are sniffed to pick a decoder plan, and every value that fits the plan is decoded and obfuscated
+    with it. Everything else goes through obfuscate_super, so the output is the same.
+    """
+    values = column.to_numpy(dtype=object)
+    random_ints = np.asarray(random_ints)
+    random_days = np.asarray(random_days)
+    output = np.empty(len(values), dtype=object)
+
+    plan = sniff_super_plan(values)
+    if plan is None:
+        fits_plan = np.zeros(len(values), dtype=bool)
+    else:
+        fits, obfuscate = SUPER_DECODER_PLANS[plan]
+        fits_plan = np.fromiter(
+            (fits(value) for value in values), dtype=bool, count=len(values)
+        )
+        idx = np.flatnonzero(fits_plan)
+        output[idx] = [
+            json.dumps(value)
+            for value in obfuscate(values[idx], random_ints[idx], random_days[idx])
+        ]
+
+    for i in np.flatnonzero(~fits_plan):
+        output[i] = json.dumps(
+            obfuscate_super(values[i], int(random_ints[i]), int(random_days[i]))
+        )
+
+    return pd.Series(output, index=column.index, name=column.name, dtype=object)
+
+
 def compare_before_and_after(
     before_df: DF, after_df: DF, col, num_rows: int = 10
 ) -> None:
@@ -277,61 +687,202 @@ def compare_before_and_after(
     print("\n", merged, "\n")
 
 
+# Column-level obfuscation kernels for each data type in the obfuscation profile.
+# Every kernel takes (column, random_ints, random_days, **options) and returns the obfuscated column
+COLUMN_KERNELS = {
+    "int": obfuscate_int_column,
+    "date": obfuscate_date_column,
+    "timestamp": obfuscate_date_column,
+    "varchar": obfuscate_varchar_column,
+    "super": obfuscate_super_column,
+}
+
+
 def obfuscate_column(df: DF, column: str, dtype: type):
     """Obfuscate a single column of a dataframe"""
     # log.info(f"Obfuscating `{column}`")
-    if dtype == "int":
-        df[column] = df.apply(
-            lambda x: obfuscate_int(x[column], x["rand_int"], x["rand_days"]),
-            axis=1,
-        )
-
-    elif dtype in ("date", "timestamp"):
-        # Convert the column to datetime to make our lives easier during obfuscation
-        df[column] = pd.to_datetime(df[column])
-        df[column] = df.apply(
-            lambda x: obfuscate_date(x[column], x["rand_days"]), axis=1
-        )
-    elif dtype == "varchar":
-        df[column] = df.apply(
-            lambda x: obfuscate_varchar(
-                x[column], x["rand_int"], x["rand_days"], column
-            ),
-            axis=1,
-        )
-    elif dtype == "super":
-        df[column] = df.apply(
-            lambda x: obfuscate_super(x[column], x["rand_int"], x["rand_days"]),
-            axis=1,
-        )
-        df[column] = df.apply(lambda x: json.dumps(x[column]), axis=1)
-    else:
+    if dtype not in COLUMN_KERNELS:
         raise AssertionError(f"Unexpected data type in fields to obfuscate: {dtype}")
 
+    options = {"field_name": column} if dtype == "varchar" else {}
+    df[column] = COLUMN_KERNELS[dtype](
+        df[column], df["rand_int"], df["rand_days"], **options
+    )
+
     return df[column]
 
 
+@dataclass(frozen=True)
+class ColumnStep:
+    """A single column to obfuscate: its position in the results, its data type, the kernel and its options"""
+
+    position: int
+    column: str
+    dtype: str
+    kernel: Callable
+    options: tuple = ()
+
+
+@dataclass(frozen=True)
+class ObfuscationPlan:
+    """Compiled version of the fields to obfuscate for a table's columns.
+
+    The data types are looked up and checked once, when the plan is compiled, and every chunk of results
+    is then obfuscated by running the plan's steps in order.
+    """
+
+    columns: tuple
+    steps: tuple
+
+    @classmethod
+    def compile(cls, fields_to_obfuscate: DF, columns) -> ObfuscationPlan:
+        """Build a plan from the fields to obfuscate (see find_fields_to_obfuscate), for results with these columns"""
+        columns = tuple(columns)
+        steps = []
+        for position, column in enumerate(columns):
+            if column in fields_to_obfuscate.index:
+                dtype = fields_to_obfuscate.loc[column]["dtype"]
+                if dtype not in COLUMN_KERNELS:
+                    raise AssertionError(
+                        f"Unexpected data type in fields to obfuscate: {dtype} (column `{column}`)"
+                    )
+
+                # The field name is used for the MBI and HICN special treatment
+                options = (("field_name", column),) if dtype == "varchar" else ()
+                steps.append(
+                    ColumnStep(position, column, dtype, COLUMN_KERNELS[dtype], options)
+                )
+
+        return cls(columns, tuple(steps))
+
+    def bind(self, columns) -> ObfuscationPlan:
+        """Returns the same plan for results whose columns are in a different order"""
+        columns = tuple(columns)
+        missing_columns = [
+            step.column for step in self.steps if step.column not in columns
+        ]
+        assert (
+            len(missing_columns) == 0
+        ), f"The query results are missing columns to obfuscate: {missing_columns}"
+
+        steps = tuple(
+            ColumnStep(
+                columns.index(step.column),
+                step.column,
+                step.dtype,
+                step.kernel,
+                step.options,
+            )
+            for step in self.steps
+        )
+        return ObfuscationPlan(columns, steps)
+
+    def apply(self, df: DF) -> DF:
+        """Obfuscates the dataframe in place. It must already have its `rand_int` and `rand_days` columns."""
+        plan = self
+        if tuple(df.columns[: len(self.columns)]) != self.columns:
+            plan = self.bind(df.columns)
+
+        random_ints = df["rand_int"]
+        random_days = df["rand_days"]
+        for step in plan.steps:
+            with timer("obfuscate_column", column=step.column, dtype=step.dtype):
+                df[step.column] = step.kernel(
+                    df.iloc[:, step.position],
+                    random_ints,
+                    random_days,
+                    **dict(step.options),
+                )
+
+        return df
+
+
+def obfuscate_shard(df_shard: DF, plan: ObfuscationPlan) -> DF:
+    """Obfuscates every column of a dataframe that is in the obfuscation plan.
+    The dataframe must already have its `rand_int` and `rand_days` columns, so it can be run in a separate process.
+    """
+    return plan.apply(df_shard.copy())
+
+
+def keyed_row_randomness(
+    df: DF, key_columns: list, run_secret: str
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns each row's random int (1-9) and random days (1-1000), derived from a keyed hash of its key columns.
+
+    The hash is SipHash (what pandas uses to hash objects), keyed with a digest of the run secret, so the values
+    can't be worked out without the secret, but the same row always gets the same values in the same run,
+    however the rows are split into chunks or shards. If no key columns are given, every column is used.
+    NULL key values are all hashed as "<NA>" (see normalized_key_columns), so rows whose keys are all NULL get the
+    same random values.
+    """
+    key_columns = [c for c in key_columns or [] if c in df.columns] or list(df.columns)
+
+    # A key hashes the same however it was read (e.g. an int column with NULLs is read as floats)
+    keys = normalized_key_columns(df, key_columns)
+
+    digest = hashlib.sha256(run_secret.encode("utf-8")).digest()
+    hash_key = "".join(chr(33 + b % 94) for b in digest[:16])
+    hashes = pd.util.hash_pandas_object(keys, index=False, hash_key=hash_key).to_numpy()
+
+    rand_ints = (hashes % np.uint64(9)).astype("int64") + 1
+    rand_days = ((hashes >> np.uint64(32)) % np.uint64(1000)).astype("int64") + 1
+    return rand_ints, rand_days
+
+
 def obfuscate_dataframe(
-    query_results: DF, fields_to_obfuscate: DF, show_comparison: bool = True
+    query_results: DF,
+    fields_to_obfuscate: DF | ObfuscationPlan,
+    show_comparison: bool = True,
+    process_pool: ProcessPoolExecutor = None,
+    num_shards: int = 1,
+    run_secret: str = None,
+    key_columns: list = None,
 ) -> DF:
-    """Takes in a dataframe, compares columns to the obfuscation profile, and obfuscates them if they match"""
-    query_cols = query_results.columns
+    """Takes in a dataframe, compares columns to the obfuscation profile, and obfuscates them if they match.
+    Pass in a compiled ObfuscationPlan to avoid looking up the profile again for every chunk.
+    If a process pool is passed in, the rows are split into `num_shards` shards that are obfuscated in parallel.
+    If a `run_secret` is passed in, each row's randomness is derived from the secret and its `key_columns`
+    (see keyed_row_randomness), so the same row is always obfuscated the same way.
+    """
+    if isinstance(fields_to_obfuscate, ObfuscationPlan):
+        plan = fields_to_obfuscate
+    else:
+        plan = ObfuscationPlan.compile(fields_to_obfuscate, query_results.columns)
+
     df_cleaned = query_results.copy()
 
     # Pass in random values to each row so each row has it's own randomness that is consistent across the row
-    df_cleaned["rand_int"] = [random.randint(1, 9) for k in df_cleaned.index]
-    df_cleaned["rand_days"] = [random.randint(1, 1000) for k in df_cleaned.index]
-
-    # Loop through every column, and if the column matches the obfuscation profile, scramble the letters/digits
-    for col in query_cols:
-        if col in fields_to_obfuscate.index:
-            dtype = fields_to_obfuscate.loc[col]["dtype"]
-            # special_treatment = fields_to_obfuscate.loc[col]["special_treatment"]
-            df_cleaned[col] = obfuscate_column(df_cleaned, col, dtype)
-
-            # Show the before and after, if requested
-            if show_comparison:
-                compare_before_and_after(query_results, df_cleaned, col)
+    with timer("row_randomness"):
+        if run_secret:
+            df_cleaned["rand_int"], df_cleaned["rand_days"] = keyed_row_randomness(
+                query_results, key_columns, run_secret
+            )
+        else:
+            df_cleaned["rand_int"] = [random.randint(1, 9) for k in df_cleaned.index]
+            df_cleaned["rand_days"] = [
+                random.randint(1, 1000) for k in df_cleaned.index
+            ]
+
+    num_shards = min(num_shards, len(df_cleaned.index) // MIN_ROWS_PER_SHARD)
+    if process_pool is not None and num_shards > 1:
+        # Each shard carries its own random values, and the shards are put back together in the original order
+        shards = [
+            df_cleaned.iloc[rows]
+            for rows in np.array_split(np.arange(len(df_cleaned.index)), num_shards)
+        ]
+        # (their per-column timings aren't collected, since they run in other processes)
+        with timer("obfuscate_shards"):
+            df_cleaned = pd.concat(
+                process_pool.map(obfuscate_shard, shards, repeat(plan))
+            )
+    else:
+        df_cleaned = plan.apply(df_cleaned)
+    count("rows", len(df_cleaned.index), stage="obfuscate")
+
+    # Show the before and after, if requested
+    if show_comparison:
+        for step in plan.steps:
+            compare_before_and_after(query_results, df_cleaned, step.column)
 
     log.info("Obfuscation Complete!")
     df_cleaned = df_cleaned.drop(["rand_int", "rand_days"], axis=1)
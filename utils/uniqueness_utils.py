@@ -0,0 +1,203 @@
+import os
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from library.log_config import get_logger
+from library.metrics_utils import timer, count
+
+from pandas import DataFrame as DF
+
+# Initiate logging
+log = get_logger(__name__)
+
+# Separates the unique fields of a key (the ASCII unit separator, which doesn't show up in the data)
+KEY_SEPARATOR = "\x1f"
+
+
+def normalized_key_columns(df: DF, key_columns: list) -> DF:
+    """The key columns as strings that are written the same way whatever dtype the values were read as, so a key
+    compares and hashes the same in every chunk: 5, 5.0 (e.g. from an int column with NULLs) and "5" all become "5",
+    and every kind of NULL becomes "<NA>"."""
+    keys = df[key_columns].copy()
+    for column in key_columns:
+        values = keys[column]
+        if pd.api.types.is_float_dtype(values):
+            whole_numbers = values.dropna()
+            if np.isfinite(whole_numbers).all() and np.array_equal(
+                whole_numbers, np.floor(whole_numbers)
+            ):
+                values = values.astype("Int64")
+        elif pd.api.types.is_object_dtype(values):
+            values = values.map(
+                lambda value: int(value)
+                if isinstance(value, float) and value.is_integer()
+                else value,
+                na_action="ignore",
+            )
+        keys[column] = values.astype(str).mask(values.isna(), "<NA>")
+
+    return keys
+
+
+def encode_keys(key_strings: np.ndarray) -> np.ndarray:
+    """Key strings as a fixed-width bytes array, which (unlike an array of objects) can be saved and memory mapped"""
+    return np.char.encode(key_strings.astype(str), "utf-8")
+
+
+def key_strings(keys: DF) -> np.ndarray:
+    """Joins each row of normalized key columns (see `normalized_key_columns`) into a single string"""
+    columns = iter(keys.columns)
+    joined = keys[next(columns)]
+    for column in columns:
+        joined = joined + KEY_SEPARATOR + keys[column]
+
+    return joined.to_numpy(dtype=object)
+
+
+def hash_key_strings(key_strings: np.ndarray) -> np.ndarray:
+    """64-bit hashes of key strings, used to partition the spilled keys and search them quickly"""
+    return pd.util.hash_array(key_strings)
+
+
+@dataclass
+class UniqueKeyIndex:
+    """Keeps track of the unique fields that have already been written, so duplicates can be dropped chunk by chunk.
+
+    Each row's unique fields are joined into a single key string. The key strings are kept in memory until there are
+    more than `max_keys_in_memory` of them (a number of keys, not bytes, so wide composite keys take up more memory).
+    They are then spilled to `spill_folder`, partitioned by a 64-bit hash of the key: each spill writes a new run per
+    partition (sorted by hash), and runs are searched with memory maps, so only the pages that are needed get loaded.
+    A partition's newest runs are merged once they are at least half as big as the run before them, so each key is
+    only rewritten a logarithmic number of times, and a partition never has more than a few dozen runs. The key strings are stored next to
+    their hashes, so two different keys whose hashes collide are both kept.
+    """
+
+    unique_field_list: list
+    spill_folder: str
+    max_keys_in_memory: int = 1_000_000
+    num_partitions: int = 64
+
+    def __post_init__(self) -> None:
+        self._keys_in_memory = set()
+        # Runs spilled to disk, oldest first, by partition: [(run id, number of keys), ...]
+        self._runs = {}
+        self._next_run_id = 0
+        self.num_keys = 0
+
+    def drop_duplicates(self, df: DF) -> DF:
+        """Drops rows whose unique fields were already seen, either in this chunk or in a previous one."""
+        num_rows = len(df.index)
+        with timer("dedupe"):
+            # The same key can be read with different dtypes in different chunks (e.g. 5, 5.0 or "5")
+            keys = key_strings(normalized_key_columns(df, self.unique_field_list))
+            is_first = ~pd.Series(keys).duplicated().to_numpy()
+            df = df[is_first]
+            keys = keys[is_first]
+
+            is_new = ~self._seen(keys)
+            self._keys_in_memory.update(keys[is_new].tolist())
+            self.num_keys += int(is_new.sum())
+
+            if len(self._keys_in_memory) > self.max_keys_in_memory:
+                self._spill()
+
+        count("rows_dropped", num_rows - int(is_new.sum()), stage="dedupe")
+        return df[is_new]
+
+    def _seen(self, keys: np.ndarray) -> np.ndarray:
+        """Returns which keys have already been seen"""
+        seen = np.fromiter(
+            (key in self._keys_in_memory for key in keys.tolist()),
+            dtype=bool,
+            count=len(keys),
+        )
+
+        if self._runs:
+            hashes = hash_key_strings(keys)
+            partitions = hashes % self.num_partitions
+            for partition in np.unique(partitions):
+                in_partition = np.flatnonzero(partitions == partition)
+                encoded_keys = encode_keys(keys[in_partition])
+                for run_id, _ in self._runs.get(partition, []):
+                    seen[in_partition] |= self._seen_in_run(
+                        run_id, hashes[in_partition], encoded_keys
+                    )
+
+        return seen
+
+    def _seen_in_run(
+        self, run_id: int, hashes: np.ndarray, encoded_keys: np.ndarray
+    ) -> np.ndarray:
+        """Returns which keys are in a spilled run"""
+        hashes_path, keys_path = self._run_paths(run_id)
+        run_hashes = np.load(hashes_path, mmap_mode="r")
+        run_keys = np.load(keys_path, mmap_mode="r")
+        first = np.searchsorted(run_hashes, hashes, "left")
+        last = np.searchsorted(run_hashes, hashes, "right")
+
+        # Almost every hash matches at most one spilled key, the rest have colliding hashes
+        seen = np.zeros(len(hashes), dtype=bool)
+        single = np.flatnonzero(last - first == 1)
+        seen[single] = run_keys[first[single]] == encoded_keys[single]
+        for i in np.flatnonzero(last - first > 1):
+            seen[i] = bool((run_keys[first[i] : last[i]] == encoded_keys[i]).any())
+
+        return seen
+
+    def _spill(self) -> None:
+        """Write the keys held in memory to a new run in each partition"""
+        log.info(
+            f"More than {self.max_keys_in_memory} unique keys in memory, spilling them to `{self.spill_folder}`"
+        )
+        os.makedirs(self.spill_folder, exist_ok=True)
+
+        keys = np.fromiter(
+            self._keys_in_memory, dtype=object, count=len(self._keys_in_memory)
+        )
+        hashes = hash_key_strings(keys)
+        keys = encode_keys(keys)
+        partitions = hashes % self.num_partitions
+        for partition in np.unique(partitions):
+            in_partition = partitions == partition
+            runs = self._runs.setdefault(partition, [])
+            runs.append(self._write_run(hashes[in_partition], keys[in_partition]))
+
+            # Merge the newest runs while they are at least half as big as the run before them, so run sizes keep
+            # (at least) halving from the oldest to the newest
+            while len(runs) > 1 and runs[-2][1] <= 2 * runs[-1][1]:
+                newer = runs.pop()
+                older = runs.pop()
+                runs.append(self._merge_runs(older, newer))
+
+        self._keys_in_memory = set()
+
+    def _write_run(self, hashes: np.ndarray, keys: np.ndarray) -> tuple:
+        """Save keys (which are only spilled once they're known to be new) sorted by their hash, as a new run"""
+        run_id = self._next_run_id
+        self._next_run_id += 1
+
+        order = np.argsort(hashes, kind="stable")
+        for path, values in zip(self._run_paths(run_id), (hashes, keys)):
+            np.save(path, values[order])
+
+        return run_id, len(hashes)
+
+    def _merge_runs(self, older: tuple, newer: tuple) -> tuple:
+        """Replace two runs with a single one"""
+        paths = [self._run_paths(run_id) for run_id, _ in (older, newer)]
+        hashes = np.concatenate([np.load(hashes_path) for hashes_path, _ in paths])
+        keys = np.concatenate([np.load(keys_path) for _, keys_path in paths])
+        merged = self._write_run(hashes, keys)
+
+        for run_paths in paths:
+            for path in run_paths:
+                os.remove(path)
+
+        return merged
+
+    def _run_paths(self, run_id: int) -> tuple:
+        """The paths of a run's sorted hashes, and of the key strings that go with them"""
+        return (
+            os.path.join(self.spill_folder, f"unique_keys_{run_id}.npy"),
+            os.path.join(self.spill_folder, f"unique_keys_{run_id}_strings.npy"),
+        )